@@ -1,13 +1,45 @@
-import requests
 import json
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from datetime import timedelta, timezone
 from pathlib import Path
 import logging
 import time
-from src.utils import to_float, to_int
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from src.utils import to_float, to_int, time_chunks, RateLimiter
+from src.cache_index import (
+    LatestRows,
+    SeriesCodes,
+    SeriesIndex,
+    latest_positions,
+    row_keys,
+)
+from src.cache_store import PartitionedCache, months_between, write_cache_file
+from src.file_lock import FileLock
+from src.metrics import Metrics
+from src.negative_cache import UnavailableRanges
+from src.query_cache import QueryCache, query_key
+from src.transport import HTTPTransport
+from src.interval_join import covering_slots, interval_integrals, time_weighted_means
 
 utc = timezone.utc
+fuel_types = [  # Fuels of the CarbonIntensity generation mix
+    "biomass",
+    "coal",
+    "imports",
+    "gas",
+    "nuclear",
+    "other",
+    "hydro",
+    "solar",
+    "wind",
+]
+generationmix_cols = [f"generationmix_{fuel}" for fuel in fuel_types]
 co2_data_cols = [
     # Metadata
     "id",
@@ -26,7 +58,8 @@ co2_data_cols = [
     "intensity_forecast",
     "intensity_index",  # CO2 Grams per kWh
     "intensity_actual",  # CO2 Grams per kWh
-    "generationmix",  # If available % of total Power generated by source
+    # If available % of total Power generated by each fuel (NaN otherwise)
+    *generationmix_cols,
 ]
 price_data_cols = [
     "id",
@@ -39,6 +72,64 @@ price_data_cols = [
     "dnoRegion",
     "pennies_per_kwh",
 ]
+
+# On-disk (and in-memory) schemas of the caches. Labels repeated on every row are
+# dictionary encoded (loaded as pandas categoricals).
+label_type = pa.dictionary(pa.int32(), pa.string())
+timestamp_type = pa.timestamp("us", tz="UTC")
+co2_schema = pa.schema(
+    [
+        ("id", pa.string()),
+        ("created", pa.int64()),
+        ("from", timestamp_type),
+        ("to", timestamp_type),
+        ("region", label_type),
+        ("postcode", label_type),
+        ("source", label_type),
+        ("regionid", label_type),
+        ("dnoregion", label_type),
+        ("shortname", label_type),
+        ("source_postcode", label_type),
+        ("intensity_forecast", pa.float64()),
+        ("intensity_index", label_type),
+        ("intensity_actual", pa.float64()),
+        *[(col, pa.float64()) for col in generationmix_cols],
+    ]
+)
+# Smaller in-memory types where they are lossless enough: intensities are whole g/kWh and
+# generation shares have one decimal. Prices (decimal pennies) stay float64.
+co2_memory_types = {
+    col: "float32"
+    for col in ["intensity_forecast", "intensity_actual", *generationmix_cols]
+}
+price_memory_types = {}
+# CO2 columns get_c02 takes from the slot containing the start of each interval (the
+# intensities and generation mix are time-weighted), from/to renamed as from_ci/to_ci
+co2_carry_cols = [
+    "from",
+    "to",
+    "created",
+    "source",
+    "regionid",
+    "dnoregion",
+    "shortname",
+    "source_postcode",
+    "intensity_index",
+]
+co2_carried_names = {"from": "from_ci", "to": "to_ci"}
+price_schema = pa.schema(
+    [
+        ("id", pa.string()),
+        ("created", pa.int64()),
+        ("region", label_type),
+        ("voltageLevel", label_type),
+        ("from", timestamp_type),
+        ("to", timestamp_type),
+        ("voltage", label_type),
+        ("dnoRegion", label_type),
+        ("pennies_per_kwh", pa.float64()),
+    ]
+)
 region_map = {  # Used for CO2 intensity data
     "North Scotland": 1,
     "South Scotland": 2,
@@ -88,66 +179,359 @@ voltage_level_enums = {  # Used for energy price data
 
 ci_base_url = "https://api.carbonintensity.org.uk"
 
+# Time covered by each source, data outside is never requested (see fill_cache_gaps)
+price_dataset_start = pd.Timestamp("2017-04-01", tz="UTC")
+price_dataset_end = pd.Timestamp("2025-04-01", tz="UTC")  # Last day: 31-03-2025
+co2_dataset_start = pd.Timestamp("2017-09-26", tz="UTC")  # National
+co2_regional_dataset_start = pd.Timestamp("2018-05-10", tz="UTC")  # Regions, postcodes
+co2_forecast_horizon = timedelta(days=2)  # Forecasts are published up to 48h ahead
+co2_forecast_ttl = timedelta(minutes=30)  # Forecasts are revised every half hour
+
 ci_headers = {"Accept": "application/json"}
 
 
-class UKGridConnection:
+def to_cache_table(data: pd.DataFrame, schema: pa.Schema) -> pa.Table:
+    """Casts cache data into the typed cache schema.
+
+    Accepts both freshly fetched data and data written with the legacy schema (where every
+    column was stored as a string, e.g. "None"/"NA" for missing values).
+
+    Args:
+        data (pandas.DataFrame): Cache data with (at least) the columns of the schema
+        schema (pyarrow.Schema): Target schema (co2_schema or price_schema)
+
+    Returns:
+        pyarrow.Table: Data in the cache schema
     """
-    This class models the connection to the grid in the UK.
+    if "generationmix" in data.columns and generationmix_cols[0] in schema.names:
+        # Legacy generation mix: JSON text [{"fuel":, "perc":}, ...] -> one column per fuel
+        mix = data["generationmix"].map(generation_mix_from_json).tolist()
+        data = data.assign(**pd.DataFrame(mix, index=data.index, columns=fuel_types))
+        data = data.rename(columns=dict(zip(fuel_types, generationmix_cols)))
+    data = data[schema.names].copy()
+    for field in schema:
+        col = data[field.name]
+        is_text = not pd.api.types.is_numeric_dtype(col)
+        if pa.types.is_timestamp(field.type):
+            data[field.name] = pd.to_datetime(col, utc=True)
+        elif pa.types.is_floating(field.type):
+            data[field.name] = col.map(to_float) if is_text else col
+            data[field.name] = data[field.name].astype("float64")
+        elif pa.types.is_integer(field.type):
+            data[field.name] = (col.map(to_int) if is_text else col).astype("int64")
+        elif not isinstance(col.dtype, pd.CategoricalDtype):
+            data[field.name] = col.astype(str)
+    return pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+
+
+def generation_mix_from_json(text) -> dict:
+    """{fuel: perc} of a legacy JSON generation mix (empty if missing or invalid)."""
+    try:
+        return {item["fuel"]: item["perc"] for item in json.loads(text)}
+    except (TypeError, ValueError, KeyError):
+        return {}
+
+
+def label_array(label, length: int) -> pa.DictionaryArray:
+    """Dictionary encoded column repeating a single label."""
+    return pa.DictionaryArray.from_arrays(
+        pa.array(np.zeros(length, dtype="int32")), pa.array([str(label)])
+    )
+
+
+def id_array(prefix: str, from_time: pa.Array) -> pa.Array:
+    """Cache ids: PREFIX_<unix timestamp of from>, e.g. NORTH_SCOTLAND_LV_1577836800"""
+    seconds = pc.divide(from_time.cast(pa.int64()), 10**6)  # timestamp[us] -> s
+    prefix = prefix.replace(" ", "_").upper()
+    return pc.binary_join_element_wise(prefix, seconds.cast(pa.string()), "")
+
+
+def price_table_from_json(json_data: dict, region, voltage, created: int) -> pa.Table:
+    """Builds the price cache table straight from the JSON response of the price API with
+    column operations (no row-wise Python processing).
+
+    Args:
+        json_data (dict): {"data": {"dnoRegion":, "voltageLevel":, "data": [{"Overall":, "unixTimestamp":, "Timestamp":}]}}
+        region (str): Region requested
+        voltage (str): Voltage requested
+        created (int): Fetch time in ns
+
+    Returns:
+        pyarrow.Table: Data in the cache schema (price_schema)
+    """
+    rows = pa.Table.from_pylist(json_data["data"]["data"])
+    n = rows.num_rows
+    if n == 0:
+        return price_schema.empty_table()
+    if "unixTimestamp" in rows.column_names:
+        from_time = pc.multiply(
+            rows["unixTimestamp"].combine_chunks().cast(pa.int64()), 10**6
+        ).cast(timestamp_type)
+    else:
+        from_time = pc.strptime(
+            rows["Timestamp"].combine_chunks(), format="%H:%M %d-%m-%Y", unit="us"
+        ).cast(timestamp_type)
+    voltage_level = json_data["data"]["voltageLevel"]
+    region = region if region else "NA"
+    columns = {
+        "id": id_array(f"{region}_{voltage_level}_", from_time),
+        "created": pa.array(np.full(n, created, dtype="int64")),
+        "region": label_array(region, n),
+        "voltageLevel": label_array(voltage_level, n),
+        "from": from_time,
+        "to": pc.add(from_time, pa.scalar(30 * 60 * 10**6, pa.duration("us"))),
+        "voltage": label_array(voltage if voltage else "NA", n),
+        "dnoRegion": label_array(json_data["data"]["dnoRegion"], n),
+        "pennies_per_kwh": rows["Overall"].combine_chunks().cast(pa.float64()),
+    }
+    return pa.Table.from_pydict(columns, schema=price_schema)
+
+
+def co2_table_from_json(
+    json_data: dict, region: str, postcode: str, created: int
+) -> pa.Table:
+    """Builds the CO2 cache table straight from the JSON response of the CarbonIntensity API
+    with column operations (no row-wise Python processing).
+
+    Args:
+        json_data (dict): {"data": [slots]} (national) or {"data": {"regionid":, ..., "data": [slots]}}
+            with slots {"from":, "to":, "intensity": {"forecast":, "actual":, "index":}, "generationmix": [{"fuel":, "perc":}]}
+        region (str): Region requested (None if not requested)
+        postcode (str): Postcode requested (None if not requested)
+        created (int): Fetch time in ns
+
+    Returns:
+        pyarrow.Table: Data in the cache schema (co2_schema)
+    """
+    # Regional requests have metadata (region id, names...) around the slots
+    metadata = json_data["data"] if isinstance(json_data["data"], dict) else {}
+    slots = pa.Table.from_pylist(metadata["data"] if metadata else json_data["data"])
+    n = slots.num_rows
+    if n == 0:
+        return co2_schema.empty_table()
+    from_time, to_time = [
+        pc.strptime(
+            slots[col].combine_chunks(), format="%Y-%m-%dT%H:%MZ", unit="us"
+        ).cast(timestamp_type)
+        for col in ("from", "to")
+    ]
+    intensity = slots["intensity"].combine_chunks()
+
+    def intensity_field(name):
+        if intensity.type.get_field_index(name) < 0:
+            return pa.nulls(n, pa.float64())
+        return intensity.field(name).cast(pa.float64())
+
+    # [{"fuel": "gas", "perc": 8.3}, ...] per slot -> one column per fuel (NaN if missing)
+    mix = {col: np.full(n, np.nan) for col in generationmix_cols}
+    if "generationmix" in slots.column_names:
+        shares = slots["generationmix"].combine_chunks()
+        slot_of_share = pc.list_parent_indices(shares).to_numpy()
+        shares = shares.flatten()
+        fuel = shares.field("fuel").to_numpy(zero_copy_only=False)
+        perc = shares.field("perc").cast(pa.float64()).to_numpy(zero_copy_only=False)
+        for fuel_type, col in zip(fuel_types, generationmix_cols):
+            is_fuel = fuel == fuel_type
+            mix[col][slot_of_share[is_fuel]] = perc[is_fuel]
+
+    region = region if region else "NA"
+    postcode = postcode if postcode else "NA"
+    columns = {
+        "id": id_array(f"{region}_{postcode}_", from_time),
+        "created": pa.array(np.full(n, created, dtype="int64")),
+        "from": from_time,
+        "to": to_time,
+        "region": label_array(region, n),
+        "postcode": label_array(postcode, n),
+        "source": label_array("CarbonIntensity", n),
+        "regionid": label_array(metadata.get("regionid", "NA"), n),
+        "dnoregion": label_array(metadata.get("dnoregion", "NA"), n),
+        "shortname": label_array(metadata.get("shortname", "NA"), n),
+        "source_postcode": label_array(metadata.get("postcode", "NA"), n),
+        "intensity_forecast": intensity_field("forecast"),
+        "intensity_index": pc.dictionary_encode(intensity.field("index")).cast(
+            label_type
+        ),
+        "intensity_actual": intensity_field("actual"),
+        **{col: pa.array(values) for col, values in mix.items()},
+    }
+    return pa.Table.from_pydict(columns, schema=co2_schema)
+
+
+def memory_frame(
+    data: pd.DataFrame, codes: SeriesCodes, series_cols: list, types: dict
+) -> pd.DataFrame:
     """
+    Compact in-memory layout of cache data: the string id is replaced by an int64 "key"
+    (series code + unix time of from, see row_keys), labels stay categorical and values use
+    the smaller types given ({column: dtype}, e.g. float32 where that is lossless enough).
+    Data already in this layout is returned as is.
+    """
+    if "key" in data.columns:
+        return data
+    data = data.copy(deep=False)  # Columns are replaced, never written into
+    if "id" in data.columns:
+        del data["id"]
+    for col, dtype in types.items():
+        if data[col].dtype != dtype:
+            data[col] = data[col].astype(dtype)
+    data.insert(0, "key", row_keys(codes.encode(data, series_cols), data["from"]))
+    return data
 
-    def consolidate_cache(self, keep_latest: bool = False, clear_rest: bool = True):
-        # It groups all the caches into a single consolidated file. (that can be committed in git)
-        # This is more memory efficient than several files
 
-        # Extract all the data from cache
-        logging.info("Consolidating Cache")
-        consolidated_cache_co2 = pd.read_parquet(self.co2_cache_path)
-        consolidated_cache_price = pd.read_parquet(self.price_cache_path)
+def profile_ranges(keys, key_cols: list) -> pd.DataFrame:
+    """Time range of every series over normalized queries (see UKGridConnection.price_keys).
 
-        if keep_latest:
-            co2_latest_data = (
-                consolidated_cache_co2.groupby("id")["created"].rank(
-                    "first", ascending=False
-                )
-                == 1
-            )
-            consolidated_cache_co2 = consolidated_cache_co2.loc[co2_latest_data, :]
-            price_latest_data = (
-                consolidated_cache_price.groupby("id")["created"].rank(
-                    "first", ascending=False
+    Args:
+        keys: Iterable of normalized queries (pandas.DataFrame with from_utc and to_utc)
+        key_cols (list): Columns identifying a series
+
+    Returns:
+        pandas.DataFrame: Index: series keys, columns: from_time, to_time
+    """
+    ranges = [
+        chunk.groupby(key_cols, sort=False).agg(
+            from_time=("from_utc", "min"), to_time=("to_utc", "max")
+        )
+        for chunk in keys
+    ]
+    if len(ranges) <= 1:
+        return ranges[0] if ranges else pd.DataFrame(columns=["from_time", "to_time"])
+    return (
+        pd.concat(ranges)
+        .groupby(level=list(range(len(key_cols))), sort=False)
+        .agg(from_time=("from_time", "min"), to_time=("to_time", "max"))
+    )
+
+
+def with_columns(df: pd.DataFrame, result: dict) -> pd.DataFrame:
+    """Copy of df with the columns of a query result ({column: array}) added."""
+    out = df.copy()
+    for col, values in result.items():
+        out[col] = values.copy()  # The result may be cached, it stays untouched
+    return out
+
+
+def write_chunks(chunks, path: Path) -> int:
+    """Writes DataFrame chunks (e.g. from UKGridConnection.stream_price) into a single
+    Parquet file, holding one chunk in memory at a time.
+
+    Returns:
+        int: Rows written
+    """
+    rows = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            if writer is None:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                writer = pq.ParquetWriter(path, table.schema)
+            else:
+                table = pa.Table.from_pandas(
+                    chunk, schema=writer.schema, preserve_index=False
                 )
-                == 1
-            )
-            consolidated_cache_price = consolidated_cache_price.loc[
-                price_latest_data, :
-            ]
-            assert len(consolidated_cache_price.id.unique()) == len(
-                consolidated_cache_price
-            )
-            assert len(consolidated_cache_co2.id.unique()) == len(
-                consolidated_cache_co2
-            )
+            writer.write_table(table)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
 
-        # Sort by id (region-voltage-timestamp)
-        consolidated_cache_co2.sort_values(by="id", inplace=True)
-        consolidated_cache_price.sort_values(by="id", inplace=True)
 
-        # Reset index
-        consolidated_cache_co2.reset_index(drop=True, inplace=True)
-        consolidated_cache_price.reset_index(drop=True, inplace=True)
+class UKGridConnection:
+    """
+    This class models the connection to the grid in the UK.
+    """
 
-        # Store all
-        consolidated_cache_co2.to_parquet(
-            self.co2_cache_path / ("Consolidated_CO2_Cache.parquet.snappy"),
-            engine="pyarrow",
-            compression="snappy",
-        )
-        consolidated_cache_price.to_parquet(
-            self.price_cache_path / ("Consolidated_Price_Cache.parquet.snappy"),
-            engine="pyarrow",
-            compression="snappy",
-        )
+    def consolidate_cache(self, keep_latest: bool = True, clear_rest: bool = True):
+        """Compacts the whole local storage (see compact_cache). The latest fetch of every id
+        is always kept; the absorbed files are removed unless clear_rest is False."""
+        return self.compact_cache(remove_inputs=clear_rest)
+
+    def compact_cache(self, remove_inputs: bool = True) -> dict:
+        """
+        Incremental compaction of the local storage: the small per-fetch files of every
+        partition are merged into its consolidated file (see PartitionedCache.compact).
+        Partitions without new files are not touched and the in-memory caches are not used,
+        so it can run while queries are served (see start_compaction).
+
+        If hot_cache is enabled, the hot cache files of the caches that changed are
+        rewritten afterwards (see load_hot_cache).
+
+        Returns:
+            dict: Partitions compacted and files absorbed per cache
+        """
+        stats = {}
+        for name, store in (("co2", self.co2_store), ("price", self.price_store)):
+            with self.metrics.timer("compaction", cache=name):
+                stats[name] = store.compact(remove_inputs)
+                if self.hot_cache and (
+                    stats[name]["files"] or not store.hot_path.exists()
+                ):
+                    store.write_hot()
+            self.metrics.count("files_compacted", stats[name]["files"], cache=name)
+        return stats
+
+    def start_compaction(self, interval: float = 600):
+        """Runs compact_cache every interval seconds in a background thread until
+        stop_compaction is called."""
+        self.stop_compaction()
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.compact_cache()
+                except Exception:
+                    logging.exception("Background compaction failed")
+
+        self._compaction = (stop, threading.Thread(target=run, daemon=True))
+        self._compaction[1].start()
+
+    def stop_compaction(self):
+        """Stops the background compaction (waits for a running compaction to finish)."""
+        if self._compaction is not None:
+            stop, thread = self._compaction
+            stop.set()
+            thread.join()
+            self._compaction = None
+
+    def migrate_cache(self):
+        """
+        One-time migrations of the local storage:
+        - Flat cache folders are moved into the partitioned datasets (see PartitionedCache).
+          Each flat file is removed once its data is stored in the partitions (under the
+          same file name).
+        - Files written with an older schema (the legacy all-string schema, or the JSON
+          generation mix) are cast into the cache schema (co2_schema / price_schema).
+        The schema of the partitions is only checked until the .schema marker of the
+        dataset records the current schema, and stale hot cache files are removed.
+        """
+        for store in (self.co2_store, self.price_store):
+            flat_files = sorted(store.path.glob("*.parquet.snappy"))
+            if not flat_files and store.schema_is_current():
+                continue
+            with FileLock(store.path / ".locks" / "migrate.lock"):  # One process
+                for file in sorted(store.path.glob("*.parquet.snappy")):
+                    logging.info(f"Migrating {file.name} to the partitioned cache")
+                    store.write(self.read_migrated(file, store.schema), name=file.name)
+                    file.unlink()
+                if store.schema_is_current():
+                    continue
+                for file in store.files():
+                    if not pq.read_schema(file).remove_metadata().equals(store.schema):
+                        logging.info(f"Migrating {file} to the current cache schema")
+                        write_cache_file(self.read_migrated(file, store.schema), file)
+                store.hot_path.unlink(missing_ok=True)
+                store.mark_schema_current()
+
+    @staticmethod
+    def read_migrated(file: Path, schema: pa.Schema) -> pa.Table:
+        """Reads a cache file, casting it into schema if it was written with another one."""
+        table = pq.read_table(file)
+        if table.schema.remove_metadata().equals(schema):
+            return table
+        return to_cache_table(table.to_pandas(), schema)
 
     # def fill_price_cache_gaps(self,region = None,voltage_level=None):
     #   TODO: Make function that inspects the data in the cache and fills data gaps
@@ -159,14 +543,16 @@ class UKGridConnection:
     def refresh_price_cache(self, keep_latest: bool = True):
         """
         Checks in local storage for data and refresh the cache in memory.
-        Cache columns
-        region_price_cache:
-        id            - string
-        created       - timestamp
-        date          - timestamp
-        region        - string
-        voltage_level - string
-        price_per_kwh - float (Pounds)
+        Cache columns (see price_schema and memory_frame)
+        key             - int64 ((region, voltage) code + unix time of from)
+        created         - int64 (fetch time in ns)
+        region          - categorical
+        voltageLevel    - categorical
+        from            - timestamp (UTC)
+        to              - timestamp (UTC)
+        voltage         - categorical
+        dnoRegion       - categorical
+        pennies_per_kwh - float (Pennies)
 
         (Ideally if implemented for database management the following columns would be ideal
         updated       - timestamp
@@ -174,38 +560,32 @@ class UKGridConnection:
         )
         """
         logging.info("Refresing Price Cache...")
-        self.price_cache = pd.read_parquet(self.price_cache_path)
-        if len(self.price_cache) == 0:
-            self.price_cache = pd.DataFrame(columns=price_data_cols)
-            return
-        if keep_latest:
-            price_latest_data = (
-                self.price_cache.groupby("id")["created"].rank("first", ascending=False)
-                == 1
-            )
-            self.price_cache = self.price_cache.loc[price_latest_data, :]
-            assert len(self.price_cache.id.unique()) == len(self.price_cache)
-        self.price_cache["pennies_per_kwh"] = self.price_cache.pennies_per_kwh.map(
-            to_float
-        )
-        self.price_cache["from"] = pd.to_datetime(self.price_cache["from"], utc=True)
-        self.price_cache["to"] = pd.to_datetime(self.price_cache["to"], utc=True)
-        self.price_cache["created"] = self.price_cache.created.map(to_int)
-        self.price_cache.sort_values(by="id", inplace=True)
-        self.price_cache.reset_index(drop=True, inplace=True)
+        with self.metrics.timer("refresh", cache="price"):
+            data = self.price_frame(self.price_store.read().to_pandas())
+            if keep_latest:
+                latest = latest_positions(data.key.values, data.created.values)
+                data = data.iloc[latest]
+            else:
+                data = data.sort_values("key", kind="stable")
+        with self.price_lock:
+            self.price_cache = data.reset_index(drop=True)
+            self.price_index.invalidate()
+            self.price_results.invalidate()
+            self.price_cache_loaded = True
 
     def refresh_co2_cache(self, keep_latest: bool = True):
         """
         Checks in local storage for data and refresh the cache in memory.
 
-        Cache columns
-        region_price_cache:
-        id              - string
-        created         - timestamp
-        from            - timestamp
-        to              - timestamp
-        region          - string
-        co2_g_per_kwh   - float [g/kWh]
+        Cache columns (see co2_schema and memory_frame)
+        key                 - int64 ((region, postcode) code + unix time of from)
+        created             - int64 (fetch time in ns)
+        from                - timestamp (UTC)
+        to                  - timestamp (UTC)
+        region / postcode   - categorical
+        intensity_forecast  - float32 [g/kWh]
+        intensity_actual    - float32 [g/kWh]
+        generationmix_*     - float32 [% of generation] per fuel (see fuel_types)
 
         (Ideally if implemented for database management the following columns would be ideal
         updated       - timestamp
@@ -213,41 +593,248 @@ class UKGridConnection:
         )
         """
         logging.info("Refresing CO2 Cache...")
-        self.co2_cache = pd.read_parquet(self.co2_cache_path)
-        if keep_latest:
-            co2_latest_data = (
-                self.co2_cache.groupby("id")["created"].rank("first", ascending=False)
-                == 1
-            )
-            self.co2_cache = self.co2_cache.loc[co2_latest_data, :]
-            assert len(self.co2_cache.id.unique()) == len(self.co2_cache)
-
-        # Data is stored as text, transform into right format
-        self.co2_cache["generationmix"] = self.co2_cache.generationmix.apply(
-            lambda x: json.loads(x)
-        )
-        self.co2_cache["intensity_actual"] = self.co2_cache.intensity_actual.map(
-            to_float
+        with self.metrics.timer("refresh", cache="co2"):
+            data = self.co2_frame(self.co2_store.read().to_pandas())
+            if keep_latest:
+                latest = latest_positions(data.key.values, data.created.values)
+                data = data.iloc[latest]
+            else:
+                data = data.sort_values("key", kind="stable")
+        with self.co2_lock:
+            self.co2_cache = data.reset_index(drop=True)
+            self.co2_index.invalidate()
+            self.co2_results.invalidate()
+            self.co2_cache_loaded = True
+
+    def price_frame(self, data: pd.DataFrame) -> pd.DataFrame:
+        """In-memory layout of price data (see memory_frame)."""
+        return memory_frame(
+            data, self.price_codes, ["region", "voltage"], price_memory_types
         )
-        self.co2_cache["intensity_forecast"] = self.co2_cache.intensity_forecast.map(
-            to_float
+
+    def co2_frame(self, data: pd.DataFrame) -> pd.DataFrame:
+        """In-memory layout of CO2 data (see memory_frame)."""
+        return memory_frame(
+            data, self.co2_codes, ["region", "postcode"], co2_memory_types
         )
-        self.co2_cache["created"] = self.co2_cache.created.map(to_int)
-        self.co2_cache["from"] = pd.to_datetime(self.co2_cache["from"], utc=True)
-        self.co2_cache["to"] = pd.to_datetime(self.co2_cache["to"], utc=True)
-        self.co2_cache.sort_values(by="id", inplace=True)
-        self.co2_cache.reset_index(drop=True, inplace=True)
 
-    def __init__(self):
+    def load_hot_cache(self) -> bool:
+        """
+        Loads both caches from their hot cache files (written by compact_cache when
+        hot_cache is enabled). A hot cache file older than the files written since its
+        snapshot is rewritten first, so a single fetch does not leave every new process
+        with a private copy of the history; only files written meanwhile are merged.
+
+        The files are memory-mapped read-only and the numeric and timestamp columns are
+        used by pandas without copying, so startup does not decode Parquet and the
+        physical memory of those columns is shared by every process through the page cache.
+
+        Returns:
+            bool: False (nothing loaded) if a hot cache file is missing
+        """
+        hot_co2 = self.co2_store.read_hot(refresh=True)
+        hot_price = self.price_store.read_hot(refresh=True)
+        if hot_co2 is None or hot_price is None:
+            return False
+        logging.info("Mapping hot caches...")
+        co2_cache = self.co2_frame(hot_co2[0].to_pandas(split_blocks=True))
+        with self.co2_lock:
+            self.co2_cache = co2_cache
+            self.co2_index.invalidate()
+            self.co2_results.invalidate()
+            self.co2_cache_loaded = True
+        price_cache = self.price_frame(hot_price[0].to_pandas(split_blocks=True))
+        with self.price_lock:
+            self.price_cache = price_cache
+            self.price_index.invalidate()
+            self.price_results.invalidate()
+            self.price_cache_loaded = True
+        if hot_co2[1].num_rows:
+            self.merge_co2_cache(hot_co2[1].to_pandas())
+        if hot_price[1].num_rows:
+            self.merge_price_cache(hot_price[1].to_pandas())
+        return True
+
+    def load_price_series(
+        self, region: str, voltage: str, from_time=None, to_time=None
+    ):
+        """
+        Lazy loading: reads the cached prices of a single (region, voltage) series from local
+        storage the first time it is used. Only the partitions of the series (and of the
+        months overlapping from_time-to_time if given) are read. No-op if they (or the whole
+        cache) are already in memory.
+        """
+        with self.price_lock:
+            if self.price_cache_loaded:
+                return
+            self.load_partitions(
+                self.price_store,
+                (region, voltage),
+                from_time,
+                to_time,
+                self.loaded_price_series,
+                self.merge_price_cache,
+            )
+
+    def load_co2_series(
+        self, region: str = "NA", postcode: str = "NA", from_time=None, to_time=None
+    ):
+        """
+        Lazy loading: reads the cached CO2 intensities of a single region/postcode from local
+        storage the first time it is used (see load_price_series).
+        """
+        with self.co2_lock:
+            if self.co2_cache_loaded:
+                return
+            self.load_partitions(
+                self.co2_store,
+                (region, postcode),
+                from_time,
+                to_time,
+                self.loaded_co2_series,
+                self.merge_co2_cache,
+            )
+
+    @staticmethod
+    def load_partitions(store, key: tuple, from_time, to_time, loaded: set, merge):
+        """Reads the partitions of a series not loaded yet and merges them into the cache.
+
+        loaded holds the series read entirely (key) and the months read ((*key, month)).
+        """
+        if key in loaded:
+            return
+        months = None
+        if from_time is not None:
+            months = [
+                month
+                for month in months_between(from_time, to_time)
+                if (*key, month) not in loaded
+            ]
+            if not months:
+                return
+        logging.info(f"Loading {store.prefix} cache for {key} {months or ''}...")
+        data = store.read(dict(zip(store.partition_cols, key)), months)
+        merge(data.to_pandas())
+        loaded.update([key] if months is None else [(*key, m) for m in months])
+
+    def merge_price_cache(self, data: pd.DataFrame):
+        """Merges freshly fetched price data (see price_api_request) into the in-memory cache
+        without reloading the cache from local storage."""
+        with self.metrics.timer("merge", cache="price"):
+            data = self.price_frame(data)
+            with self.price_lock:
+                series = self.price_rows.merge(data)
+                self.price_results.invalidate(series)
+
+    def merge_co2_cache(self, data: pd.DataFrame):
+        """Merges freshly fetched CO2 data (see intensity_api_request) into the in-memory cache
+        without reloading the cache from local storage."""
+        with self.metrics.timer("merge", cache="co2"):
+            data = self.co2_frame(data)
+            with self.co2_lock:
+                series = self.co2_rows.merge(data)
+                self.co2_results.invalidate(series)
+
+    @property
+    def price_cache(self) -> pd.DataFrame:
+        """In-memory price cache (see refresh_price_cache), with the rows merged since it
+        was last read (see LatestRows)."""
+        with self.price_lock:
+            return self.price_rows.frame()
+
+    @price_cache.setter
+    def price_cache(self, data: pd.DataFrame):
+        with self.price_lock:
+            self.price_rows = LatestRows(data, self.price_index)
+
+    @property
+    def co2_cache(self) -> pd.DataFrame:
+        """In-memory CO2 cache (see refresh_co2_cache), with the rows merged since it was
+        last read (see LatestRows)."""
+        with self.co2_lock:
+            return self.co2_rows.frame()
+
+    @co2_cache.setter
+    def co2_cache(self, data: pd.DataFrame):
+        with self.co2_lock:
+            self.co2_rows = LatestRows(data, self.co2_index)
+
+    def fetch_concurrently(self, fetch, items: list) -> list:
+        """Calls fetch on every item using a pool of at most max_workers threads.
+
+        Returns:
+            list: Results in the same order as items
+        """
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [fetch(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as pool:
+            return list(pool.map(fetch, items))
+
+    def api_get(self, url: str, cache: str) -> dict:
+        """Decoded JSON response of an API request through the transport. The HTTP
+        transport labels its api_bytes/api_retries counters with the cache, other
+        transports only get the plain get_json(url, headers) call."""
+        if isinstance(self.transport, HTTPTransport):
+            return self.transport.get_json(
+                url, headers=ci_headers, labels={"cache": cache}
+            )
+        return self.transport.get_json(url, headers=ci_headers)
+
+    def stats(self) -> dict:
+        """Snapshot of the stage timers and counters (see Metrics.stats) and of the query
+        result caches (see QueryCache.stats)."""
+        return {
+            **self.metrics.stats(),
+            "query_cache": {
+                "price": self.price_results.stats(),
+                "co2": self.co2_results.stats(),
+            },
+        }
+
+    def __init__(
+        self,
+        cache_path: Path = Path("/root/project/data/.GridConnection_cache/"),
+        lazy: bool = False,
+        max_workers: int = 4,
+        requests_per_second: float = 5,
+        transport=None,
+        hot_cache: bool = False,
+        query_cache_bytes: int = 64 * 2**20,
+        metrics: Metrics = None,
+        unavailable_ttl: timedelta = timedelta(hours=6),
+    ):
+        """
+        Args:
+            cache_path (Path): Root folder of the local storage cache
+            lazy (bool): If True the caches are not loaded upfront, each (region, voltage) or
+                region/postcode series is read from local storage on first use.
+            max_workers (int): Maximum number of concurrent API requests
+            requests_per_second (float): Maximum API request rate (None for no limit)
+            transport: Object making the API requests (see src/transport.py), defaults to a
+                pooled HTTPTransport. A FakeGridTransport or ReplayTransport runs offline.
+            hot_cache (bool): If True the caches are loaded from the memory-mapped hot cache
+                files when available (see load_hot_cache), and compact_cache rewrites them.
+            query_cache_bytes (int): Memory budget of the results of repeated get_price and
+                get_c02 queries (see QueryCache), 0 disables it.
+            metrics (Metrics): Stage timers and counters (see stats), e.g. shared by several
+                connections. A new Metrics by default.
+            unavailable_ttl (timedelta): Time ranges the APIs did not return are not
+                requested again (see UnavailableRanges)
+        """
         self.max_power: float
+        self.metrics: Metrics = metrics if metrics is not None else Metrics()
+        self.hot_cache: bool = hot_cache
         self.use_cache: float = True
-        # , price_data : pd.DataFrame = None, co2_intesity_data : pd.DataFrame = None
-        self.co2_cache_path: Path = Path(
-            "/root/project/data/.GridConnection_cache/co2/"
-        )
-        self.price_cache_path: Path = Path(
-            "/root/project/data/.GridConnection_cache/price/"
+        self.max_workers: int = max_workers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.transport = (
+            transport
+            if transport
+            else HTTPTransport(pool_maxsize=max(max_workers, 1), metrics=self.metrics)
         )
+        # , price_data : pd.DataFrame = None, co2_intesity_data : pd.DataFrame = None
+        self.co2_cache_path: Path = Path(cache_path) / "co2"
+        self.price_cache_path: Path = Path(cache_path) / "price"
         self.co2_cache_path.mkdir(
             parents=True, exist_ok=True
         )  # Create Path if doesn't exist
@@ -255,10 +842,54 @@ class UKGridConnection:
             parents=True, exist_ok=True
         )  # Create Path if doesn't exist
 
-        self.co2_cache: pd.DataFrame = pd.DataFrame()
-        self.price_cache: pd.DataFrame = pd.DataFrame()
-        self.refresh_co2_cache()  # Load Data
-        self.refresh_price_cache()  # Load Data
+        self.co2_store = PartitionedCache(
+            self.co2_cache_path,
+            co2_schema,
+            ["region", "postcode"],
+            "CO2",
+            "Consolidated_CO2_Cache.parquet.snappy",
+            co2_memory_types,
+        )
+        self.price_store = PartitionedCache(
+            self.price_cache_path,
+            price_schema,
+            ["region", "voltage"],
+            "price",
+            "Consolidated_Price_Cache.parquet.snappy",
+            price_memory_types,
+        )
+        self._compaction = None  # (stop event, thread) of the background compaction
+        # Negative caches: ranges the APIs did not return (shared through local storage)
+        self.co2_unavailable = UnavailableRanges(
+            self.co2_cache_path / ".unavailable.json", unavailable_ttl
+        )
+        self.price_unavailable = UnavailableRanges(
+            self.price_cache_path / ".unavailable.json", unavailable_ttl
+        )
+        self.co2_codes = SeriesCodes()  # (region, postcode) codes of the row keys
+        self.price_codes = SeriesCodes()  # (region, voltage) codes of the row keys
+        # Held while an in-memory cache (and its index) is read or replaced, so queries
+        # can run from several threads (see AsyncUKGridConnection)
+        self.co2_lock = threading.RLock()
+        self.price_lock = threading.RLock()
+        self.co2_index = SeriesIndex(["region", "postcode"])  # Sorted time index
+        self.price_index = SeriesIndex(["region", "voltage"])  # Sorted time index
+        self.co2_cache = self.co2_frame(co2_schema.empty_table().to_pandas())
+        self.price_cache = self.price_frame(price_schema.empty_table().to_pandas())
+        # Results of repeated queries, dropped when their series are updated
+        self.co2_results = QueryCache(query_cache_bytes)
+        self.price_results = QueryCache(query_cache_bytes)
+        self.co2_cache_loaded: bool = False  # True once the whole cache is in memory
+        self.price_cache_loaded: bool = False
+        # Series/months loaded in lazy mode (see load_partitions)
+        self.loaded_co2_series: set = set()
+        self.loaded_price_series: set = set()
+        self.migrate_cache()  # Flat (legacy) files -> partitioned datasets
+        if hot_cache and self.load_hot_cache():
+            pass  # Whole history mapped from the hot cache files
+        elif not lazy:
+            self.refresh_co2_cache()  # Load Data
+            self.refresh_price_cache()  # Load Data
 
     def get_price(self, df):
         """Get total estimated energy costs given an energy profile
@@ -266,104 +897,427 @@ class UKGridConnection:
             df columns:
                 - from
                 - to
-                - region (Optional)
-                - postcode (Optional)
+                - region
+                - voltage_level
                 - average_power (Optional)
 
         Args:
-            df (pandas.DataFrame): DataFrame with profile
+            df (pandas.DataFrame): DataFrame with profile (left unchanged)
+
+        Returns:
+            pandas.DataFrame: Copy of df with pennies_per_kwh (and total_cost_pennies if
+                average_power is given)
+        """
+        with self.metrics.timer("get_price"):
+            keys = self.price_keys(df)
+            query = query_key(keys)
+            result = self.price_results.get(query)
+            self.metrics.count(
+                "query_cache_misses" if result is None else "query_cache_hits",
+                cache="price",
+            )
+            if result is None:
+                series_ranges = profile_ranges([keys], ["region", "voltage"])
+                logging.info(f"Extractiong for {list(series_ranges.index)}")
+                unavailable = self.fill_price_gaps(series_ranges)
+                versions = self.price_results.versions(series_ranges.index)
+                result = self.price_values(keys)
+                if not unavailable:
+                    self.price_results.put(query, result, versions)
+            return with_columns(df, result)
+
+    @staticmethod
+    def price_keys(df: pd.DataFrame) -> pd.DataFrame:
+        """Normalized price query of a profile: region, voltage, from_utc, to_utc (and
+        average_power if given), indexed like df."""
+        keys = pd.DataFrame(
+            {
+                "region": df["region"],
+                "voltage": df["voltage_level"],
+                "from_utc": pd.to_datetime(df["from"], utc=True),  # Enforce UTC
+                "to_utc": pd.to_datetime(df["to"], utc=True),  # Enforce UTC
+            },
+            index=df.index,
+        )
+        if "average_power" in df.columns:
+            keys["average_power"] = df["average_power"]
+        return keys
 
-        Raises:
-            Exception: _description_
+    def price_values(self, keys: pd.DataFrame) -> dict:
+        """Price columns of a normalized query (see price_keys) from the in-memory cache.
 
         Returns:
-            pandas.DataFrame:  DataFrame with energy costs
-        """
-        if not "from_utc" in df.columns:
-            df["from_utc"] = pd.to_datetime(df["from"], utc=True)  # Enforce UTC
-        if not "to_utc" in df.columns:
-            df["to_utc"] = pd.to_datetime(df["to"], utc=True)  # Enforce UTC
-        region = list(df.region.unique())
-        voltage_level = list(df.voltage_level.unique())
-        logging.info(f"Extractiong for {region}-{voltage_level}")
-        region_voltage_combinations = (
-            df[["region", "voltage_level"]].drop_duplicates().reset_index(drop=True)
+            dict: {"pennies_per_kwh": array} (plus "total_cost_pennies" if average_power)
+        """
+        # Time-weighted price over each interval of the profile, all series at once
+        with self.price_lock, self.metrics.timer("interval_join", cache="price"):
+            prices = self.interval_join(
+                keys,
+                ["region", "voltage"],
+                self.price_index,
+                self.price_cache,
+                ["pennies_per_kwh"],
+            )["pennies_per_kwh"].values
+        result = {"pennies_per_kwh": prices}
+        if "average_power" in keys.columns:
+            hours = (keys["to_utc"] - keys["from_utc"]).dt.total_seconds() / 3600
+            result["total_cost_pennies"] = (
+                keys["average_power"].values * prices * hours.values
+            )
+        return result
+
+    def stream_price(self, profile, batch_size: int = 100_000):
+        """Streaming get_price for profiles too large to hold in memory.
+
+        If profile is a Parquet file, its series and time ranges are read first (only the
+        key columns), the missing data is fetched once over the combined range of every
+        series, then the file is enriched batch by batch. An iterable of DataFrames is
+        enriched chunk by chunk, each chunk only fetching what earlier chunks did not.
+        Results are not memoized (see QueryCache). See write_chunks to store the output.
+
+        Args:
+            profile: Path of a Parquet file or iterable of DataFrames (columns of get_price)
+            batch_size (int): Rows per batch read from a Parquet file
+
+        Yields:
+            pandas.DataFrame: Each chunk with the columns added by get_price
+        """
+        yield from self.stream_profile(
+            profile,
+            self.price_keys,
+            ["region", "voltage"],
+            ["from", "to", "region", "voltage_level"],
+            self.fill_price_gaps,
+            self.price_values,
+            batch_size,
         )
-        for i in range(len(region_voltage_combinations)):
-            # Iterate for each unique combination of region and voltage_level.
-            region = region_voltage_combinations.loc[i, "region"]
-            voltage_level = region_voltage_combinations.loc[i, "voltage_level"]
-            # Check cache for data
-            ixs = (df["region"] == region) & (df["voltage_level"] == voltage_level)
-            from_time = min(df.loc[ixs, "from_utc"])
-            to_time = max(df.loc[ixs, "to_utc"])
-            # Test completeness of data and fill if necessary
-            for attempt in range(4):
-                cache_ixs = (self.price_cache["region"] == region) & (
-                    self.price_cache["voltage"] == voltage_level
+
+    @staticmethod
+    def stream_profile(
+        profile, make_keys, key_cols, plan_cols, fill_gaps, values, batch_size
+    ):
+        """Enriches the chunks of a profile (see stream_price).
+
+        Args:
+            profile: Path of a Parquet file or iterable of DataFrames
+            make_keys (callable): Normalized query of a chunk (e.g. price_keys)
+            key_cols (list): Columns of the query identifying a series
+            plan_cols (list): Profile columns needed by make_keys
+            fill_gaps (callable): Fills the cache for series ranges (e.g. fill_price_gaps)
+            values (callable): Columns of a normalized query (e.g. price_values)
+            batch_size (int): Rows per batch read from a Parquet file
+        """
+        if isinstance(profile, (str, Path)):
+            file = pq.ParquetFile(profile)
+            plan_cols = [col for col in plan_cols if col in file.schema_arrow.names]
+            fill_gaps(
+                profile_ranges(
+                    (
+                        make_keys(batch.to_pandas())
+                        for batch in file.iter_batches(batch_size, columns=plan_cols)
+                    ),
+                    key_cols,
                 )
-                if not any(cache_ixs):
-                    logging.info(
-                        "No data for region and voltage level is stored, collecting data via API."
-                    )
-                    self.price_api_request(region, voltage_level, from_time, to_time)
-                    self.refresh_price_cache(keep_latest=True)
-                    continue  # Start loop again this test shouldn't be triggered
+            )
+            for batch in file.iter_batches(batch_size):
+                chunk = batch.to_pandas()
+                yield with_columns(chunk, values(make_keys(chunk)))
+            return
+        for chunk in profile:
+            keys = make_keys(chunk)
+            fill_gaps(profile_ranges([keys], key_cols))
+            yield with_columns(chunk, values(keys))
 
-                first_available_date = min(self.price_cache.loc[cache_ixs, "from"])
-                last_available_date = max(self.price_cache.loc[cache_ixs, "to"])
+    def interval_join(
+        self,
+        keys: pd.DataFrame,
+        key_cols: list,
+        index: SeriesIndex,
+        cache: pd.DataFrame,
+        value_cols: list,
+        carry_cols: list = (),
+    ) -> pd.DataFrame:
+        """Time-weighted overlap join of profile intervals (of any length) with the cached
+        half-hour slots of their series (see interval_integrals).
 
-                if from_time < first_available_date:
-                    logging.info(
-                        "No data for beggining of time period, collecting data via API."
-                    )
-                    self.price_api_request(
-                        region, voltage_level, from_time, first_available_date
-                    )
-                    self.refresh_price_cache(keep_latest=True)
-                    cache_ixs = (self.price_cache["region"] == region) & (
-                        self.price_cache["voltage"] == voltage_level
-                    )
-                    continue
-                if to_time > last_available_date:
-                    logging.info(
-                        "No data for end of time period, collecting data via API."
-                    )
-                    self.price_api_request(
-                        region, voltage_level, last_available_date, to_time
+        Args:
+            keys (pandas.DataFrame): key_cols, from_utc and to_utc of each profile interval
+            key_cols (list): Columns identifying the series of each interval
+            index (SeriesIndex): Index of the cache
+            cache (pandas.DataFrame): In-memory cache
+            value_cols (list): Cache columns to average
+            carry_cols (list): Cache columns taken from the slot containing the start of
+                each interval (e.g. labels, see covering_slots)
+
+        Returns:
+            pandas.DataFrame: Time-weighted mean of value_cols over each interval (NaN if the
+                cache does not fully cover the interval) and carry_cols (NaN if no slot
+                contains the start), indexed like keys
+        """
+        query_from = keys["from_utc"].values.astype("int64")
+        query_to = keys["to_utc"].values.astype("int64")
+        query_series = np.zeros(len(keys), dtype="int64")
+        slot_labels, slot_series = [], []
+        # Only the slots overlapping each series' intervals take part in the join
+        groups = keys.groupby(key_cols, sort=False).indices
+        for series, (key, positions) in enumerate(groups.items()):
+            query_series[positions] = series
+            labels = index.overlapping_labels(
+                cache, key, query_from[positions].min(), query_to[positions].max()
+            )
+            slot_labels.append(labels)
+            slot_series.append(np.full(len(labels), series))
+        slots = cache.loc[np.concatenate(slot_labels or [cache.index.values[0:0]])]
+        integrals, covered = interval_integrals(
+            slots["from"].values.astype("int64"),
+            slots["to"].values.astype("int64"),
+            slots[value_cols].values,
+            query_from,
+            query_to,
+            slot_series=np.concatenate(slot_series or [np.zeros(0, dtype="int64")]),
+            query_series=query_series,
+        )
+        means = time_weighted_means(integrals, covered, query_from, query_to)
+        out = pd.DataFrame(means, index=keys.index, columns=value_cols)
+        if len(carry_cols):
+            position = covering_slots(
+                slots["from"].values.astype("int64"),
+                slots["to"].values.astype("int64"),
+                query_from,
+                slot_series=np.concatenate(slot_series or [np.zeros(0, dtype="int64")]),
+                query_series=query_series,
+            )
+            # Position -1 (no covering slot) is reindexed to NaN
+            carried = slots[list(carry_cols)].reset_index(drop=True).reindex(position)
+            for col in carry_cols:
+                values = carried[col]
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    values = values.astype(object)  # Categories depend on the cache
+                out[col] = values.array  # Keeps the time zone of from/to
+        return out
+
+    def fill_cache_gaps(
+        self,
+        series_ranges,
+        index,
+        get_cache,
+        fetch_table,
+        store_and_merge,
+        max_span,
+        store,
+        merge,
+        lock,
+        bounds,
+        unavailable,
+        expired=None,
+    ) -> set:
+        """Plans the data missing from a cache for every series, fetches it concurrently and
+        stores/merges it once.
+
+        Only the part of each range within the bounds of the source is planned, and ranges
+        known to be unavailable (see UnavailableRanges) are skipped. Ranges the API does not
+        return are recorded as unavailable, so they are not requested again until they
+        expire: their slots are NaN in the results.
+
+        When the cache is stored locally, the fetch leases of the partitions to fetch are
+        held meanwhile (see PartitionedCache.fetch_lease): workers sharing the cache folder
+        wait for each other, then pick up the data already fetched by another worker from
+        local storage instead of calling the API again.
+
+        Args:
+            series_ranges (pandas.DataFrame): Index: series keys, columns: from_time, to_time
+            index (SeriesIndex): Index of the cache
+            get_cache (callable): Returns the current in-memory cache
+            fetch_table (callable): fetch_table(*key, start, end) -> pyarrow.Table
+            store_and_merge (callable): Stores and merges the fetched pyarrow.Table
+            max_span (timedelta): Maximum time range of a single request
+            store (PartitionedCache): Local storage of the cache
+            merge (callable): Merges a pandas.DataFrame read from local storage
+            lock (threading.RLock): Lock of the in-memory cache, held while planning (never
+                while waiting for fetch leases or API responses)
+            bounds (callable): bounds(key) -> (first, last) time covered by the source for
+                a series
+            unavailable (UnavailableRanges): Ranges known to be unavailable
+            expired (callable): expired(cache, labels) -> bool array of the cached rows to
+                fetch again (see SeriesIndex.missing_ranges), None if cached rows never change
+
+        Returns:
+            set: Keys of the series with data known to be unavailable (outside the bounds,
+                or not returned by the API now or earlier), empty if the cache covers every
+                series. Failed requests raise.
+        """
+
+        def plan():
+            """Requests [(*key, start, end)] and the series with data known unavailable."""
+            requests, skipped = [], set()
+            with lock:
+                for key, row in series_ranges.iterrows():
+                    first, last = bounds(key)
+                    start, end = max(row.from_time, first), min(row.to_time, last)
+                    if start > row.from_time or end < row.to_time:
+                        skipped.add(key)
+                    if start >= end:
+                        continue
+                    ranges, known = unavailable.subtract(
+                        key,
+                        index.missing_ranges(
+                            get_cache(),
+                            key,
+                            start,
+                            end,
+                            max_span=max_span,
+                            expired=expired,
+                        ),
                     )
-                    self.refresh_price_cache(keep_latest=True)
-                    continue
-                focused_cache_ixs = (
-                    (self.price_cache["region"] == region)
-                    & (self.price_cache["voltage"] == voltage_level)
-                    & (self.price_cache["from"] >= from_time)
-                    & (self.price_cache["to"] <= to_time)
+                    if known:
+                        skipped.add(key)
+                    requests += [(*key, start, end) for start, end in ranges]
+            return requests, skipped
+
+        cache = store.prefix.lower()
+        missing, skipped = plan()
+        missing_series = len({tuple(request[:-2]) for request in missing})
+        hits = len(series_ranges) - missing_series
+        self.metrics.count("cache_hits", hits, cache=cache)
+        self.metrics.count("cache_misses", missing_series, cache=cache)
+        if not missing:
+            return skipped
+        partitions = {
+            (tuple(request[:-2]), month)
+            for request in missing
+            for month in months_between(
+                request[-2], request[-1] - timedelta(minutes=30)
+            )
+        }
+        with store.fetch_lease(partitions) if self.use_cache else nullcontext():
+            if self.use_cache:
+                # Another worker may have fetched them while we waited for the leases
+                self.reload_partitions(store, partitions, merge)
+                missing, skipped = plan()
+                if not missing:
+                    return skipped
+            logging.info(
+                f"Gaps in cache detected, collecting {len(missing)} range(s) via API."
+            )
+            self.metrics.count("gap_fills", len(missing), cache=cache)
+            with self.metrics.timer("api_fetch", cache=cache):
+                fetched = self.fetch_concurrently(
+                    lambda request: fetch_table(*request), missing
                 )
-                focused_cached_data = self.price_cache[focused_cache_ixs]
-                if not len(focused_cached_data) == int(
-                    (to_time - from_time).total_seconds() / 1800
-                ):
-                    # Check if data is missing between from_time and to_time if there is just fill the gap
-                    logging.warning(
-                        f"Gaps in cache detected between {from_time}/{to_time} filling gap [have: {len(focused_cached_data)}, expected: {int((to_time-from_time).seconds/1800)} ] , this may take several minutes, please be patient..."
-                    )
-                    self.price_api_request(region, voltage_level, from_time, to_time)
-                    self.refresh_price_cache(keep_latest=True)
-                    continue
-                break
+            store_and_merge(pa.concat_tables(fetched))
+            missing, skipped = plan()
+        if not missing:
+            return skipped
+        logging.warning(
+            f"Data not available from the API, not requested again for "
+            f"{unavailable.ttl}: {missing}"
+        )
+        self.metrics.count("unavailable_ranges", len(missing), cache=cache)
+        ranges = {}
+        for request in missing:
+            ranges.setdefault(tuple(request[:-2]), []).append(tuple(request[-2:]))
+        for key, key_ranges in ranges.items():
+            unavailable.add(key, key_ranges)
+        return skipped | set(ranges)
+
+    @staticmethod
+    def reload_partitions(store, partitions: set, merge):
+        """Reads partitions [(series key, month)] from local storage and merges them."""
+        months = {}
+        for key, month in partitions:
+            months.setdefault(key, []).append(month)
+        for key, key_months in months.items():
+            data = store.read(dict(zip(store.partition_cols, key)), key_months)
+            if data.num_rows:
+                merge(data.to_pandas())
+
+    def fill_price_gaps(self, series_ranges: pd.DataFrame) -> set:
+        """Makes sure the price cache covers the series in series_ranges (index: (region,
+        voltage), columns: from_time, to_time), only fetching the missing ranges.
 
-            # Insert data into dataframe
-            df.loc[ixs, "pennies_per_kwh"] = pd.merge(
-                df.loc[ixs, "from_utc"],
-                focused_cached_data[["from", "pennies_per_kwh"]],
-                left_on="from_utc",
-                right_on="from",
-                suffixes=("", "_ci"),
-                how="left",
-            ).set_index(df[ixs].index)["pennies_per_kwh"]
+        Returns:
+            set: Series with data known to be unavailable (see fill_cache_gaps)
+        """
+        for (region, voltage_level), row in series_ranges.iterrows():
+            # The slot starting before from_time is part of the interval join
+            self.load_price_series(
+                region,
+                voltage_level,
+                row.from_time - timedelta(minutes=30),
+                row.to_time,
+            )
+        return self.fill_cache_gaps(
+            series_ranges,
+            self.price_index,
+            lambda: self.price_cache,
+            self.price_api_table,
+            lambda table: self.merge_price_cache(self.store_price_data(table)),
+            max_span=timedelta(days=30),
+            store=self.price_store,
+            merge=self.merge_price_cache,
+            lock=self.price_lock,
+            bounds=lambda key: (price_dataset_start, price_dataset_end),
+            unavailable=self.price_unavailable,
+        )
 
-            # df.drop(columns='pennies_per_kwh',inplace=True)
+    def fill_co2_gaps(self, series_ranges: pd.DataFrame) -> set:
+        """Makes sure the CO2 cache covers the series in series_ranges (index: (region,
+        postcode) with "NA" if not used, columns: from_time, to_time), only fetching the
+        missing ranges.
+
+        Returns:
+            set: Series with data known to be unavailable (see fill_cache_gaps)
+        """
+        for (region, postcode), row in series_ranges.iterrows():
+            self.load_co2_series(
+                region, postcode, row.from_time - timedelta(minutes=30), row.to_time
+            )
+        return self.fill_cache_gaps(
+            series_ranges,
+            self.co2_index,
+            lambda: self.co2_cache,
+            lambda region, postcode, start, end: self.intensity_api_table(
+                start,
+                end,
+                region=None if region == "NA" else region,
+                postcode=None if postcode == "NA" else postcode,
+            ),
+            lambda table: self.merge_co2_cache(self.store_co2_data(table)),
+            max_span=timedelta(days=13),
+            store=self.co2_store,
+            merge=self.merge_co2_cache,
+            lock=self.co2_lock,
+            bounds=self.co2_bounds,
+            unavailable=self.co2_unavailable,
+            expired=self.co2_expired,
+        )
+
+    @staticmethod
+    def co2_bounds(key: tuple) -> tuple:
+        """(first, last) time covered by CarbonIntensity for a (region, postcode) series:
+        national data starts earlier than regional and postcode data."""
+        first = co2_dataset_start if key == ("NA", "NA") else co2_regional_dataset_start
+        return first, pd.Timestamp.now(tz="UTC") + co2_forecast_horizon
+
+    @staticmethod
+    def co2_expired(cache: pd.DataFrame, labels: np.ndarray) -> np.ndarray:
+        """Cached CO2 slots (row labels) to fetch again: forecasts (slots not over yet when
+        fetched, so without their actual intensity) fetched more than co2_forecast_ttl ago.
+        """
+        positions = cache.index.get_indexer(labels)
+        created = cache["created"].values[positions]
+        forecast = cache["to"].values[positions].astype("int64") > created
+        return forecast & (
+            created < (pd.Timestamp.now(tz="UTC") - co2_forecast_ttl).value
+        )
+
+    @staticmethod
+    def co2_final(series_ranges: pd.DataFrame) -> bool:
+        """True if CO2 results over these ranges can no longer change: they end before the
+        last co2_forecast_ttl, so none of their slots is a forecast to fetch again (see
+        co2_expired)."""
+        cutoff = pd.Timestamp.now(tz="UTC") - co2_forecast_ttl
+        return series_ranges["to_time"].max() <= cutoff
 
     # def try_fill_from_cache_simple_df_price(self,region,voltage_level,from_time,to_time):
 
@@ -416,79 +1370,58 @@ class UKGridConnection:
         Returns:
             pandas.DataFrame: response from API call
         """
+        table = self.price_api_table(region, voltage, from_time, to_time)
+        if skipstore:
+            return table.to_pandas()
+        return self.store_price_data(table)  # Store data (default behaviour)
 
-        fetch_nanosec = time.time_ns()
-        fetch_id = str(fetch_nanosec)
+    def price_api_table(self, region, voltage, from_time, to_time) -> pa.Table:
+        """Retrieves energy price data via API (see price_api_request) without storing it.
 
+        Returns:
+            pyarrow.Table: response from API call in the cache schema (price_schema)
+        """
         if to_time - from_time > timedelta(days=31):
-            # Recursive behaviour
-            data_chunks = []
-            next_t = from_time
-            while next_t < to_time:
-                next_t = min(from_time + timedelta(days=30), to_time)
-                data_chunks.append(
-                    self.price_api_request(
-                        region,
-                        voltage,
-                        from_time=from_time,
-                        to_time=next_t,
-                        skipstore=True,
-                    )
-                )
-                from_time = next_t
-                # Could add a pause not to overwhelm their servers
-            data = pd.concat(data_chunks)
-            data.reset_index(inplace=True, drop=True)
-        else:
-            dno = region_dno[region]
-            voltage_level = voltage_level_enums[voltage]
-            from_txt = from_time.strftime("%d-%m-%Y")  # datetime in format YYYY-MM-DD
-            to_txt = (to_time + timedelta(days=1)).strftime(
-                "%d-%m-%Y"
-            )  # datetime in format YYYY-MM-DD / Truncates at the beggining of the day
-            url = f"https://odegdcpnma.execute-api.eu-west-2.amazonaws.com/development/prices?dno={dno}&voltage={voltage_level}&start={from_txt}&end={to_txt}"
-            r = requests.get(url, params={}, headers=ci_headers)
-            # Response {"status":~ , "data":{"dno":, "region":,  "data":[{"Overall":~, "Timestamp":}] }}
-            # “data”: a list with the “Overall” price in p/kWh, the “unixTimestamp”, and “Timestamp” with the specific time and date.
-            json_data = json.loads(r.text)
-
-            data = pd.DataFrame(json_data["data"]["data"])
-            data.rename(
-                columns={"Overall": "pennies_per_kwh", "Timestamp": "from"},
-                inplace=True,
-            )
-            data = data[["pennies_per_kwh", "from"]]
-            data["from"] = pd.to_datetime(
-                data["from"], format="%H:%M %d-%m-%Y", utc=True
-            )
-            data["to"] = data["from"] + timedelta(minutes=30)
-            data["region"] = region if region else "NA"
-            data["voltage"] = voltage if voltage else "NA"
-            data["dnoRegion"] = json_data["data"]["dnoRegion"]
-            data["voltageLevel"] = json_data["data"]["voltageLevel"]
-            data["id"] = data.apply(
-                lambda x: "_".join(
-                    [x["region"], x["voltageLevel"], str(int(x["from"].timestamp()))]
-                )
-                .replace(" ", "_")
-                .upper(),
-                axis=1,
+            # Recursive behaviour (chunks are fetched concurrently, reassembled in order)
+            data_chunks = self.fetch_concurrently(
+                lambda chunk: self.price_api_table(region, voltage, *chunk),
+                time_chunks(from_time, to_time, timedelta(days=30)),
             )
-            data["created"] = fetch_id
-            data = data[price_data_cols]
-        # Export data to cache
-        # Need to create ID & timestamps
-
-        if self.use_cache and not skipstore:  # Store data (default behaviour)
-            filename = "price_" + fetch_id + ".parquet.snappy"
-            logging.info(f"Storing {filename}")
-            data = data.applymap(str).astype(
-                pd.StringDtype()
-            )  # Convert all to string for storing
-            data.to_parquet(
-                self.price_cache_path / filename, engine="pyarrow", compression="snappy"
-            )
-        return data
+            return pa.concat_tables(data_chunks)
+        dno = region_dno[region]
+        voltage_level = voltage_level_enums[voltage]
+        from_txt = from_time.strftime("%d-%m-%Y")  # datetime in format YYYY-MM-DD
+        to_txt = (to_time + timedelta(days=1)).strftime(
+            "%d-%m-%Y"
+        )  # datetime in format YYYY-MM-DD / Truncates at the beggining of the day
+        url = f"https://odegdcpnma.execute-api.eu-west-2.amazonaws.com/development/prices?dno={dno}&voltage={voltage_level}&start={from_txt}&end={to_txt}"
+        self.rate_limiter.wait()  # Not to overwhelm their servers
+        # Response {"status":~ , "data":{"dno":, "region":,  "data":[{"Overall":~, "Timestamp":}] }}
+        # “data”: a list with the “Overall” price in p/kWh, the “unixTimestamp”, and “Timestamp” with the specific time and date.
+        with self.metrics.timer("api_request", cache="price"):
+            json_data = self.api_get(url, cache="price")
+        with self.metrics.timer("ingest", cache="price"):
+            table = price_table_from_json(json_data, region, voltage, time.time_ns())
+        self.metrics.count("api_requests", cache="price")
+        self.metrics.count("rows_fetched", table.num_rows, cache="price")
+        return table
+
+    def store_price_data(self, data) -> pd.DataFrame:
+        """Stores fetched price data (pyarrow.Table in the cache schema or pandas.DataFrame)
+        in local storage (if use_cache).
+
+        Returns:
+            pandas.DataFrame: Data in the cache schema
+        """
+        table = (
+            data if isinstance(data, pa.Table) else to_cache_table(data, price_schema)
+        )
+        if self.use_cache:
+            with self.metrics.timer("store", cache="price"):
+                written = self.price_store.write(table)
+            self.metrics.count("files_written", len(written), cache="price")
+            logging.info(f"Storing {written}")
+        return table.to_pandas()
 
     def get_c02(self, df):
         """Given an energy profile and region it returns the total CO2 consumed from the grid
@@ -505,35 +1438,104 @@ class UKGridConnection:
         Returns:
             pandas.DataFrame: DataFrame with CO2 generated
         """
+        with self.metrics.timer("get_c02"):
+            keys = self.co2_keys(df)
+            query = query_key(keys)
+            result = self.co2_results.get(query)
+            self.metrics.count(
+                "query_cache_misses" if result is None else "query_cache_hits",
+                cache="co2",
+            )
+            if result is None:
+                series_ranges = profile_ranges([keys], ["region_ci", "postcode_ci"])
+                # Check cache, fetch only what is missing
+                unavailable = self.fill_co2_gaps(series_ranges)
+                versions = self.co2_results.versions(series_ranges.index)
+                result = self.co2_values(keys)
+                # Forecasts still to be revised are not memoized
+                if not unavailable and self.co2_final(series_ranges):
+                    self.co2_results.put(query, result, versions)
+            return with_columns(df, result)
+
+    @staticmethod
+    def co2_keys(df: pd.DataFrame) -> pd.DataFrame:
+        """Normalized CO2 query of a profile: from_utc, to_utc, postcode_ci, region_ci (and
+        average_power if given), indexed like df."""
+        # Each row uses the intensity of its postcode, else of its region, else national.
+        keys = pd.DataFrame(index=df.index)
+        keys["from_utc"] = pd.to_datetime(df["from"], utc=True)  # Enforce UTC
+        keys["to_utc"] = pd.to_datetime(df["to"], utc=True)  # Enforce UTC
+        keys["postcode_ci"] = (
+            df["postcode"].fillna("NA").astype(str) if "postcode" in df else "NA"
+        )
+        keys["region_ci"] = (
+            df["region"].fillna("NA").astype(str) if "region" in df else "NA"
+        )
+        keys.loc[keys["postcode_ci"] != "NA", "region_ci"] = "NA"
+        if "average_power" in df.columns:
+            keys["average_power"] = df["average_power"]
+        return keys
 
-        # TODO: Enable Cache for improved performance
-        # Check cache dataframe
-
-        # If cache dataframe does not have all data then:
-        # 1. Refresh cache (from local storage) if this still does not have all data then
-        # 2. Make an API request to fetch missing data and update local storage cache.
+    def co2_values(self, keys: pd.DataFrame) -> dict:
+        """CO2 columns of a normalized query (see co2_keys) from the in-memory cache.
 
-        raw_df = self.intensity_api_request(min(df["from"]), max(df.to))
-        raw_df["from"] = pd.to_datetime(raw_df["from"], utc=True)
-        raw_df["to"] = pd.to_datetime(raw_df["to"], utc=True)
-        df["from"] = pd.to_datetime(df["from"], utc=True)
+        Intensities and generation mix are time-weighted over each interval, the other
+        columns of the cache (intensity_index, regionid, shortname, ...) are taken from the
+        slot containing the start of the interval, its from/to as from_ci/to_ci.
 
-        # TODO: Enable smart assignement of intensity (using pandas SQL)
-        # Logic:
-        #   1. Join by: From_requested>to_response && To_requested<From_response,
-        #   2. Do aggregations: Between From_requested and To_requested
+        Returns:
+            dict: {column: array}: the query (from_utc, to_utc, postcode_ci, region_ci), the
+                CO2 columns (plus the total_emmissions_* columns if average_power)
+        """
+        # Time-weighted intensity over each interval of the profile
+        intensity_cols = ["intensity_forecast", "intensity_actual", *generationmix_cols]
+        with self.co2_lock, self.metrics.timer("interval_join", cache="co2"):
+            intensities = self.interval_join(
+                keys,
+                ["region_ci", "postcode_ci"],
+                self.co2_index,
+                self.co2_cache,
+                intensity_cols,
+                co2_carry_cols,
+            )
+        result = {
+            col: keys[col].array
+            for col in ["from_utc", "to_utc", "postcode_ci", "region_ci"]
+        }
+        result.update(
+            {
+                co2_carried_names.get(col, col): intensities[col].array
+                for col in co2_carry_cols
+            }
+        )
+        result.update({col: intensities[col].values for col in intensity_cols})
+        if "average_power" in keys.columns:
+            # Emissions = average power * integral of the intensity over the interval
+            hours = (keys["to_utc"] - keys["from_utc"]).dt.total_seconds() / 3600
+            energy = keys["average_power"].values * hours.values
+            result["total_emmissions_actual"] = (
+                energy * result["intensity_actual"] / 10**6
+            )
+            result["total_emmissions_forecast"] = (
+                energy * result["intensity_forecast"] / 10**6
+            )
+        return result
 
-        out = pd.merge(df, raw_df, on="from", suffixes=("", "_ci"))
-        if "average_power" in out.columns:
-            # TODO: When change to variable time windows, change the code below (assumes intervals are half an hour long)
-            out["total_emmissions_actual"] = (
-                out.average_power * out.intensity_actual / 10**6
-            ) / 2
-            out["total_emmissions_forecast"] = (
-                out.average_power * out.intensity_forecast / 10**6
-            ) / 2
+    def stream_c02(self, profile, batch_size: int = 100_000):
+        """Streaming get_c02 for profiles too large to hold in memory (see stream_price).
 
-        return out
+        Yields:
+            pandas.DataFrame: Each chunk with the columns added by get_c02
+        """
+        yield from self.stream_profile(
+            profile,
+            self.co2_keys,
+            ["region_ci", "postcode_ci"],
+            ["from", "to", "region", "postcode"],
+            self.fill_co2_gaps,
+            self.co2_values,
+            batch_size,
+        )
 
     def intensity_api_request(
         self,
@@ -564,112 +1566,68 @@ class UKGridConnection:
              - geneartionmix
 
         """
+        table = self.intensity_api_table(from_time, to_time, region, postcode)
+        if skipstore:
+            return table.to_pandas()
+        return self.store_co2_data(table)  # Store data (default behaviour)
 
-        fetch_nanosec = time.time_ns()
-        fetch_id = str(fetch_nanosec)
-        logging.info(
-            f"FetchID: {fetch_id}"
-        )  # Maybe time definition is not enoughly accurate
+    def intensity_api_table(
+        self, from_time, to_time, region: str = None, postcode: str = None
+    ) -> pa.Table:
+        """Makes API request to CarbonIntensity (see intensity_api_request) without storing it.
 
+        Returns:
+            pyarrow.Table: Results of CO2 intensity in the cache schema (co2_schema)
+        """
         # Times should be all UTC. Timezone parsing should be handled here.
         if to_time - from_time > timedelta(days=14):
-            # Recursive behaviour
-            data_chunks = []
-            next_t = from_time
-            while next_t < to_time:
-                next_t = min(from_time + timedelta(days=13), to_time)
-                data_chunks.append(
-                    self.intensity_api_request(
-                        from_time=from_time,
-                        to_time=next_t,
-                        region=region,
-                        postcode=postcode,
-                        skipstore=True,
-                    )
-                )
-                from_time = next_t
-                # Could add a pause not to overwhelm their servers
-            data = pd.concat(data_chunks)
-            data.reset_index(inplace=True, drop=True)
-        else:
-            # Prepare URL for API call
-            from_txt = from_time.strftime(
-                "%Y-%m-%dT%H:%MZ"
-            )  # datetime in ISO8601 format YYYY-MM-DDThh:mmZ
-            to_txt = to_time.strftime("%Y-%m-%dT%H:%MZ")
-
-            if postcode:
-                template = (
-                    f"/regional/intensity/{from_txt}/{to_txt}/postcode/{postcode}"
-                )
-            elif region:
-                region_id = region_map[region]
-                template = (
-                    f"/regional/intensity/{from_txt}/{to_txt}/regionid/{region_id}"
-                )
-            else:
-                template = f"/intensity/{from_txt}/{to_txt}"  # The maximum date range is limited to 14 days
-
-            url = ci_base_url + template
-            # Fetch data
-            logging.info(f"Calling {url}")
-            r = requests.get(url, params={}, headers=ci_headers)
-
-            # Process data
-            json_data = json.loads(r.text)
-
-            if postcode:
-                # data_summary = pd.json_normalize(json_data["data"],sep="_")[['regionid','dnoregion','shortname']]
-                data = pd.json_normalize(json_data["data"], record_path="data", sep="_")
-                data["regionid"] = json_data["data"]["regionid"]
-                data["shortname"] = json_data["data"]["shortname"]
-                data["source_postcode"] = json_data["data"]["postcode"]
-            elif region:
-                # Does not have actual but has generation mix
-                data = pd.json_normalize(json_data["data"], record_path="data", sep="_")
-                data["regionid"] = json_data["data"]["regionid"]
-                data["dnoregion"] = json_data["data"]["dnoregion"]
-                data["shortname"] = json_data["data"]["shortname"]
-            else:
-                data = pd.json_normalize(json_data["data"], sep="_")
-            data["source"] = "CarbonIntensity"
-            data["created"] = fetch_id
-            data["region"] = region if region else "NA"
-            data["postcode"] = postcode if postcode else "NA"
-            data["from"] = pd.to_datetime(data["from"], utc=True)
-            data["to"] = pd.to_datetime(data["to"], utc=True)
-            data["id"] = data.apply(
-                lambda x: "_".join(
-                    [x["region"], x["postcode"], str(int(x["from"].timestamp()))]
-                )
-                .replace(" ", "_")
-                .upper(),
-                axis=1,
-            )
-            if not "generationmix" in data.columns:
-                data["generationmix"] = json.dumps({})
-            else:
-                data["generationmix"] = data.generationmix.apply(
-                    lambda x: json.dumps(x)
-                )
-
-            if not "intensity_actual" in data.columns:
-                data["intensity_actual"] = None
-            #  Fill missing columns with pd.NA.
-            missing_cols = [col for col in co2_data_cols if col not in data.columns]
-            data[missing_cols] = "NA"
-            data = data[co2_data_cols]  # Sort Columns
-        if self.use_cache and not skipstore:  # Store data (default behaviour)
-            filename = "CO2_" + fetch_id + ".parquet.snappy"
-            logging.info(f"Storing {filename}")
-            data = data.applymap(str).astype(
-                pd.StringDtype()
-            )  # Convert all to string for storing
-            data.to_parquet(
-                self.co2_cache_path / filename, engine="pyarrow", compression="snappy"
+            # Recursive behaviour (chunks are fetched concurrently, reassembled in order)
+            data_chunks = self.fetch_concurrently(
+                lambda chunk: self.intensity_api_table(*chunk, region, postcode),
+                time_chunks(from_time, to_time, timedelta(days=13)),
             )
+            return pa.concat_tables(data_chunks)
+
+        # Prepare URL for API call
+        from_txt = from_time.strftime(
+            "%Y-%m-%dT%H:%MZ"
+        )  # datetime in ISO8601 format YYYY-MM-DDThh:mmZ
+        to_txt = to_time.strftime("%Y-%m-%dT%H:%MZ")
+
+        if postcode:
+            template = f"/regional/intensity/{from_txt}/{to_txt}/postcode/{postcode}"
+        elif region:
+            region_id = region_map[region]
+            template = f"/regional/intensity/{from_txt}/{to_txt}/regionid/{region_id}"
+        else:
+            template = f"/intensity/{from_txt}/{to_txt}"  # The maximum date range is limited to 14 days
+
+        url = ci_base_url + template
+        # Fetch data
+        logging.info(f"Calling {url}")
+        self.rate_limiter.wait()  # Not to overwhelm their servers
+        with self.metrics.timer("api_request", cache="co2"):
+            json_data = self.api_get(url, cache="co2")
+        with self.metrics.timer("ingest", cache="co2"):
+            table = co2_table_from_json(json_data, region, postcode, time.time_ns())
+        self.metrics.count("api_requests", cache="co2")
+        self.metrics.count("rows_fetched", table.num_rows, cache="co2")
+        return table
+
+    def store_co2_data(self, data) -> pd.DataFrame:
+        """Stores fetched CO2 data (pyarrow.Table in the cache schema or pandas.DataFrame)
+        in local storage (if use_cache).
 
-        return data
+        Returns:
+            pandas.DataFrame: Data in the cache schema
+        """
+        table = data if isinstance(data, pa.Table) else to_cache_table(data, co2_schema)
+        if self.use_cache:
+            with self.metrics.timer("store", cache="co2"):
+                written = self.co2_store.write(table)
+            self.metrics.count("files_written", len(written), cache="co2")
+            logging.info(f"Storing {written}")
+        return table.to_pandas()
 
     # pd.read_parquet(self.co2_cache_path/'CO2_1680361107217428600.parquet.snappy')
     # pd.read_parquet(self.co2_cache_path/'CO2_1680361107532143900.parquet.snappy')
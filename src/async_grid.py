@@ -0,0 +1,101 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from src.UKGridConnection import UKGridConnection
+
+
+class AsyncUKGridConnection:
+    """
+    asyncio counterpart of UKGridConnection for async services.
+
+    Every request method is a coroutine running the synchronous pipeline (API fetches, cache
+    merges and refreshes, interval joins) in a thread pool, so the event loop is never
+    blocked and up to max_queries queries are served concurrently. Queries share the caches
+    of a single UKGridConnection: its in-memory caches are guarded by locks and the fetches
+    of concurrent queries for the same partitions are deduplicated by the fetch leases (see
+    UKGridConnection.fill_cache_gaps).
+
+    Usage:
+        async with await AsyncUKGridConnection.create(cache_path=path) as grid:
+            prices, co2 = await asyncio.gather(grid.get_price(df), grid.get_c02(df))
+    """
+
+    def __init__(self, grid: UKGridConnection, max_queries: int = 8):
+        """
+        Args:
+            grid (UKGridConnection): Connection serving the queries (see create)
+            max_queries (int): Maximum number of queries running at the same time
+        """
+        self.grid = grid
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_queries, thread_name_prefix="UKGridConnection"
+        )
+
+    @classmethod
+    async def create(cls, max_queries: int = 8, **kwargs):
+        """Builds the UKGridConnection (loading its caches) off the event loop.
+
+        Args:
+            max_queries (int): Maximum number of queries running at the same time
+            **kwargs: Arguments of UKGridConnection
+        """
+        loop = asyncio.get_running_loop()
+        grid = await loop.run_in_executor(
+            None, functools.partial(UKGridConnection, **kwargs)
+        )
+        return cls(grid, max_queries)
+
+    async def run(self, method, *args, **kwargs):
+        """Runs a (blocking) method of the connection in the thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(method, *args, **kwargs)
+        )
+
+    async def get_price(self, df):
+        """See UKGridConnection.get_price"""
+        return await self.run(self.grid.get_price, df)
+
+    async def get_c02(self, df):
+        """See UKGridConnection.get_c02"""
+        return await self.run(self.grid.get_c02, df)
+
+    async def price_api_request(self, region, voltage, from_time, to_time, **kwargs):
+        """See UKGridConnection.price_api_request"""
+        return await self.run(
+            self.grid.price_api_request, region, voltage, from_time, to_time, **kwargs
+        )
+
+    async def intensity_api_request(self, from_time, to_time, **kwargs):
+        """See UKGridConnection.intensity_api_request"""
+        return await self.run(
+            self.grid.intensity_api_request, from_time, to_time, **kwargs
+        )
+
+    async def refresh_price_cache(self, keep_latest: bool = True):
+        """See UKGridConnection.refresh_price_cache"""
+        return await self.run(self.grid.refresh_price_cache, keep_latest)
+
+    async def refresh_co2_cache(self, keep_latest: bool = True):
+        """See UKGridConnection.refresh_co2_cache"""
+        return await self.run(self.grid.refresh_co2_cache, keep_latest)
+
+    async def compact_cache(self, remove_inputs: bool = True) -> dict:
+        """See UKGridConnection.compact_cache"""
+        return await self.run(self.grid.compact_cache, remove_inputs)
+
+    async def close(self):
+        """Waits for the running queries, then stops the thread pool and the background
+        compaction and closes the transport."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.executor.shutdown)
+        await loop.run_in_executor(None, self.grid.stop_compaction)
+        if hasattr(self.grid.transport, "close"):
+            self.grid.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
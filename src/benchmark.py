@@ -0,0 +1,425 @@
+"""
+Offline benchmarks of UKGridConnection on synthetic caches.
+
+A synthetic history (every DNO region x voltage level for prices, every CarbonIntensity
+region plus national for CO2, half-hourly) is written as compacted partitions plus a sprawl
+of small per-fetch files, then the main operations are timed with the APIs served by
+FakeGridTransport:
+
+    python -m src.benchmark                                   # Full scale (8 years)
+    python -m src.benchmark --years 1 --save-baseline benchmarks/baseline.json
+    python -m src.benchmark --years 1 --baseline benchmarks/baseline.json
+
+With --baseline the run fails (exit code 1) if a benchmark is slower than its baseline by
+more than the tolerance. Baselines are machine specific, so none is committed: record one
+with --save-baseline (make benchmark_baseline) before comparing (make benchmark).
+"""
+import argparse
+import gc
+import json
+import logging
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from src.build_cache import backfill, price_regions, voltage_levels
+from src.transport import FakeGridTransport
+from src.UKGridConnection import (
+    UKGridConnection,
+    co2_schema,
+    generationmix_cols,
+    id_array,
+    label_array,
+    price_schema,
+    region_dno,
+    region_map,
+    timestamp_type,
+    voltage_level_enums,
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+slot_ns = 30 * 60 * 10**9
+history_end = datetime(2025, 4, 1)  # End of the price dataset
+
+
+def slot_times(from_time, to_time):
+    """Half-hour slots between from_time and to_time: (from, to) timestamp[us] arrays and
+    the minute of the day of each slot."""
+    from_ns = np.arange(
+        pd.Timestamp(from_time, tz="UTC").value,
+        pd.Timestamp(to_time, tz="UTC").value,
+        slot_ns,
+    )
+    from_us = pa.array(from_ns // 1000).cast(timestamp_type)
+    to_us = pa.array((from_ns + slot_ns) // 1000).cast(timestamp_type)
+    minute = (from_ns // (60 * 10**9)) % (24 * 60)
+    return from_us, to_us, minute
+
+
+def daily_wave(minute: np.ndarray) -> np.ndarray:
+    return np.sin(2 * np.pi * minute / (24 * 60))
+
+
+def synthetic_price_table(
+    region: str, voltage: str, from_time, to_time, created: int
+) -> pa.Table:
+    """Price cache rows of a series (same values as FakeGridTransport)."""
+    from_us, to_us, minute = slot_times(from_time, to_time)
+    n = len(from_us)
+    dno = region_dno[region]
+    voltage_level = voltage_level_enums[voltage]
+    columns = {
+        "id": id_array(f"{region}_{voltage_level}_", from_us),
+        "created": pa.array(np.full(n, created, dtype="int64")),
+        "region": label_array(region, n),
+        "voltageLevel": label_array(voltage_level, n),
+        "from": from_us,
+        "to": to_us,
+        "voltage": label_array(voltage, n),
+        "dnoRegion": label_array(dno, n),
+        "pennies_per_kwh": pa.array(
+            np.round(10 + 5 * daily_wave(minute) + dno / 10, 2)
+        ),
+    }
+    return pa.Table.from_pydict(columns, schema=price_schema)
+
+
+def synthetic_co2_table(region: str, from_time, to_time, created: int) -> pa.Table:
+    """CO2 cache rows of a region ("NA" for national, same values as FakeGridTransport)."""
+    from_us, to_us, minute = slot_times(from_time, to_time)
+    n = len(from_us)
+    region_id = region_map.get(region, 11)
+    forecast = np.floor(200 + 100 * daily_wave(minute) + region_id)
+    gas = np.round(40 + 20 * daily_wave(minute), 1)
+    mix = {col: np.zeros(n) for col in generationmix_cols}
+    mix["generationmix_gas"], mix["generationmix_wind"] = gas, 100 - gas
+    columns = {
+        "id": id_array(f"{region}_NA_", from_us),
+        "created": pa.array(np.full(n, created, dtype="int64")),
+        "from": from_us,
+        "to": to_us,
+        "region": label_array(region, n),
+        "postcode": label_array("NA", n),
+        "source": label_array("CarbonIntensity", n),
+        "regionid": label_array(region_id, n),
+        "dnoregion": label_array(f"DNO {region_id}", n),
+        "shortname": label_array(f"Region {region_id}", n),
+        "source_postcode": label_array("NA", n),
+        "intensity_forecast": pa.array(forecast),
+        "intensity_index": label_array("moderate", n),
+        "intensity_actual": pa.array(forecast + 5),
+        **{col: pa.array(values) for col, values in mix.items()},
+    }
+    return pa.Table.from_pydict(columns, schema=co2_schema)
+
+
+def write_synthetic_cache(
+    cache_path: Path,
+    from_time,
+    to_time,
+    price_series: list,
+    co2_regions: list,
+    fetch_files: int = 10,
+    seed: int = 0,
+) -> dict:
+    """
+    Writes a synthetic cache: the history of every series as compacted partitions, plus
+    fetch_files small per-fetch files per series (one day re-fetched at a random date, as
+    left behind by get_price/get_c02 between compactions).
+
+    Returns:
+        dict: Rows and files written per cache
+    """
+    grid = UKGridConnection(cache_path=cache_path, lazy=True)
+    rng = np.random.default_rng(seed)
+    days = (pd.Timestamp(to_time) - pd.Timestamp(from_time)).days
+    stats = {"price_rows": 0, "co2_rows": 0, "files": 0}
+    series = [("price", key) for key in price_series] + [
+        ("co2", region) for region in co2_regions
+    ]
+    for cache, key in series:
+        if cache == "price":
+            store, make_table = grid.price_store, synthetic_price_table
+            args = key
+        else:
+            store, make_table = grid.co2_store, synthetic_co2_table
+            args = (key,)
+        # History fetched once it was over (older than the per-fetch files)
+        table = make_table(
+            *args, from_time, to_time, created=pd.Timestamp(to_time).value
+        )
+        stats["files"] += len(store.write(table, name=store.consolidated_name))
+        stats[f"{cache}_rows"] += table.num_rows
+        for day in rng.integers(0, days, fetch_files):
+            start = pd.Timestamp(from_time) + timedelta(days=int(day))
+            fetch = make_table(*args, start, start + timedelta(days=1), time.time_ns())
+            stats["files"] += len(store.write(fetch))
+    return stats
+
+
+def measure(name: str, function, rows=None, trace_memory: bool = False) -> dict:
+    """Runs function once, timing it (or tracking its peak memory).
+
+    peak_mb is the peak of the Python/numpy allocations made by the function (tracemalloc,
+    Arrow buffers are not included), max_rss_mb the peak resident memory of the process so
+    far (None on Windows). tracemalloc slows the function down several times, so it only
+    runs with trace_memory, whose seconds are not comparable (see benchmark_reports).
+
+    Args:
+        rows: Rows processed (or a callable returning them from the result of function)
+        trace_memory (bool): Track the peak memory (peak_mb is None otherwise)
+
+    Returns:
+        dict: name, seconds, rows, rows_per_second, peak_mb, max_rss_mb
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    rows = rows(result) if callable(rows) else rows
+    max_rss = None
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    report = {
+        "name": name,
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_second": rows / seconds if rows and seconds else None,
+        "peak_mb": peak,
+        "max_rss_mb": max_rss,
+    }
+    logging.info(f"{name}: {seconds:.3f}s")
+    return report
+
+
+def profile(series: list, from_time, to_time, key_cols: list) -> pd.DataFrame:
+    """Half-hourly profile (average_power 1 kW) of every series between from_time and
+    to_time."""
+    times = pd.date_range(from_time, to_time, freq="30min", inclusive="left", tz="UTC")
+    frames = []
+    for key in series:
+        frame = pd.DataFrame({"from": times, "to": times + timedelta(minutes=30)})
+        for col, value in zip(key_cols, key if isinstance(key, tuple) else (key,)):
+            frame[col] = value
+        frames.append(frame)
+    data = pd.concat(frames, ignore_index=True)
+    data["average_power"] = 1.0
+    return data
+
+
+def run_benchmarks(
+    work_path: Path,
+    years: int = 8,
+    regions: int = None,
+    fetch_files: int = 10,
+    latency: float = 0.0,
+    trace_memory: bool = False,
+) -> list:
+    """
+    Writes a synthetic cache of years of history into work_path and times:
+    __init__ (full, lazy and hot cache), refresh_*_cache, get_price (cached data, memoized
+    result and data fetched from the API), get_c02, consolidate_cache and the backfill of
+    build_cache.py (one month of every price series into an empty cache).
+
+    Args:
+        work_path (Path): Scratch folder (overwritten)
+        years (int): Years of history ending on 2025-04-01 (all but the last month cached)
+        regions (int): Only use the first regions (default: all of them)
+        fetch_files (int): Per-fetch files left per series
+        latency (float): Simulated latency of every API response [s]
+        trace_memory (bool): Track peak memory instead of timing (see measure)
+
+    Returns:
+        list: One report per benchmark (see measure)
+    """
+    work_path = Path(work_path)
+    shutil.rmtree(work_path, ignore_errors=True)
+    cache_path = work_path / "cache"
+    from_time = history_end - pd.DateOffset(years=years)
+    cached_end = history_end - pd.DateOffset(months=1)  # The last month is fetched
+    region_names = list(price_regions)[:regions]
+    price_series = [(r, v) for r in region_names for v in voltage_levels]
+    co2_regions = [r for r in region_map if r in region_names or regions is None] + [
+        "NA"
+    ]
+    written = write_synthetic_cache(
+        cache_path, from_time, cached_end, price_series, co2_regions, fetch_files
+    )
+    logging.info(f"Synthetic cache: {written}")
+
+    def connection(**kwargs):
+        return UKGridConnection(
+            cache_path=cache_path,
+            requests_per_second=None,
+            transport=FakeGridTransport(latency),
+            **kwargs,
+        )
+
+    def run(name, function, rows=None):
+        return measure(name, function, rows, trace_memory)
+
+    cached_rows = lambda grid: len(grid.price_cache) + len(grid.co2_cache)
+    reports = [run("init", connection, cached_rows)]
+    grid = connection()
+    reports.append(run("init_lazy", lambda: connection(lazy=True), 0))
+    reports.append(
+        run(
+            "refresh_price_cache",
+            grid.refresh_price_cache,
+            lambda _: len(grid.price_cache),
+        )
+    )
+    reports.append(
+        run("refresh_co2_cache", grid.refresh_co2_cache, lambda _: len(grid.co2_cache))
+    )
+
+    last_month = cached_end - pd.DateOffset(months=1)
+    price_profile = profile(
+        price_series, last_month, cached_end, ["region", "voltage_level"]
+    )
+    reports.append(
+        run("get_price", lambda: grid.get_price(price_profile), len(price_profile))
+    )
+    reports.append(
+        run(
+            "get_price_memoized",
+            lambda: grid.get_price(price_profile),
+            len(price_profile),
+        )
+    )
+    next_month = profile(
+        price_series, cached_end, history_end, ["region", "voltage_level"]
+    )
+    reports.append(
+        run("get_price_fetch", lambda: grid.get_price(next_month), len(next_month))
+    )
+    co2_profile = profile(
+        [r for r in co2_regions if r != "NA"], last_month, cached_end, ["region"]
+    )
+    reports.append(run("get_c02", lambda: grid.get_c02(co2_profile), len(co2_profile)))
+    reports.append(
+        run(
+            "consolidate_cache",
+            grid.consolidate_cache,
+            lambda stats: sum(s["files"] for s in stats.values()),
+        )
+    )
+    grid.price_store.write_hot()
+    grid.co2_store.write_hot()
+    reports.append(
+        run("init_hot_cache", lambda: connection(hot_cache=True), cached_rows)
+    )
+
+    empty = UKGridConnection(
+        cache_path=work_path / "backfill",
+        lazy=True,
+        requests_per_second=None,
+        transport=FakeGridTransport(latency),
+    )
+    month = datetime(2019, 1, 1)
+    reports.append(
+        run(
+            "backfill",
+            lambda: backfill(
+                empty, month, month + pd.DateOffset(months=1), regions=region_names
+            ),
+            lambda _: len(empty.price_cache),
+        )
+    )
+    return reports
+
+
+def compare(reports: list, baseline: dict, tolerance: float = 0.25) -> list:
+    """Benchmarks slower than their baseline ({name: report}) by more than tolerance.
+
+    Returns:
+        list: [(name, seconds, baseline seconds)]
+    """
+    return [
+        (r["name"], r["seconds"], baseline[r["name"]]["seconds"])
+        for r in reports
+        if r["name"] in baseline
+        and r["seconds"] > baseline[r["name"]]["seconds"] * (1 + tolerance)
+    ]
+
+
+def benchmark_reports(work_path: Path, memory: bool = True, **kwargs) -> list:
+    """Runs the benchmarks (see run_benchmarks) for their times, then again from scratch
+    with memory tracking for their peak_mb only, so tracemalloc does not slow down the
+    timed run.
+
+    Returns:
+        list: One report per benchmark (see measure)
+    """
+    reports = run_benchmarks(work_path, **kwargs)
+    if memory:
+        traced = run_benchmarks(work_path, trace_memory=True, **kwargs)
+        for report, traced_report in zip(reports, traced):
+            report["peak_mb"] = traced_report["peak_mb"]
+    return reports
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--years", type=int, default=8)
+    parser.add_argument("--regions", type=int, default=None)
+    parser.add_argument("--fetch-files", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--work-path", type=Path, default=None)
+    parser.add_argument("--baseline", type=Path, help="Fail on regressions against it")
+    parser.add_argument("--save-baseline", type=Path)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument(
+        "--no-memory", action="store_true", help="Skip the peak memory run"
+    )
+    args = parser.parse_args(args)
+    if args.baseline and not args.baseline.exists():
+        parser.error(
+            f"no baseline at {args.baseline}, record one on this machine first with "
+            f"--save-baseline {args.baseline} (make benchmark_baseline)"
+        )
+
+    with tempfile.TemporaryDirectory() as scratch:
+        reports = benchmark_reports(
+            args.work_path or Path(scratch),
+            memory=not args.no_memory,
+            years=args.years,
+            regions=args.regions,
+            fetch_files=args.fetch_files,
+            latency=args.latency,
+        )
+    print(pd.DataFrame(reports).set_index("name").round(3).to_string())
+    if args.save_baseline:
+        args.save_baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.save_baseline.write_text(
+            json.dumps({r["name"]: r for r in reports}, indent=2)
+        )
+    if args.baseline:
+        regressions = compare(
+            reports, json.loads(args.baseline.read_text()), args.tolerance
+        )
+        for name, seconds, expected in regressions:
+            print(f"REGRESSION {name}: {seconds:.3f}s (baseline {expected:.3f}s)")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
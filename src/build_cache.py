@@ -1,56 +1,254 @@
-if __name__ == "__main__":
-    # Example: retrieve from cache (or download and then retrieve if not in cache)
-    # data of energy price the whole UK for January 2019
+"""
+Backfills the local cache with the prices (and optionally CO2 intensities) of every region
+and voltage level over a date range, e.g. to seed a fresh node with the full history:
 
-    from src.UKGridConnection import UKGridConnection
-    from datetime import datetime
-    from dateutil.relativedelta import relativedelta
-    import pandas as pd
-
-    price_regions = {
-        "Yorkshire": 23,
-        "London": 12,
-        "East England": 10,  # Eastern England
-        "East Midlands": 11,
-        "North Wales": 13,  # North Wales & Mersey
-        "West Midlands": 14,  # Midlands
-        "North Scotland": 17,  # Northern Scotland
-        "South Scotland": 18,  # Southern Scotland
-        "South England": 20,  # Southern
-        "South Wales": 21,
-        "South West England": 22,  # South Western
-        "South East England": 19,  # South East
-        "North East England": 15,  # North East
-        "North West England": 16,  # North West
-    }
-
-    # # Unspecified Regions (Regions we offer in the UI as options but are not defined by our source of data)
-    # "England" : 20,  # England is considered the same as South England (Southern)
-    # "Scotland" : 16, # Scotland is considered the same as South Scotland
-    # "Wales" : 21,    # Wales is considered the same as South Wales
-
-    voltage_levels = {  # Used for energy price data
-        "Low Voltage: <1kV": "LV",
-        "LV Substation: <1kV": "LV-Sub",
-        "High Voltage: <22kV": "HV",
-    }
-    grid = UKGridConnection()
-
-    # Do monthly batches from Jan-2019 till last month on all categories
-    from_time = datetime(2019, 1, 1)
-    to_time = from_time + relativedelta(months=1)
-
-    # 41 combinations per month.
-    # We have forecasts up to end of next year. (if we are in April 2023, the last day we can query is Dec-2024)
-    sample_data = [
-        {
-            "from": from_time,
-            "to": to_time,
-            "region": region,
-            "voltage_level": voltage_level,
-        }
-        for region in price_regions.keys()
-        for voltage_level in voltage_levels.keys()
+    python src/build_cache.py --from 2017-04-01 --to 2025-04-01 --co2
+
+The work is split into (series, month) units fetched by a bounded pool of workers. Every
+completed unit is recorded in a checkpoint file, so an interrupted backfill resumes where it
+stopped when run again, and the cache is compacted as the backfill goes.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from src.cache_store import months_between
+
+price_regions = {
+    "Yorkshire": 23,
+    "London": 12,
+    "East England": 10,  # Eastern England
+    "East Midlands": 11,
+    "North Wales": 13,  # North Wales & Mersey
+    "West Midlands": 14,  # Midlands
+    "North Scotland": 17,  # Northern Scotland
+    "South Scotland": 18,  # Southern Scotland
+    "South England": 20,  # Southern
+    "South Wales": 21,
+    "South West England": 22,  # South Western
+    "South East England": 19,  # South East
+    "North East England": 15,  # North East
+    "North West England": 16,  # North West
+}
+
+# # Unspecified Regions (Regions we offer in the UI as options but are not defined by our source of data)
+# "England" : 20,  # England is considered the same as South England (Southern)
+# "Scotland" : 16, # Scotland is considered the same as South Scotland
+# "Wales" : 21,    # Wales is considered the same as South Wales
+
+voltage_levels = {  # Used for energy price data
+    "Low Voltage: <1kV": "LV",
+    "LV Substation: <1kV": "LV-Sub",
+    "High Voltage: <22kV": "HV",
+}
+
+
+class Checkpoint:
+    """
+    Completed backfill units, one JSON line per unit appended to a file (flushed to disk as
+    soon as the unit completes), e.g.
+
+        {"cache": "price", "series": ["Yorkshire", "Low Voltage: <1kV"], "month": "2019-01",
+         "from": "2019-01-01T00:00:00+00:00", "to": "2019-02-01T00:00:00+00:00"}
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.done = set()
+        self._lock = threading.Lock()
+        if self.path.exists():
+            for line in self.path.read_text().splitlines():
+                try:
+                    self.done.add(self.unit_key(json.loads(line)))
+                except (ValueError, KeyError):
+                    pass  # Line cut short by a crash
+
+    @staticmethod
+    def unit_key(unit: dict) -> tuple:
+        return (
+            unit["cache"],
+            tuple(unit["series"]),
+            unit["month"],
+            pd.Timestamp(unit["from"]).isoformat(),
+            pd.Timestamp(unit["to"]).isoformat(),
+        )
+
+    def __contains__(self, unit: dict) -> bool:
+        return self.unit_key(unit) in self.done
+
+    def add(self, unit: dict):
+        key = self.unit_key(unit)
+        line = json.dumps(dict(zip(["cache", "series", "month", "from", "to"], key)))
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a") as file:
+                file.write(line + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self.done.add(key)
+
+
+def backfill_units(
+    from_time, to_time, regions: list, voltages: list, co2: bool = False
+) -> list:
+    """(series, month) units of a backfill, each covering the part of from_time-to_time in
+    its month.
+
+    Returns:
+        list: [{"cache": "price"|"co2", "series": [...], "month": "YYYY-MM", "from":, "to":}]
+    """
+    from_time, to_time = [
+        pd.to_datetime(t, utc=True) for t in (from_time, to_time)
+    ]  # Naive times are UTC
+    series = [
+        ("price", [region, voltage]) for region in regions for voltage in voltages
     ]
-    df = pd.DataFrame(sample_data)
-    grid.get_price(df)
+    if co2:
+        series += [("co2", [region, "NA"]) for region in regions]
+        series.append(("co2", ["NA", "NA"]))  # National
+    units = []
+    for month in months_between(from_time, to_time - pd.Timedelta(minutes=30)):
+        start = pd.Timestamp(month, tz="UTC")
+        end = start + pd.DateOffset(months=1)
+        for cache, key in series:
+            units.append(
+                {
+                    "cache": cache,
+                    "series": key,
+                    "month": month,
+                    "from": max(start, from_time),
+                    "to": min(end, to_time),
+                }
+            )
+    return units
+
+
+def backfill(
+    grid,
+    from_time,
+    to_time,
+    regions: list = None,
+    voltages: list = None,
+    co2: bool = False,
+    workers: int = 4,
+    checkpoint: Path = None,
+    compact_every: int = 50,
+) -> dict:
+    """
+    Fetches the data of every (series, month) unit missing from the cache with a pool of
+    workers, recording completed units in the checkpoint (units already recorded are
+    skipped) and compacting the cache every compact_every completed units and at the end.
+    Failed units are logged and left for the next run. Units with data known to be
+    unavailable (outside the dataset, or not returned by the API, see
+    UKGridConnection.fill_cache_gaps) are counted apart and not checkpointed either: the
+    next run does not request them again until the unavailable ranges expire.
+
+    Args:
+        grid (UKGridConnection): Connection to backfill (ideally lazy, see __init__)
+        from_time (datetime): Start of the backfill (UTC)
+        to_time (datetime): End of the backfill (UTC, excluded)
+        regions (list): Regions (default: all of price_regions)
+        voltages (list): Voltage levels (default: all of voltage_levels)
+        co2 (bool): Also backfill the CO2 intensities of the regions and national
+        workers (int): Units fetched at the same time
+        checkpoint (Path): Checkpoint file (default: backfill.checkpoint.jsonl in the cache)
+        compact_every (int): Completed units between compactions (0: only at the end)
+
+    Returns:
+        dict: Number of units, skipped (already done), completed, unavailable and failed
+    """
+    regions = list(price_regions) if regions is None else regions
+    voltages = list(voltage_levels) if voltages is None else voltages
+    checkpoint = Checkpoint(
+        checkpoint or grid.co2_cache_path.parent / "backfill.checkpoint.jsonl"
+    )
+    units = backfill_units(from_time, to_time, regions, voltages, co2)
+    todo = [unit for unit in units if unit not in checkpoint]
+    logging.info(f"Backfilling {len(todo)} of {len(units)} units")
+
+    def run(unit):
+        series_ranges = pd.DataFrame(
+            {"from_time": [unit["from"]], "to_time": [unit["to"]]},
+            index=pd.MultiIndex.from_tuples([tuple(unit["series"])]),
+        )
+        if unit["cache"] == "price":
+            return grid.fill_price_gaps(series_ranges)
+        return grid.fill_co2_gaps(series_ranges)
+
+    stats = {"units": len(units), "skipped": len(units) - len(todo)}
+    stats.update(completed=0, unavailable=0, failed=0)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(run, unit): unit for unit in todo}
+        for future in as_completed(futures):
+            unit = futures[future]
+            try:
+                unavailable = future.result()
+            except Exception:
+                logging.exception(f"Backfill of {unit} failed")
+                stats["failed"] += 1
+                continue
+            if unavailable:
+                logging.info(f"Data of {unit} is not available")
+                stats["unavailable"] += 1
+                continue
+            checkpoint.add(unit)
+            stats["completed"] += 1
+            if compact_every and stats["completed"] % compact_every == 0:
+                grid.compact_cache()
+    grid.compact_cache()
+    logging.info(f"Backfill finished: {stats}")
+    return stats
+
+
+def voltage_name(voltage: str) -> str:
+    """Voltage level of voltage_levels from its name or its short name (LV, LV-Sub, HV)."""
+    short_names = {short: name for name, short in voltage_levels.items()}
+    return short_names.get(voltage, voltage)
+
+
+def main(args=None) -> int:
+    from src.UKGridConnection import UKGridConnection
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--from", dest="from_time", required=True, help="YYYY-MM-DD")
+    parser.add_argument(
+        "--to", dest="to_time", required=True, help="YYYY-MM-DD (excluded)"
+    )
+    parser.add_argument("--regions", nargs="+", choices=list(price_regions))
+    parser.add_argument(
+        "--voltages", nargs="+", choices=[*voltage_levels, *voltage_levels.values()]
+    )
+    parser.add_argument(
+        "--co2", action="store_true", help="Also backfill CO2 intensities"
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--compact-every", type=int, default=50)
+    parser.add_argument("--checkpoint", type=Path)
+    parser.add_argument("--cache-path", type=Path)
+    args = parser.parse_args(args)
+
+    kwargs = {"cache_path": args.cache_path} if args.cache_path else {}
+    grid = UKGridConnection(lazy=True, **kwargs)
+    stats = backfill(
+        grid,
+        datetime.fromisoformat(args.from_time),
+        datetime.fromisoformat(args.to_time),
+        regions=args.regions,
+        voltages=[voltage_name(v) for v in args.voltages] if args.voltages else None,
+        co2=args.co2,
+        workers=args.workers,
+        checkpoint=args.checkpoint,
+        compact_every=args.compact_every,
+    )
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
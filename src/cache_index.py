@@ -0,0 +1,288 @@
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+
+
+class SeriesIndex:
+    """
+    Sorted time index over the series of an in-memory cache (e.g. one series per
+    (region, voltage) in the price cache).
+
+    For every series it holds the sorted int64 "from" timestamps [ns] and the matching row
+    labels of the cache, so coverage checks and range slicing are binary searches instead of
+    boolean masks over the whole cache.
+
+    Cache rows must keep their index labels when new data is merged (see LatestRows), then
+    only the merged series need to be invalidated; they are rebuilt on next use.
+    """
+
+    def __init__(self, key_cols: list):
+        self.key_cols = list(key_cols)
+        self.series: dict = {}  # key -> (sorted from [ns], row labels)
+        self.complete: bool = False  # False: every series is rebuilt on next use
+        self.stale: set = set()  # Series rebuilt on next use
+        self.next_label = 0  # Labels from here on were added since the last refresh
+
+    def invalidate(self, keys=None):
+        """Invalidates the given series keys (all of them if keys is None)."""
+        if keys is None:
+            self.series = {}
+            self.stale = set()
+            self.complete = False
+            self.next_label = 0  # The cache may be replaced with fresh labels
+        else:
+            self.stale.update(keys)
+
+    @staticmethod
+    def _sorted_series(cache: pd.DataFrame, labels: np.ndarray):
+        from_ns = cache.loc[labels, "from"].values.astype("int64")
+        order = np.argsort(from_ns, kind="stable")
+        return from_ns[order], labels[order]
+
+    def _refresh(self, cache: pd.DataFrame):
+        end_label = cache.index.max() + 1 if len(cache) else 0
+        if not self.complete:
+            self.series = {}
+            groups = cache.groupby(self.key_cols, observed=True, sort=False).indices
+            for key, positions in groups.items():
+                self.series[key] = self._sorted_series(
+                    cache, cache.index.values[positions]
+                )
+            self.complete = True
+            self.stale = set()
+        if self.stale:
+            # Stale series = their rows still in the cache + the rows added since the
+            # last refresh (LatestRows never reuses the label of a cached row), so only
+            # those rows are looked up instead of masking the whole cache per series
+            positions = cache.index.get_indexer(np.arange(self.next_label, end_label))
+            added = cache.iloc[positions[positions >= 0]]
+            groups = added.groupby(self.key_cols, observed=True, sort=False).indices
+            for key in self.stale:
+                labels = added.index.values[groups.get(key, [])]
+                if key in self.series:
+                    kept = self.series[key][1]
+                    kept = kept[cache.index.get_indexer(kept) >= 0]
+                    labels = np.concatenate([kept, labels])
+                if len(labels):
+                    self.series[key] = self._sorted_series(cache, labels)
+                else:
+                    self.series.pop(key, None)
+        self.stale = set()
+        self.next_label = max(self.next_label, end_label)
+
+    def lookup(self, cache: pd.DataFrame, key: tuple):
+        """Sorted "from" timestamps [ns] and row labels of a series (None if not cached)."""
+        if not self.complete or self.stale:
+            self._refresh(cache)
+        return self.series.get(key)
+
+    def bounds(self, cache: pd.DataFrame, key: tuple):
+        """First "from" and last "to" available for a series (None if not cached)."""
+        series = self.lookup(cache, key)
+        if series is None:
+            return None
+        _, labels = series
+        return cache.at[labels[0], "from"], cache.at[labels[-1], "to"]
+
+    def slice(
+        self, cache: pd.DataFrame, key: tuple, from_time, to_time
+    ) -> pd.DataFrame:
+        """Cached rows of a series with from_time <= from and to <= to_time (sorted by from)."""
+        series = self.lookup(cache, key)
+        if series is None:
+            return cache.iloc[0:0]
+        from_ns, labels = series
+        left, right = np.searchsorted(
+            from_ns, [pd.Timestamp(from_time).value, pd.Timestamp(to_time).value]
+        )
+        rows = cache.loc[labels[left:right]]
+        return rows[rows["to"] <= to_time]
+
+    def missing_ranges(
+        self,
+        cache: pd.DataFrame,
+        key: tuple,
+        from_time,
+        to_time,
+        max_span: timedelta,
+        slot: timedelta = timedelta(minutes=30),
+        expired=None,
+    ) -> list:
+        """
+        Works out which slots between from_time and to_time are missing from a series and
+        groups them into the fewest (start, end) ranges no longer than max_span, e.g. the
+        API calls needed to fill the gaps.
+
+        expired(cache, labels) -> bool array optionally flags cached rows of the window that
+        count as missing, e.g. forecasts to fetch again.
+        """
+        slot_ns = int(slot.total_seconds() * 10**9)
+        max_span_ns = int(max_span.total_seconds() * 10**9)
+        start_ns = pd.Timestamp(from_time).value // slot_ns * slot_ns  # Floor to slot
+        end_ns = pd.Timestamp(to_time).value
+        expected = np.arange(start_ns, end_ns, slot_ns)
+        series = self.lookup(cache, key)
+        if series is not None:
+            from_ns, labels = series
+            left, right = np.searchsorted(from_ns, [start_ns, end_ns])
+            cached = from_ns[left:right]  # Cached slots of the window only
+            if expired is not None and right > left:
+                cached = cached[~expired(cache, labels[left:right])]
+            expected = expected[~np.isin(expected, cached, assume_unique=True)]
+        ranges = []
+        i = 0
+        while i < len(expected):
+            # Greedy: every range covers as many missing slots as max_span allows
+            j = np.searchsorted(expected, expected[i] + max_span_ns - slot_ns, "right")
+            ranges.append(
+                (
+                    pd.Timestamp(expected[i], tz="UTC"),
+                    pd.Timestamp(expected[j - 1] + slot_ns, tz="UTC"),
+                )
+            )
+            i = j
+        return ranges
+
+    def overlapping_labels(
+        self, cache: pd.DataFrame, key: tuple, from_time, to_time
+    ) -> np.ndarray:
+        """Row labels of the cached rows of a series overlapping from_time-to_time (sorted by
+        from), including the row starting before from_time."""
+        series = self.lookup(cache, key)
+        if series is None:
+            return cache.index.values[0:0]
+        from_ns, labels = series
+        left = np.searchsorted(from_ns, pd.Timestamp(from_time).value, "right") - 1
+        right = np.searchsorted(from_ns, pd.Timestamp(to_time).value, "left")
+        return labels[max(left, 0) : right]
+
+    def overlapping(
+        self, cache: pd.DataFrame, key: tuple, from_time, to_time
+    ) -> pd.DataFrame:
+        """Cached rows of a series overlapping from_time-to_time (sorted by from), including
+        the row starting before from_time."""
+        return cache.loc[self.overlapping_labels(cache, key, from_time, to_time)]
+
+
+class SeriesCodes:
+    """Integer codes of the series of a cache (e.g. (region, voltage) -> 0, 1, ...),
+    assigned the first time each series is seen."""
+
+    def __init__(self):
+        self.codes: dict = {}  # key -> code
+
+    def encode(self, data: pd.DataFrame, key_cols: list) -> np.ndarray:
+        """Series code of every row of data [int64]."""
+        codes = np.empty(len(data), dtype="int64")
+        groups = data.groupby(key_cols, observed=True, sort=False).indices
+        for key, positions in groups.items():
+            codes[positions] = self.codes.setdefault(key, len(self.codes))
+        return codes
+
+
+def row_keys(series_codes: np.ndarray, from_time: pd.Series) -> np.ndarray:
+    """
+    int64 row keys: series code in the high 32 bits and unix time [s] of "from" in the low
+    32 bits, the integer counterpart of the string ids (e.g. NORTH_SCOTLAND_LV_1577836800).
+    """
+    seconds = from_time.values.astype("datetime64[s]").astype("int64")
+    return (series_codes.astype("int64") << 32) + seconds
+
+
+def latest_positions(keys: np.ndarray, created: np.ndarray) -> np.ndarray:
+    """Positions of the latest row ("created") of every key, sorted by key. Ties go to the
+    last row, so rows appended later win."""
+    order = np.lexsort((created, keys))
+    sorted_keys = keys[order]
+    is_last = np.ones(len(order), dtype=bool)
+    is_last[:-1] = sorted_keys[1:] != sorted_keys[:-1]
+    return order[is_last]
+
+
+class LatestRows:
+    """
+    In-memory cache keeping only the latest fetch ("created") of every row key, together
+    with its SeriesIndex.
+
+    Merged rows are only checked against the cached rows of their own series (found with
+    the index) and are kept as pending chunks: the cache frame is rebuilt once when it is
+    next read (see frame) instead of on every merge, e.g. when lazy loading merges the
+    partitions of one series at a time.
+
+    Cache rows keep their index labels and new rows get fresh ones, so the index only
+    rebuilds the series present in the merged data.
+    """
+
+    def __init__(self, cache: pd.DataFrame, index: SeriesIndex):
+        self.cache = cache
+        self.index = index
+        self.index.invalidate()
+        self.pending: list = []  # New rows not in cache yet
+        self.superseded: list = []  # Labels of cache rows replaced by pending rows
+        self.stale: set = set()  # Series of the pending rows
+        self.next_label = cache.index.max() + 1 if len(cache) else 0
+
+    def merge(self, data: pd.DataFrame) -> list:
+        """Merges new rows (same columns as the cache).
+
+        Returns:
+            list: Series keys of the new rows
+        """
+        if len(data) == 0:
+            return []
+        data = data.copy(deep=False)
+        data.index = pd.RangeIndex(self.next_label, self.next_label + len(data))
+        self.next_label += len(data)
+        keep = np.ones(len(data), dtype=bool)
+        from_ns = data["from"].values.astype("int64")
+        created = data["created"].values
+        groups = data.groupby(self.index.key_cols, observed=True, sort=False).indices
+        for key, positions in groups.items():
+            series = self.index.lookup(self.cache, key)
+            if series is None:
+                continue
+            cached_from, labels = series
+            left = np.searchsorted(cached_from, from_ns[positions], "left")
+            counts = np.searchsorted(cached_from, from_ns[positions], "right") - left
+            # Every (new row, cached row) pair with the same from
+            rows = np.repeat(positions, counts)
+            offsets = np.arange(len(rows)) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            old = labels[np.repeat(left, counts) + offsets]
+            newer = self.cache.loc[old, "created"].values > created[rows]
+            keep[rows[newer]] = False  # Ties go to the new rows
+            self.superseded.append(old[~newer])
+        self.pending.append(data[keep])
+        self.stale.update(groups)
+        return list(groups)
+
+    def frame(self) -> pd.DataFrame:
+        """The cache with the pending rows merged in."""
+        if not self.pending:
+            return self.cache
+        cache = self.cache
+        if self.superseded:
+            cache = cache.drop(np.unique(np.concatenate(self.superseded)))
+        else:
+            cache = cache.copy(deep=False)
+        # Keep categorical dtypes (pd.concat falls back to object if categories differ)
+        pending = [chunk.copy(deep=False) for chunk in self.pending]
+        for col in cache.select_dtypes("category").columns:
+            new_labels = pd.Index(
+                pd.concat([pd.Series(chunk[col].unique()) for chunk in pending])
+            ).unique()
+            cache[col] = cache[col].cat.add_categories(
+                new_labels.difference(cache[col].cat.categories)
+            )
+            for chunk in pending:
+                chunk[col] = pd.Categorical(
+                    chunk[col], categories=cache[col].cat.categories
+                )
+        data = pd.concat(pending) if len(pending) > 1 else pending[0]
+        # Pending rows of the same key: the latest one, ties go to the last merged
+        data = data.iloc[latest_positions(data["key"].values, data["created"].values)]
+        self.cache = pd.concat([cache, data])
+        self.index.invalidate(self.stale)
+        self.pending, self.superseded, self.stale = [], [], set()
+        return self.cache
@@ -0,0 +1,404 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.cache_index import SeriesCodes, latest_positions, row_keys
+from src.file_lock import FileLock
+
+
+def write_cache_file(table: pa.Table, path: Path):
+    """Writes a cache file atomically (temporary hidden file + rename) so readers, in this or
+    any other process, never see a half-written file.
+
+    Timestamps are half-hourly and sorted within a series, so they are delta encoded instead
+    of dictionary encoded (which roughly halves the file size).
+    """
+    timestamp_cols = [f.name for f in table.schema if pa.types.is_timestamp(f.type)]
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+    pq.write_table(
+        table,
+        tmp_path,
+        compression="snappy",
+        use_dictionary=[c for c in table.column_names if c not in timestamp_cols],
+        column_encoding={c: "DELTA_BINARY_PACKED" for c in timestamp_cols},
+    )
+    os.replace(tmp_path, path)
+
+
+def months_between(from_time, to_time) -> list:
+    """Month partitions (YYYY-MM) overlapping from_time-to_time."""
+    months = pd.period_range(
+        pd.Timestamp(from_time).tz_localize(None).to_period("M"),
+        pd.Timestamp(to_time).tz_localize(None).to_period("M"),
+        freq="M",
+    )
+    return [str(m) for m in months]
+
+
+def keep_latest(data: pd.DataFrame, series_cols: list) -> pd.DataFrame:
+    """Latest fetch ("created") of every row of every series (sorted by series and from),
+    deduplicated with a sort over int64 row keys (see row_keys)."""
+    keys = row_keys(SeriesCodes().encode(data, series_cols), data["from"])
+    return data.iloc[latest_positions(keys, data["created"].values)].reset_index(
+        drop=True
+    )
+
+
+def hot_schema(schema: pa.Schema, types: dict = None) -> pa.Schema:
+    """
+    Schema of a hot cache file: the in-memory layout of the cache, i.e. without the string
+    ids, timestamps in ns (so pandas can use them without copy) and the smaller value types
+    given in types ({column: numpy dtype}).
+    """
+    types = types or {}
+    fields = []
+    for f in schema:
+        if f.name == "id":
+            continue
+        if pa.types.is_timestamp(f.type):
+            f = pa.field(f.name, pa.timestamp("ns", tz=f.type.tz))
+        elif f.name in types:
+            f = pa.field(f.name, pa.from_numpy_dtype(np.dtype(types[f.name])))
+        fields.append(f)
+    return pa.schema(fields)
+
+
+class PartitionedCache:
+    """
+    Local storage of a cache as a hive-partitioned Parquet dataset, e.g. for prices:
+
+        price/region=Yorkshire/voltage=Low%20Voltage%3A%20%3C1kV/month=2019-01/price_<ns>.parquet.snappy
+
+    Every fetch writes one file into each partition it touches. Reads push the partition
+    filters (series and months) down to the dataset, so only the files of the requested
+    partitions are opened: read time scales with the query, not with the cached history.
+    Files keep all the columns of the schema, the directories only serve for pruning.
+
+    compact() merges the small fetch files of each partition into its consolidated file.
+
+    Several processes can share a dataset: files are published atomically under unique
+    names, compactions of a partition are serialised by a file lock, and fetch_lease lets
+    one process at a time fetch the data of a partition (see FileLock). Lock files live in
+    the hidden .locks folder.
+
+    Optionally, a hot cache file (<prefix>_hot.arrow) holds the whole deduplicated history
+    as an uncompressed Arrow IPC (Feather v2) file, see write_hot/read_hot.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        schema: pa.Schema,
+        partition_cols: list,
+        prefix: str,
+        consolidated_name: str = None,
+        hot_types: dict = None,
+    ):
+        """
+        Args:
+            path (Path): Root folder of the dataset
+            schema (pyarrow.Schema): Schema of the cache files
+            partition_cols (list): Columns of the series partitions (month is always added)
+            prefix (str): Prefix of the file names (e.g. "price")
+            consolidated_name (str): File name of the compacted data of a partition
+            hot_types (dict): Smaller value types of the hot cache file ({column: dtype})
+        """
+        self.path = Path(path)
+        self.schema = schema
+        self.partition_cols = list(partition_cols)
+        self.prefix = prefix
+        self.consolidated_name = (
+            consolidated_name or f"Consolidated_{prefix}_Cache.parquet.snappy"
+        )
+        self.hot_types = hot_types or {}
+        self._compact_lock = threading.Lock()  # One compaction at a time
+        self.partitioning = ds.partitioning(
+            pa.schema([(c, pa.string()) for c in self.partition_cols + ["month"]]),
+            flavor="hive",
+        )
+
+    def series_dir(self, values: tuple) -> Path:
+        """Folder of a series (values of partition_cols)."""
+        parts = [
+            f"{c}={quote(str(v), safe='')}" for c, v in zip(self.partition_cols, values)
+        ]
+        return self.path.joinpath(*parts)
+
+    def partition_dir(self, values: tuple, month: str) -> Path:
+        """Folder of a partition (values of partition_cols, YYYY-MM)."""
+        return self.series_dir(values) / f"month={month}"
+
+    def files(self, folder: Path = None) -> list:
+        """Data files of the dataset or of one of its folders (hidden temporary files
+        excluded)."""
+        folder = self.path if folder is None else folder
+        return sorted(
+            f for f in folder.rglob("*.parquet.snappy") if not f.name.startswith(".")
+        )
+
+    def split(self, table: pa.Table) -> dict:
+        """Splits a table into its partitions: {(values, month): table}"""
+        keys = table.select(self.partition_cols).to_pandas()
+        keys["month"] = pc.strftime(table["from"], "%Y-%m").to_numpy()
+        groups = keys.groupby(self.partition_cols + ["month"], observed=True, sort=True)
+        return {
+            (tuple(key[:-1]), key[-1]): table.take(pa.array(positions))
+            for key, positions in groups.indices.items()
+        }
+
+    def write(self, table: pa.Table, name: str = None) -> list:
+        """Writes a table (in the cache schema) into its partitions, one file per partition.
+
+        Args:
+            table (pyarrow.Table): Data to store
+            name (str): File name, defaults to <prefix>_<time in ns>.parquet.snappy
+
+        Returns:
+            list: Written files
+        """
+        name = name or (
+            f"{self.prefix}_{time.time_ns()}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+            ".parquet.snappy"
+        )
+        written = []
+        for (values, month), part in self.split(table).items():
+            folder = self.partition_dir(values, month)
+            folder.mkdir(parents=True, exist_ok=True)
+            write_cache_file(part, folder / name)
+            written.append(folder / name)
+        return written
+
+    def read(self, series: dict = None, months: list = None) -> pa.Table:
+        """Reads the cache files of the partitions matching the filters.
+
+        Args:
+            series (dict): {partition column: value} filters, e.g. {"region": "London"}
+            months (list): Only read these months (YYYY-MM, see months_between)
+
+        Returns:
+            pyarrow.Table: Data in the cache schema (not deduplicated)
+        """
+        series = series or {}
+        condition = None
+        for col, value in series.items():
+            condition = self._and(condition, ds.field(col) == str(value))
+        if months is not None:
+            condition = self._and(condition, ds.field("month").isin(months))
+        for attempt in range(3):
+            files = self._files_to_read(series, months)
+            if not files:
+                return self.schema.empty_table()
+            try:
+                return self._dataset(files).to_table(
+                    columns=self.schema.names, filter=condition
+                )
+            except FileNotFoundError:
+                # Absorbed by a compaction after listing: its output is listed next time
+                if attempt == 2:
+                    raise
+
+    def _files_to_read(self, series: dict, months: list) -> list:
+        if set(series) >= set(self.partition_cols):
+            # Whole series requested: only list the folders of its partitions
+            series_dir = self.series_dir([series[c] for c in self.partition_cols])
+            folders = (
+                [series_dir]
+                if months is None
+                else [series_dir / f"month={month}" for month in months]
+            )
+            return [
+                str(f)
+                for folder in folders
+                if folder.is_dir()
+                for f in self.files(folder)
+            ]
+        return [str(f) for f in self.files()]
+
+    def _dataset(self, files: list) -> ds.Dataset:
+        return ds.dataset(
+            files,
+            format="parquet",
+            schema=self.schema.append(pa.field("month", pa.string())),
+            partitioning=self.partitioning,
+            partition_base_dir=str(self.path),
+        )
+
+    def compact_partition(self, folder: Path, remove_inputs: bool = True) -> int:
+        """Merges the files of a partition into its consolidated file, keeping the latest
+        fetch of every id. The output is written atomically before the absorbed inputs are
+        removed; files written meanwhile are left for the next compaction.
+
+        Returns:
+            int: Number of files absorbed (0 if the partition was already compacted or is
+                being compacted by another process)
+        """
+        lock = FileLock(self.lock_path("compact", folder))
+        if not lock.acquire(blocking=False):
+            return 0
+        try:
+            return self._compact_partition(folder, remove_inputs)
+        finally:
+            lock.release()
+
+    def _compact_partition(self, folder: Path, remove_inputs: bool) -> int:
+        output = folder / self.consolidated_name
+        inputs = self.files(folder)
+        if not inputs or inputs == [output]:
+            return 0
+        data = self._dataset([str(f) for f in inputs]).to_table(
+            columns=self.schema.names
+        )
+        data = keep_latest(data.to_pandas(), self.partition_cols)
+        write_cache_file(
+            pa.Table.from_pandas(data, schema=self.schema, preserve_index=False), output
+        )
+        if remove_inputs:
+            for file in inputs:
+                if file != output:
+                    file.unlink(missing_ok=True)
+        return len(inputs)
+
+    def compact(self, remove_inputs: bool = True) -> dict:
+        """Incremental compaction: only the partitions holding new fetch files (anything but
+        their consolidated file) are read and rewritten.
+
+        Returns:
+            dict: {"partitions": partitions compacted, "files": files absorbed}
+        """
+        with self._compact_lock:
+            folders = sorted(
+                {f.parent for f in self.files() if f.name != self.consolidated_name}
+            )
+            absorbed = [self.compact_partition(f, remove_inputs) for f in folders]
+        if folders:
+            logging.info(
+                f"Compacted {sum(absorbed)} {self.prefix} files in {len(folders)} partitions"
+            )
+        return {"partitions": len(folders), "files": sum(absorbed)}
+
+    @property
+    def schema_marker(self) -> Path:
+        return self.path / ".schema"
+
+    def schema_is_current(self) -> bool:
+        """True if every file of the dataset is known to be written with self.schema."""
+        return (
+            self.schema_marker.exists()
+            and self.schema_marker.read_text() == self.schema.to_string()
+        )
+
+    def mark_schema_current(self):
+        """Records that every file of the dataset is written with self.schema."""
+        self.schema_marker.write_text(self.schema.to_string())
+
+    @property
+    def hot_path(self) -> Path:
+        return self.path / f"{self.prefix}_hot.arrow"
+
+    def write_hot(self, only_if_stale: bool = False) -> Path:
+        """
+        Writes the hot cache file: the latest fetch of every row (sorted by series and from)
+        in the in-memory layout (see hot_schema) as an uncompressed Arrow IPC file, written
+        atomically. The time the snapshot started is
+        kept in its metadata, so read_hot can pick up the files written after it.
+
+        Args:
+            only_if_stale (bool): Skip the rewrite if no file was written since the snapshot
+                of the current hot cache file (checked holding the lock, so processes
+                finding the same stale file rewrite it once)
+        """
+        with FileLock(self.path / ".locks" / "hot.lock"):
+            if only_if_stale and self.hot_path.exists() and not self.newer_files():
+                return self.hot_path
+            snapshot_ns = time.time_ns()
+            data = keep_latest(self.read().to_pandas(), self.partition_cols)
+            data = data.drop(columns="id").astype(self.hot_types)
+            schema = hot_schema(self.schema, self.hot_types).with_metadata(
+                {"snapshot_ns": str(snapshot_ns)}
+            )
+            table = pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+            tmp_path = self.hot_path.with_name(
+                f".{self.hot_path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+            )
+            with pa.OSFile(str(tmp_path), "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp_path, self.hot_path)
+        logging.info(f"Wrote {self.hot_path} ({table.num_rows} rows)")
+        return self.hot_path
+
+    def newer_files(self) -> list:
+        """Data files written after the snapshot of the hot cache file (all of them if
+        there is no hot cache file)."""
+        if not self.hot_path.exists():
+            return self.files()
+        with pa.memory_map(str(self.hot_path), "r") as source:
+            metadata = pa.ipc.open_file(source).schema.metadata
+        snapshot_ns = int(metadata[b"snapshot_ns"])
+        return [f for f in self.files() if f.stat().st_mtime_ns >= snapshot_ns]
+
+    def read_hot(self, refresh: bool = False):
+        """
+        Memory-maps the hot cache file read-only: its buffers are backed by the page cache,
+        so every process mapping it shares the same physical memory and nothing is decoded.
+
+        Args:
+            refresh (bool): Rewrite the hot cache file first if files were written since
+                its snapshot (see write_hot), so their rows are mapped too instead of being
+                merged into a private copy of the cache by every process
+
+        Returns:
+            tuple(pyarrow.Table, pyarrow.Table): (hot cache, data of the files written
+                since its snapshot) or None if there is no hot cache file
+        """
+        if not self.hot_path.exists():
+            return None
+        if refresh and self.newer_files():
+            self.write_hot(only_if_stale=True)
+        hot = pa.ipc.open_file(pa.memory_map(str(self.hot_path), "r")).read_all()
+        snapshot_ns = int(hot.schema.metadata[b"snapshot_ns"])
+        newer = [str(f) for f in self.files() if f.stat().st_mtime_ns >= snapshot_ns]
+        newer_data = (
+            self._dataset(newer).to_table(columns=self.schema.names)
+            if newer
+            else self.schema.empty_table()
+        )
+        return hot, newer_data
+
+    def lock_path(self, kind: str, folder: Path) -> Path:
+        """Lock file of a kind of operation (e.g. "fetch") on a folder of the dataset."""
+        relative = folder.relative_to(self.path).as_posix()
+        digest = hashlib.sha1(relative.encode()).hexdigest()[:16]
+        return self.path / ".locks" / f"{kind}-{digest}.lock"
+
+    @contextmanager
+    def fetch_lease(self, partitions: list):
+        """
+        Holds the fetch leases of the given partitions [(values, month)]: other processes
+        asking for any of them wait until they are released. Leases are taken in sorted
+        order so that workers asking for overlapping partitions cannot deadlock.
+        """
+        with ExitStack() as stack:
+            for values, month in sorted(set(partitions)):
+                lock = FileLock(
+                    self.lock_path("fetch", self.partition_dir(values, month))
+                )
+                stack.enter_context(lock)
+            yield
+
+    @staticmethod
+    def _and(condition, other):
+        return other if condition is None else condition & other
@@ -0,0 +1,73 @@
+import os
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """
+    Exclusive lock shared by every process (and thread) using the same lock file.
+
+    It relies on OS locks (flock, or msvcrt.locking on Windows) held on an open file, so a
+    lock is released automatically if its holder dies: there are no stale lock files to clean
+    up. Each FileLock object is meant to be used by a single thread at a time.
+    """
+
+    def __init__(self, path: Path, poll_interval: float = 0.05):
+        """
+        Args:
+            path (Path): Lock file (created if it does not exist)
+            poll_interval (float): Seconds between attempts while waiting for the lock
+        """
+        self.path = Path(path)
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def _try_lock(self, fd: int) -> bool:
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def acquire(self, blocking: bool = True, timeout: float = None) -> bool:
+        """Takes the lock, waiting for it if blocking (at most timeout seconds if given).
+
+        Returns:
+            bool: True if the lock was taken
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._try_lock(fd):
+            if not blocking or (deadline is not None and time.monotonic() > deadline):
+                os.close(fd)
+                return False
+            time.sleep(self.poll_interval)
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
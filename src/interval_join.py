@@ -0,0 +1,131 @@
+import numpy as np
+
+ns_per_hour = 3600 * 10**9
+
+
+def interval_integrals(
+    slot_from,
+    slot_to,
+    values,
+    query_from,
+    query_to,
+    slot_series=None,
+    query_series=None,
+):
+    """
+    Integrates step functions (e.g. half-hourly prices or CO2 intensities) over arbitrary
+    query intervals (e.g. 1, 5, 15 or 60 minute metering intervals).
+
+    The step functions are constant over sorted, non-overlapping slots [slot_from, slot_to).
+    Each query interval [query_from, query_to) is split across the slots it overlaps using
+    prefix sums and binary searches, so no row is ever exploded into its slots:
+    O((n + m) log m) for n queries over m slots.
+
+    Several series (e.g. regions) are handled in one pass by giving the integer series of
+    every slot and query; slots must then be sorted by (series, from).
+
+    Args:
+        slot_from (numpy.ndarray): Sorted slot starts [int64 ns]
+        slot_to (numpy.ndarray): Slot ends [int64 ns]
+        values (numpy.ndarray): Slot values, shape (m,) or (m, k) (NaN for missing values)
+        query_from (numpy.ndarray): Interval starts [int64 ns]
+        query_to (numpy.ndarray): Interval ends [int64 ns]
+        slot_series (numpy.ndarray, optional): Series of each slot [int]
+        query_series (numpy.ndarray, optional): Series of each interval [int]
+
+    Returns:
+        tuple(numpy.ndarray, numpy.ndarray): Shape (n, k)
+            - integrals: Integral of the values over each interval [value * hours]
+            - covered: Hours of each interval covered by a (non-NaN) value
+    """
+    slot_from = np.asarray(slot_from, dtype="int64")
+    values = np.asarray(values, dtype="float64")
+    k = values.shape[1] if values.ndim > 1 else 1
+    if len(slot_from) == 0:
+        return np.zeros((len(query_from), k)), np.zeros((len(query_from), k))
+    values = values.reshape(len(slot_from), k)
+    slot_hours = (np.asarray(slot_to, dtype="int64") - slot_from) / ns_per_hour
+    valid = ~np.isnan(values)
+    rate = np.where(valid, values, 0.0)
+    zeros = np.zeros((1, values.shape[1]))
+    cum_integral = np.vstack([zeros, np.cumsum(rate * slot_hours[:, None], axis=0)])
+    cum_covered = np.vstack([zeros, np.cumsum(valid * slot_hours[:, None], axis=0)])
+
+    if slot_series is None:
+        slot_series = np.zeros(len(slot_from), dtype="int64")
+        query_series = np.zeros(len(query_from), dtype="int64")
+    slot_series = np.asarray(slot_series, dtype="int64")
+    query_series = np.asarray(query_series, dtype="int64")
+    # Sort key of (series, time): series * number of distinct times + rank of the time
+    times = np.unique(np.concatenate([slot_from, query_from, query_to]).astype("int64"))
+    slot_key = slot_series * len(times) + np.searchsorted(times, slot_from)
+
+    def primitive(t):
+        # Integral from the first slot up to t: whole slots before t + part of t's slot
+        t = np.asarray(t, dtype="int64")
+        t_key = query_series * len(times) + np.searchsorted(times, t)
+        k = np.searchsorted(slot_key, t_key, "right") - 1
+        last = np.clip(k, 0, None)
+        same = (k >= 0) & (slot_series[last] == query_series)
+        inside = np.clip((t - slot_from[last]) / ns_per_hour, 0, slot_hours[last])
+        # Before the first slot of its series: whole slots of the previous series only
+        inside = np.where(same, inside, np.where(k >= 0, slot_hours[last], 0.0))
+        inside = inside[:, None]
+        return (
+            cum_integral[last] + rate[last] * inside,
+            cum_covered[last] + valid[last] * inside,
+        )
+
+    integral_to, covered_to = primitive(query_to)
+    integral_from, covered_from = primitive(query_from)
+    return integral_to - integral_from, covered_to - covered_from
+
+
+def covering_slots(
+    slot_from, slot_to, query_from, slot_series=None, query_series=None
+) -> np.ndarray:
+    """Position of the slot containing the start of each query interval (-1 if none), e.g.
+    to carry labels of the slots that are not averaged. Slots are sorted as in
+    interval_integrals.
+
+    Returns:
+        numpy.ndarray: Slot positions [int64], shape (n,)
+    """
+    slot_from = np.asarray(slot_from, dtype="int64")
+    query_from = np.asarray(query_from, dtype="int64")
+    if len(slot_from) == 0:
+        return np.full(len(query_from), -1, dtype="int64")
+    if slot_series is None:
+        slot_series = np.zeros(len(slot_from), dtype="int64")
+        query_series = np.zeros(len(query_from), dtype="int64")
+    slot_series = np.asarray(slot_series, dtype="int64")
+    query_series = np.asarray(query_series, dtype="int64")
+    times = np.unique(np.concatenate([slot_from, query_from]))
+    slot_key = slot_series * len(times) + np.searchsorted(times, slot_from)
+    query_key = query_series * len(times) + np.searchsorted(times, query_from)
+    k = np.searchsorted(slot_key, query_key, "right") - 1
+    last = np.clip(k, 0, None)
+    found = (
+        (k >= 0)
+        & (slot_series[last] == query_series)
+        & (query_from < np.asarray(slot_to, dtype="int64")[last])
+    )
+    return np.where(found, k, -1)
+
+
+def time_weighted_means(integrals, covered, query_from, query_to, tolerance=1e-9):
+    """Time-weighted mean values over each interval (NaN if not fully covered).
+
+    Args:
+        integrals, covered (numpy.ndarray): Output of interval_integrals
+        query_from, query_to (numpy.ndarray): Interval limits [int64 ns]
+
+    Returns:
+        numpy.ndarray: Mean values, shape (n, k)
+    """
+    hours = (
+        np.asarray(query_to, "int64") - np.asarray(query_from, "int64")
+    ) / ns_per_hour
+    complete = covered >= hours[:, None] - tolerance
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(complete & (hours[:, None] > 0), integrals / covered, np.nan)
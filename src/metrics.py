@@ -0,0 +1,130 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+def metric_key(name: str, labels: dict) -> str:
+    """Name of a metric with its labels, e.g. api_requests{cache=price}"""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """
+    Thread-safe counters and stage timers of a UKGridConnection.
+
+    Counters (e.g. api_requests, rows_fetched, files_written) and timers (count, total and
+    max seconds of a stage, e.g. get_price, api_request, merge) are keyed by name and
+    labels. stats() returns a snapshot, prometheus() the Prometheus text exposition format.
+
+    Hooks receive every observation as hook(kind, name, value, labels) with kind "counter"
+    (value: increment) or "timer" (value: seconds), e.g. to forward them to OpenTelemetry:
+
+        metrics.add_hook(
+            lambda kind, name, value, labels: counters[name].add(value, labels)
+            if kind == "counter" else histograms[name].record(value, labels)
+        )
+    """
+
+    def __init__(self, namespace: str = "energygrid"):
+        """
+        Args:
+            namespace (str): Prefix of the Prometheus metric names
+        """
+        self.namespace = namespace
+        self.hooks = []
+        self._counters: dict = {}  # (name, labels) -> value
+        self._timers: dict = {}  # (name, labels) -> [count, total seconds, max seconds]
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Calls hook(kind, name, value, labels) on every observation."""
+        self.hooks.append(hook)
+
+    def count(self, name: str, value: float = 1, **labels):
+        """Increments a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        for hook in self.hooks:
+            hook("counter", name, value, labels)
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Records one run of a stage."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self._timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+        for hook in self.hooks:
+            hook("timer", name, seconds, labels)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Times the body of a with statement as one run of a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: {"counters": {key: value}, "timers": {key: {"count":, "total_seconds":,
+                "max_seconds":}}} with keys like api_requests{cache=price} (see metric_key)
+        """
+        with self._lock:
+            return {
+                "counters": {
+                    metric_key(name, dict(labels)): value
+                    for (name, labels), value in sorted(self._counters.items())
+                },
+                "timers": {
+                    metric_key(name, dict(labels)): {
+                        "count": count,
+                        "total_seconds": total,
+                        "max_seconds": longest,
+                    }
+                    for (name, labels), (count, total, longest) in sorted(
+                        self._timers.items()
+                    )
+                },
+            }
+
+    def prometheus(self) -> str:
+        """Counters and timers in the Prometheus text exposition format. Counters are
+        exported as <namespace>_<name>_total, timers as the summary
+        <namespace>_stage_seconds{stage="<name>"}."""
+
+        def labels_txt(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timers = sorted(self._timers.items())
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"{self.namespace}_{name}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{labels_txt(labels)} {value}")
+        if timers:
+            metric = f"{self.namespace}_stage_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for (name, labels), (count, total, _) in timers:
+                stage_labels = labels_txt((("stage", name),) + labels)
+                lines.append(f"{metric}_sum{stage_labels} {total}")
+                lines.append(f"{metric}_count{stage_labels} {count}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from src.file_lock import FileLock
+
+
+class UnavailableRanges:
+    """
+    Negative cache: time ranges of series that the API was asked for but did not return
+    (empty or short responses), so they are not requested again until they expire.
+
+    Ranges are kept per series key with an expiry time (now + ttl when recorded). If a path
+    is given they are persisted as JSON, shared by every process using the file: additions
+    are merged into the file under a FileLock and written atomically, and the file is
+    reloaded when another process changed it.
+    """
+
+    def __init__(self, path: Path = None, ttl: timedelta = timedelta(hours=6)):
+        """
+        Args:
+            path (Path): JSON file of the ranges (None: kept in memory only)
+            ttl (timedelta): Time a recorded range is considered unavailable
+        """
+        self.path = None if path is None else Path(path)
+        self.ttl = ttl
+        self._ranges: dict = {}  # key -> [(start ns, end ns, expires ns)]
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _read_file(self) -> dict:
+        try:
+            records = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+        ranges = {}
+        for key, start, end, expires in records:
+            ranges.setdefault(tuple(key), []).append((start, end, expires))
+        return ranges
+
+    def _reload(self):
+        """Reloads the file if another process changed it (call holding _lock)."""
+        if self.path is None:
+            return
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._mtime:
+            self._ranges = self._read_file()
+            self._mtime = mtime
+
+    def add(self, key: tuple, ranges: list):
+        """Records [(start, end)] of a series as unavailable for ttl."""
+        if not ranges:
+            return
+        expires = time.time_ns() + int(self.ttl.total_seconds() * 10**9)
+        new = [
+            (pd.Timestamp(start).value, pd.Timestamp(end).value, expires)
+            for start, end in ranges
+        ]
+        with self._lock:
+            if self.path is None:
+                self._ranges.setdefault(tuple(key), []).extend(new)
+                return
+            with FileLock(self.path.parent / ".locks" / f"{self.path.name}.lock"):
+                ranges = self._read_file()
+                ranges.setdefault(tuple(key), []).extend(new)
+                now = time.time_ns()
+                records = [
+                    [list(k), start, end, expires]
+                    for k, key_ranges in ranges.items()
+                    for start, end, expires in key_ranges
+                    if expires > now
+                ]
+                tmp_path = self.path.with_name(
+                    f".{self.path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+                )
+                tmp_path.write_text(json.dumps(records))
+                os.replace(tmp_path, self.path)
+                self._ranges = ranges
+                self._mtime = self.path.stat().st_mtime_ns
+
+    def subtract(self, key: tuple, ranges: list) -> tuple:
+        """Removes the unexpired unavailable ranges of a series from [(start, end)].
+
+        Returns:
+            tuple: (remaining [(start, end)], True if anything was removed)
+        """
+        with self._lock:
+            self._reload()
+            now = time.time_ns()
+            unavailable = sorted(
+                (start, end)
+                for start, end, expires in self._ranges.get(tuple(key), [])
+                if expires > now
+            )
+        if not unavailable:
+            return ranges, False
+        remaining = []
+        for start, end in ranges:
+            start_ns, end_ns = pd.Timestamp(start).value, pd.Timestamp(end).value
+            for gap_start, gap_end in unavailable:
+                if gap_end <= start_ns or gap_start >= end_ns:
+                    continue
+                if gap_start > start_ns:
+                    remaining.append((start_ns, gap_start))
+                start_ns = max(start_ns, gap_end)
+                if start_ns >= end_ns:
+                    break
+            if start_ns < end_ns:
+                remaining.append((start_ns, end_ns))
+        remaining = [
+            (pd.Timestamp(start, tz="UTC"), pd.Timestamp(end, tz="UTC"))
+            for start, end in remaining
+        ]
+        return remaining, remaining != list(ranges)
+
+    def clear(self):
+        """Forgets every unavailable range (and removes the file)."""
+        with self._lock:
+            self._ranges = {}
+            self._mtime = None
+            if self.path is not None:
+                self.path.unlink(missing_ok=True)
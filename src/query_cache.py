@@ -0,0 +1,107 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+def query_key(frame: pd.DataFrame) -> bytes:
+    """Digest of the normalized columns of a query (the index is ignored)."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(",".join(frame.columns).encode())
+    digest.update(pd.util.hash_pandas_object(frame, index=False).values.tobytes())
+    return digest.digest()
+
+
+def result_nbytes(values) -> int:
+    """Approximate size of a result column (numpy or pandas array) without converting it.
+    Object arrays (e.g. labels) also count the size of the objects they point to."""
+    if pd.api.types.is_object_dtype(values.dtype):
+        return int(pd.Series(values, copy=False).memory_usage(index=False, deep=True))
+    return values.nbytes
+
+
+class QueryCache:
+    """
+    Least recently used cache of query results, bounded by the bytes of the results.
+
+    Every result records the versions of the series it was computed from; invalidate(keys)
+    bumps the versions of updated series, so results depending on them are dropped on their
+    next lookup (and invalidate() drops everything).
+    """
+
+    def __init__(self, max_bytes: int = 64 * 2**20):
+        """
+        Args:
+            max_bytes (int): Maximum total size of the cached results (0 disables caching)
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (result, nbytes, series versions)
+        self._versions: dict = {}  # series key -> version
+        self._lock = threading.Lock()
+
+    def invalidate(self, series_keys=None):
+        """Invalidates the results depending on the given series (all if None)."""
+        with self._lock:
+            if series_keys is None:
+                self._entries.clear()
+                self.nbytes = 0
+                return
+            for key in series_keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+
+    def get(self, key: bytes):
+        """Cached result of a query (None if missing or stale)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and all(
+                self._versions.get(series, 0) == version for series, version in entry[2]
+            ):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def versions(self, series_keys) -> tuple:
+        """Current versions of series_keys, to be taken before reading them (see put)."""
+        with self._lock:
+            return tuple((s, self._versions.get(s, 0)) for s in series_keys)
+
+    def put(self, key: bytes, result: dict, versions: tuple):
+        """Caches the result of a query ({column: numpy or pandas array}) computed from the
+        series versions taken before it was computed (so a concurrent update makes it
+        stale). Nothing is done if caching is disabled (max_bytes 0)."""
+        if not self.max_bytes:
+            return
+        nbytes = sum(result_nbytes(values) for values in result.values())
+        with self._lock:
+            if nbytes > self.max_bytes:
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (result, nbytes, versions)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key: bytes):
+        _, nbytes, _ = self._entries.pop(key)
+        self.nbytes -= nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
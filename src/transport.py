@@ -0,0 +1,214 @@
+import hashlib
+import json
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+utc = timezone.utc
+
+# Transports are the only objects making requests to the APIs. Any object with a
+# get_json(url, headers) method returning the decoded JSON response can be plugged into
+# UKGridConnection(transport=...), e.g. to replay recorded responses or to run offline.
+
+
+class HTTPTransport:
+    """
+    Shared HTTP transport for both APIs: keep-alive connection pooling (one requests.Session),
+    timeouts and retries with exponential backoff on 429/5xx responses (honouring
+    Retry-After headers).
+    """
+
+    def __init__(
+        self,
+        timeout: float = 30,
+        retries: int = 5,
+        backoff_factor: float = 0.5,
+        pool_maxsize: int = 16,
+        metrics=None,
+    ):
+        """
+        Args:
+            timeout (float): Connect/read timeout of each request in seconds
+            retries (int): Maximum number of retries of a request
+            backoff_factor (float): Retry n waits backoff_factor * 2**(n-1) seconds
+            pool_maxsize (int): Connections kept alive per host (match max_workers)
+            metrics (Metrics): Counts the bytes received and the retries (see src/metrics.py)
+        """
+        self.timeout = timeout
+        self.metrics = metrics
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get_json(self, url: str, headers: dict = None, labels: dict = None) -> dict:
+        """GET request returning the decoded JSON body (raises for error status codes).
+
+        Args:
+            labels (dict): Labels of the api_bytes and api_retries counters (e.g. cache)
+        """
+        r = self.session.get(url, headers=headers, timeout=self.timeout)
+        if self.metrics is not None:
+            labels = labels or {}
+            self.metrics.count("api_bytes", len(r.content), **labels)
+            retries = getattr(r.raw, "retries", None)
+            if retries is not None and retries.history:
+                self.metrics.count("api_retries", len(retries.history), **labels)
+        r.raise_for_status()
+        return json.loads(r.text)
+
+    def close(self):
+        self.session.close()
+
+
+class ReplayTransport:
+    """
+    Serves responses recorded as JSON fixtures (one file per URL) in fixtures_path.
+
+    If a record_from transport is given, URLs without fixture are fetched from it and
+    recorded, otherwise a FileNotFoundError is raised.
+    """
+
+    def __init__(self, fixtures_path: Path, record_from=None):
+        self.fixtures_path = Path(fixtures_path)
+        self.fixtures_path.mkdir(parents=True, exist_ok=True)
+        self.record_from = record_from
+
+    def fixture_file(self, url: str) -> Path:
+        return self.fixtures_path / (hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def get_json(self, url: str, headers: dict = None) -> dict:
+        fixture = self.fixture_file(url)
+        if fixture.exists():
+            return json.loads(fixture.read_text())["response"]
+        if self.record_from is None:
+            raise FileNotFoundError(f"No recorded response for {url}")
+        response = self.record_from.get_json(url, headers=headers)
+        fixture.write_text(json.dumps({"url": url, "response": response}))
+        return response
+
+
+class FakeGridTransport:
+    """
+    Local stand-in for the price and CarbonIntensity APIs. Responses are synthesised
+    (deterministic daily profiles) in the same format as the real APIs so UKGridConnection
+    can be tested and benchmarked offline.
+    """
+
+    fuels = [
+        "biomass",
+        "coal",
+        "imports",
+        "gas",
+        "nuclear",
+        "other",
+        "hydro",
+        "solar",
+        "wind",
+    ]
+
+    def __init__(self, latency: float = 0.0):
+        """
+        Args:
+            latency (float): Seconds each response is delayed (simulates network latency)
+        """
+        self.latency = latency
+        self.requested_urls = []
+        self.in_flight = 0  # Requests being answered
+        self.max_in_flight = 0  # Most requests answered at the same time
+        self._lock = threading.Lock()
+
+    def get_json(self, url: str, headers: dict = None) -> dict:
+        with self._lock:
+            self.requested_urls.append(url)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        parsed = urlparse(url)
+        if parsed.path.endswith("/prices"):
+            return self.price_response(
+                {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            )
+        return self.intensity_response(parsed.path.strip("/").split("/"))
+
+    @staticmethod
+    def daily_wave(t: datetime) -> float:
+        return math.sin(2 * math.pi * (t.hour * 60 + t.minute) / (24 * 60))
+
+    def price_response(self, query: dict) -> dict:
+        # The API returns whole days from start (included) to end (excluded)
+        t = datetime.strptime(query["start"], "%d-%m-%Y").replace(tzinfo=utc)
+        end = datetime.strptime(query["end"], "%d-%m-%Y").replace(tzinfo=utc)
+        dno = int(query["dno"])
+        rows = []
+        while t < end:
+            rows.append(
+                {
+                    "Overall": round(10 + 5 * self.daily_wave(t) + dno / 10, 2),
+                    "unixTimestamp": int(t.timestamp()),
+                    "Timestamp": t.strftime("%H:%M %d-%m-%Y"),
+                }
+            )
+            t += timedelta(minutes=30)
+        return {
+            "status": "200",
+            "data": {"dnoRegion": dno, "voltageLevel": query["voltage"], "data": rows},
+        }
+
+    def intensity_response(self, path: list) -> dict:
+        # /intensity/{from}/{to} or /regional/intensity/{from}/{to}/{regionid|postcode}/{x}
+        regional = path[0] == "regional"
+        from_txt, to_txt = path[2:4] if regional else path[1:3]
+        t = datetime.strptime(from_txt, "%Y-%m-%dT%H:%MZ").replace(tzinfo=utc)
+        end = datetime.strptime(to_txt, "%Y-%m-%dT%H:%MZ").replace(tzinfo=utc)
+        t -= timedelta(minutes=30)  # The API returns the slot ending at from
+        region_id = int(path[-1]) if regional and path[-2] == "regionid" else 11
+        slots = []
+        while t < end:
+            forecast = int(200 + 100 * self.daily_wave(t) + region_id)
+            slot = {
+                "from": t.strftime("%Y-%m-%dT%H:%MZ"),
+                "to": (t + timedelta(minutes=30)).strftime("%Y-%m-%dT%H:%MZ"),
+                "intensity": {"forecast": forecast, "index": "moderate"},
+            }
+            if regional:
+                gas = round(40 + 20 * self.daily_wave(t), 1)
+                slot["generationmix"] = [
+                    {"fuel": fuel, "perc": gas if fuel == "gas" else 0}
+                    for fuel in self.fuels[:-1]
+                ] + [{"fuel": "wind", "perc": round(100 - gas, 1)}]
+            else:
+                slot["intensity"]["actual"] = forecast + 5
+            slots.append(slot)
+            t += timedelta(minutes=30)
+        if not regional:
+            return {"data": slots}
+        data = {
+            "regionid": region_id,
+            "shortname": f"Region {region_id}",
+            "data": slots,
+        }
+        if path[-2] == "postcode":
+            data["postcode"] = path[-1]
+        else:
+            data["dnoregion"] = f"DNO {region_id}"
+        return {"data": data}
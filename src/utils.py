@@ -1,5 +1,7 @@
 import numpy as np
 import http.client as httplib
+import threading
+import time
 
 
 def to_int(x):
@@ -31,3 +33,38 @@ def have_internet() -> bool:
         return False
     finally:
         conn.close()
+
+
+def time_chunks(from_time, to_time, span) -> list:
+    """Splits the period from_time-to_time into consecutive (from, to) chunks of at most span.
+
+    Returns:
+        list: [(from_time, t1), (t1, t2), ..., (tn, to_time)]
+    """
+    chunks = []
+    while from_time < to_time:
+        next_t = min(from_time + span, to_time)
+        chunks.append((from_time, next_t))
+        from_time = next_t
+    return chunks
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls to wait() so that at most `requests_per_second`
+    go through per second (no limit if None)."""
+
+    def __init__(self, requests_per_second: float = None):
+        self.requests_per_second = requests_per_second
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        """Blocks until the caller is allowed to make its request."""
+        if not self.requests_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1 / self.requests_per_second
+        if slot > now:
+            time.sleep(slot - now)
@@ -0,0 +1,34 @@
+import asyncio
+
+
+def make_profile(region):
+    import pandas as pd
+    profile = pd.DataFrame({"from": pd.date_range("2019-01-01", periods=96, freq="30min")})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=30)
+    profile["region"] = region
+    profile["voltage_level"] = "Low Voltage: <1kV"
+    return profile
+
+
+def test_async_queries_run_concurrently(tmp_path):
+    """ Concurrent queries share one connection and match the synchronous results """
+    import pandas as pd
+    from src.async_grid import AsyncUKGridConnection
+    from src.transport import FakeGridTransport
+    from src.UKGridConnection import UKGridConnection
+    regions = ["Yorkshire", "London", "Yorkshire"]
+
+    async def main():
+        async with await AsyncUKGridConnection.create(
+            cache_path=tmp_path / "async", requests_per_second=None, transport=FakeGridTransport()
+        ) as grid:
+            prices = await asyncio.gather(*[grid.get_price(make_profile(region)) for region in regions])
+            co2 = await asyncio.gather(*[grid.get_c02(make_profile(region)) for region in regions])
+            return prices, co2, grid.grid.transport.requested_urls
+
+    prices, co2, urls = asyncio.run(main())
+    assert len(urls) == 4  # One per series and source, the repeated query waits or hits the cache
+    sync = UKGridConnection(cache_path=tmp_path / "sync", transport=FakeGridTransport())
+    for region, price, intensity in zip(regions, prices, co2):
+        pd.testing.assert_frame_equal(price, sync.get_price(make_profile(region)))
+        pd.testing.assert_frame_equal(intensity, sync.get_c02(make_profile(region)))
@@ -0,0 +1,50 @@
+def test_synthetic_tables_match_fake_api(tmp_path):
+    """ Synthetic cache rows hold the values FakeGridTransport serves """
+    import pandas as pd
+    from datetime import datetime
+    from src.benchmark import synthetic_price_table
+    from src.transport import FakeGridTransport
+    from src.UKGridConnection import UKGridConnection
+    region, voltage = "Yorkshire", "Low Voltage: <1kV"
+    table = synthetic_price_table(region, voltage, datetime(2019, 1, 1), datetime(2019, 1, 2), created=1)
+    grid = UKGridConnection(cache_path=tmp_path, transport=FakeGridTransport())
+    fetched = grid.price_api_request(region, voltage, datetime(2019, 1, 1), datetime(2019, 1, 1), skipstore=True)
+    fetched = fetched[fetched["from"] < pd.Timestamp("2019-01-02", tz="UTC")]
+    synthetic = table.to_pandas()
+    pd.testing.assert_series_equal(synthetic["id"], fetched["id"].reset_index(drop=True))
+    pd.testing.assert_series_equal(synthetic["pennies_per_kwh"], fetched["pennies_per_kwh"].reset_index(drop=True), atol=0.011)
+
+
+def test_benchmarks_run_at_small_scale(tmp_path):
+    from src.benchmark import compare, run_benchmarks
+    reports = run_benchmarks(tmp_path, years=1, regions=1, fetch_files=2)
+    names = [r["name"] for r in reports]
+    assert names == [
+        "init", "init_lazy", "refresh_price_cache", "refresh_co2_cache", "get_price",
+        "get_price_memoized", "get_price_fetch", "get_c02", "consolidate_cache",
+        "init_hot_cache", "backfill",
+    ]
+    by_name = {r["name"]: r for r in reports}
+    assert by_name["refresh_price_cache"]["rows"] == 3 * 334 * 48  # 3 voltages, 2024-04 to 2025-03
+    assert by_name["consolidate_cache"]["rows"] >= 2 * 3 + 2 * 2  # Per-fetch files absorbed
+    slower = {name: dict(r, seconds=r["seconds"] / 10) for name, r in by_name.items()}
+    assert [name for name, *_ in compare(reports, slower)] == names
+    assert compare(reports, by_name) == []
+
+
+def test_memory_is_traced_in_a_separate_run(tmp_path):
+    """ Timed runs do not use tracemalloc, peak memory comes from a second run """
+    from src.benchmark import benchmark_reports, measure
+    assert measure("noop", lambda: None)["peak_mb"] is None
+    assert measure("alloc", lambda: bytearray(2**20), trace_memory=True)["peak_mb"] >= 1
+    reports = benchmark_reports(tmp_path, years=1, regions=1, fetch_files=1)
+    assert all(r["peak_mb"] is not None and r["seconds"] > 0 for r in reports)
+
+
+def test_missing_baseline_fails_before_running(tmp_path, capsys):
+    import pytest
+    from src.benchmark import main
+    with pytest.raises(SystemExit):
+        main(["--baseline", str(tmp_path / "baseline.json"), "--work-path", str(tmp_path / "work")])
+    assert "--save-baseline" in capsys.readouterr().err
+    assert not (tmp_path / "work").exists()
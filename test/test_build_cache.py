@@ -0,0 +1,62 @@
+class FlakyTransport:
+    """ FakeGridTransport failing the requests of one month until fixed """
+
+    def __init__(self, failing: str):
+        from src.transport import FakeGridTransport
+        self.fake = FakeGridTransport()
+        self.failing = failing
+        self.requested_urls = []
+
+    def get_json(self, url, headers=None):
+        self.requested_urls.append(url)
+        if self.failing and self.failing in url:
+            raise ConnectionError(url)
+        return self.fake.get_json(url, headers)
+
+
+def test_backfill_resumes_from_checkpoint(tmp_path):
+    from datetime import datetime
+    from src.build_cache import backfill
+    from src.UKGridConnection import UKGridConnection
+    transport = FlakyTransport(failing="start=02-02-2019")
+    grid = UKGridConnection(cache_path=tmp_path, lazy=True, requests_per_second=None, transport=transport)
+    # One worker: January (fetched up to 1 Feb included) completes before February is planned
+    args = dict(regions=["Yorkshire"], voltages=["Low Voltage: <1kV"], co2=True, workers=1, compact_every=1)
+
+    stats = backfill(grid, datetime(2019, 1, 1), datetime(2019, 3, 1), **args)
+    assert stats == {"units": 6, "skipped": 0, "completed": 5, "unavailable": 0, "failed": 1}  # (price + 2 CO2) x 2 months
+    assert len((tmp_path / "backfill.checkpoint.jsonl").read_text().splitlines()) == 5
+    assert not [f for f in grid.price_store.files() if f.name != grid.price_store.consolidated_name]
+
+    transport.failing = None  # Resumed in a new process
+    transport.requested_urls = []
+    grid = UKGridConnection(cache_path=tmp_path, lazy=True, requests_per_second=None, transport=transport)
+    stats = backfill(grid, datetime(2019, 1, 1), datetime(2019, 3, 1), **args)
+    assert stats == {"units": 6, "skipped": 5, "completed": 1, "unavailable": 0, "failed": 0}
+    assert len(transport.requested_urls) == 1
+    assert "start=02-02-2019" in transport.requested_urls[0]
+
+
+def test_backfill_does_not_fail_on_unavailable_data(tmp_path):
+    """ Months before the dataset are reported as unavailable, not failed, on every run """
+    from datetime import datetime
+    from src.build_cache import backfill
+    from src.transport import FakeGridTransport
+    from src.UKGridConnection import UKGridConnection
+    args = dict(regions=["Yorkshire"], voltages=["Low Voltage: <1kV"], workers=1)
+    grid = UKGridConnection(cache_path=tmp_path, lazy=True, requests_per_second=None, transport=FakeGridTransport())
+    stats = backfill(grid, datetime(2017, 2, 1), datetime(2017, 5, 1), **args)
+    assert stats == {"units": 3, "skipped": 0, "completed": 1, "unavailable": 2, "failed": 0}
+
+    grid = UKGridConnection(cache_path=tmp_path, lazy=True, requests_per_second=None, transport=FakeGridTransport())
+    stats = backfill(grid, datetime(2017, 2, 1), datetime(2017, 5, 1), **args)
+    assert stats == {"units": 3, "skipped": 1, "completed": 0, "unavailable": 2, "failed": 0}
+    assert grid.transport.requested_urls == []
+
+
+def test_backfill_cli_rejects_unknown_voltages(capsys):
+    import pytest
+    from src.build_cache import main
+    with pytest.raises(SystemExit):
+        main(["--from", "2019-01-01", "--to", "2019-02-01", "--voltages", "LX"])
+    assert "invalid choice" in capsys.readouterr().err
@@ -0,0 +1,128 @@
+import pandas as pd
+
+
+def make_cache():
+    from_times = pd.date_range("2019-01-01", periods=6, freq="30min", tz="UTC")
+    cache = pd.DataFrame(
+        {
+            "region": ["A", "B"] * 3,
+            "voltage": ["LV"] * 6,
+            "from": from_times[::-1],  # Unsorted on purpose
+        }
+    )
+    cache["to"] = cache["from"] + pd.Timedelta(minutes=30)
+    return cache
+
+
+def test_series_index_bounds_and_slice():
+    from src.cache_index import SeriesIndex
+    cache = make_cache()
+    index = SeriesIndex(["region", "voltage"])
+
+    first, last = index.bounds(cache, ("A", "LV"))
+    assert first == pd.Timestamp("2019-01-01 00:30", tz="UTC")
+    assert last == pd.Timestamp("2019-01-01 03:00", tz="UTC")
+    assert index.bounds(cache, ("C", "LV")) is None
+
+    rows = index.slice(
+        cache,
+        ("B", "LV"),
+        pd.Timestamp("2019-01-01 00:00", tz="UTC"),
+        pd.Timestamp("2019-01-01 02:00", tz="UTC"),
+    )
+    assert list(rows["from"].dt.strftime("%H:%M")) == ["00:00", "01:00"]
+
+
+def test_series_index_invalidation_after_merge():
+    from src.cache_index import SeriesIndex
+    cache = make_cache()
+    index = SeriesIndex(["region", "voltage"])
+    assert index.bounds(cache, ("C", "LV")) is None
+
+    new_rows = make_cache().iloc[:2].assign(region="C")
+    new_rows.index = [10, 11]  # Merged rows get fresh labels
+    cache = pd.concat([cache, new_rows])
+    index.invalidate([("C", "LV")])
+    assert len(index.slice(cache, ("C", "LV"), cache["from"].min(), cache["to"].max())) == 2
+    assert len(index.lookup(cache, ("A", "LV"))[1]) == 3
+
+
+def test_series_index_missing_ranges_respect_max_span():
+    from datetime import timedelta
+    from src.cache_index import SeriesIndex
+    cache = make_cache().iloc[0:0]
+    index = SeriesIndex(["region", "voltage"])
+    start = pd.Timestamp("2019-01-01", tz="UTC")
+    ranges = index.missing_ranges(
+        cache, ("A", "LV"), start, start + timedelta(days=45), max_span=timedelta(days=30)
+    )
+    assert ranges == [
+        (start, start + timedelta(days=30)),
+        (start + timedelta(days=30), start + timedelta(days=45)),
+    ]
+
+
+def test_row_keys_and_latest_positions():
+    """ Integer row keys dedup like the string ids: latest fetch per (series, from) """
+    import numpy as np
+    from src.cache_index import SeriesCodes, latest_positions, row_keys
+    cache = make_cache()
+    cache = pd.concat([cache, cache.iloc[[0, 3]]], ignore_index=True)  # Fetched again
+    cache["created"] = [1] * 6 + [2, 2]
+    codes = SeriesCodes()
+    keys = row_keys(codes.encode(cache, ["region", "voltage"]), cache["from"])
+    assert codes.codes == {("A", "LV"): 0, ("B", "LV"): 1}
+    assert keys[0] == 1546309800 and keys[1] == (1 << 32) + 1546308000  # 2019-01-01 02:30/02:00
+
+    latest = latest_positions(keys, cache["created"].values)
+    assert len(latest) == 6 and np.all(np.diff(keys[latest]) > 0)
+    assert set(latest) == {1, 2, 4, 5, 6, 7}  # Rows 0 and 3 superseded
+
+
+def test_series_index_refresh_after_superseding_merge():
+    """ Stale series drop their superseded rows and pick up the merged ones """
+    from src.cache_index import SeriesIndex
+    cache = make_cache()
+    index = SeriesIndex(["region", "voltage"])
+    assert len(index.lookup(cache, ("A", "LV"))[1]) == 3
+
+    new_rows = cache.iloc[[0]].assign(voltage="LV")  # Re-fetch of A 02:30
+    new_rows.index = [6]
+    cache = pd.concat([cache.drop(index=[0]), new_rows])
+    index.invalidate([("A", "LV")])
+    from_ns, labels = index.lookup(cache, ("A", "LV"))
+    assert sorted(labels) == [2, 4, 6] and list(from_ns) == sorted(from_ns)
+    assert len(index.lookup(cache, ("B", "LV"))[1]) == 3
+
+    start = pd.Timestamp("2019-01-01 00:00", tz="UTC")
+    ranges = index.missing_ranges(
+        cache, ("A", "LV"), start, start + pd.Timedelta(hours=3), max_span=pd.Timedelta(hours=1)
+    )
+    assert ranges == [
+        (start + pd.Timedelta(minutes=30 * i), start + pd.Timedelta(minutes=30 * (i + 1)))
+        for i in (0, 2, 4)
+    ]
+
+
+def test_latest_rows_merges_lazily_per_series():
+    """ Merged rows only replace older fetches of their series, the frame is rebuilt once """
+    import numpy as np
+    from src.cache_index import LatestRows, SeriesIndex
+    cache = make_cache().assign(key=np.arange(6), created=1)
+    cache["region"] = cache["region"].astype("category")
+    rows = LatestRows(cache, SeriesIndex(["region", "voltage"]))
+
+    refetch = cache.iloc[[0, 2]].assign(created=[2, 0])  # A 02:30 newer, A 01:30 older
+    new_series = cache.iloc[[1]].assign(region="C", key=10, created=1)
+    assert rows.merge(refetch) == [("A", "LV")]
+    assert rows.merge(new_series) == [("C", "LV")]
+    assert rows.frame() is not cache and rows.pending == []
+    assert rows.frame() is rows.frame()  # Rebuilt once
+
+    frame = rows.frame()
+    assert len(frame) == 7 and frame["key"].is_unique
+    assert list(frame.index) == [1, 2, 3, 4, 5, 6, 8]  # Kept and fresh labels
+    assert frame.set_index("key")["created"].to_dict() == {0: 2, 1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 10: 1}
+    assert isinstance(frame["region"].dtype, pd.CategoricalDtype)
+    assert list(rows.index.lookup(frame, ("C", "LV"))[1]) == [8]
+    assert sorted(rows.index.lookup(frame, ("A", "LV"))[1]) == [2, 4, 6]
@@ -0,0 +1,74 @@
+import pandas as pd
+
+
+def price_table(region, from_time, to_time):
+    from src.UKGridConnection import price_schema, to_cache_table
+    data = pd.DataFrame({"from": pd.date_range(from_time, to_time, freq="30min", inclusive="left")})
+    data["to"] = data["from"] + pd.Timedelta(minutes=30)
+    data["id"] = region.upper() + "_LV_" + (data["from"].astype("int64") // 10**9).astype(str)
+    data["created"] = 1
+    data["region"] = region
+    data["voltageLevel"] = "LV"
+    data["voltage"] = "Low Voltage: <1kV"
+    data["dnoRegion"] = "23"
+    data["pennies_per_kwh"] = 1.0
+    return to_cache_table(data, price_schema)
+
+
+def test_partitioned_cache_reads_only_requested_partitions(tmp_path):
+    """ Reads of one series/month never open the files of other partitions """
+    from src.cache_store import PartitionedCache, months_between
+    from src.UKGridConnection import price_schema
+    store = PartitionedCache(tmp_path, price_schema, ["region", "voltage"], "price")
+    start, end = pd.Timestamp("2019-01-01", tz="UTC"), pd.Timestamp("2019-04-01", tz="UTC")
+    for region in ["Yorkshire", "London"]:
+        store.write(price_table(region, start, end))
+    assert len(store.files()) == 6  # 2 series * 3 months
+
+    # Corrupt every other partition: reading them would fail
+    keep = store.partition_dir(("London", "Low Voltage: <1kV"), "2019-02")
+    for file in store.files():
+        if file.parent != keep:
+            file.write_bytes(b"not parquet")
+
+    day = pd.Timestamp("2019-02-10", tz="UTC")
+    table = store.read({"region": "London", "voltage": "Low Voltage: <1kV"}, months_between(day, day))
+    data = table.to_pandas()
+    assert len(data) == 28 * 48
+    assert (data.region == "London").all()
+    assert data["from"].min() == pd.Timestamp("2019-02-01", tz="UTC")
+    assert table.schema.equals(price_schema)
+
+
+def test_months_between():
+    from src.cache_store import months_between
+    assert months_between(pd.Timestamp("2019-11-30 23:30"), pd.Timestamp("2020-01-01")) == ["2019-11", "2019-12", "2020-01"]
+
+
+def test_compaction_absorbs_only_new_fetch_files(tmp_path):
+    """ Fetch files are merged into each partition's consolidated file and removed """
+    import pyarrow as pa
+    from src.cache_store import PartitionedCache
+    from src.UKGridConnection import price_schema
+    store = PartitionedCache(tmp_path, price_schema, ["region", "voltage"], "price")
+    jan, feb = pd.Timestamp("2019-01-01", tz="UTC"), pd.Timestamp("2019-02-01", tz="UTC")
+    store.write(price_table("Yorkshire", jan, feb))
+    store.write(price_table("London", jan, feb))
+    refetch = price_table("Yorkshire", jan, jan + pd.Timedelta(days=1))
+    refetch = refetch.set_column(1, "created", pa.array([2] * len(refetch), pa.int64()))
+    refetch = refetch.set_column(8, "pennies_per_kwh", pa.array([5.0] * len(refetch)))
+    store.write(refetch, name="price_2.parquet.snappy")
+    assert len(store.files()) == 3
+
+    assert store.compact() == {"partitions": 2, "files": 3}
+    assert [f.name for f in store.files()] == [store.consolidated_name] * 2
+    yorkshire = store.read({"region": "Yorkshire", "voltage": "Low Voltage: <1kV"}).to_pandas()
+    assert len(yorkshire) == 31 * 48 and yorkshire.id.is_unique
+    assert yorkshire["from"].is_monotonic_increasing
+    assert (yorkshire.set_index("from").pennies_per_kwh[: jan + pd.Timedelta(hours=23)] == 5.0).all()
+
+    # Nothing new: nothing rewritten. New fetch: only its partition is compacted
+    assert store.compact() == {"partitions": 0, "files": 0}
+    store.write(price_table("London", feb, feb + pd.Timedelta(days=1)))
+    assert store.compact() == {"partitions": 1, "files": 1}
+    assert len(store.files()) == 3
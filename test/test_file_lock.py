@@ -0,0 +1,10 @@
+def test_file_lock_is_exclusive(tmp_path):
+    from src.file_lock import FileLock
+    first, second = FileLock(tmp_path / "a.lock"), FileLock(tmp_path / "a.lock")
+    assert first.acquire()
+    assert not second.acquire(blocking=False)
+    assert not second.acquire(timeout=0.1)
+    assert FileLock(tmp_path / "b.lock").acquire(blocking=False)  # Other lock files are free
+    first.release()
+    assert second.acquire(blocking=False)
+    second.release()
@@ -6,16 +6,39 @@ def test_log():
     logging.error('eggs error')
     logging.critical('eggs critical')
 
-def initialize_grid_with_internet():
+def fake_price_data(region, voltage, from_time, to_time, created=1, price=1.0):
+    """ Half-hourly price data shaped as returned by UKGridConnection.price_api_request """
+    import pandas as pd
+    from src.UKGridConnection import voltage_level_enums
+    data = pd.DataFrame(
+        {"from": pd.date_range(from_time, to_time, freq="30min", inclusive="left")}
+    )
+    data["to"] = data["from"] + pd.Timedelta(minutes=30)
+    voltage_level = voltage_level_enums[voltage]
+    data["id"] = (
+        f"{region}_{voltage_level}_".replace(" ", "_").upper()
+        + (data["from"].astype("int64") // 10**9).astype(str)
+    )
+    data["created"] = created
+    data["region"] = pd.Categorical([region] * len(data))
+    data["voltage"] = pd.Categorical([voltage] * len(data))
+    data["voltageLevel"] = pd.Categorical([voltage_level] * len(data))
+    data["dnoRegion"] = pd.Categorical(["23"] * len(data))
+    data["pennies_per_kwh"] = price
+    return data
+
+def initialize_grid_with_internet(cache_path):
+    """ Grid connected to the live APIs, or to a local stand-in of the APIs if offline """
     from src.utils import have_internet
-    if not have_internet():
-        warnings.warn("No internet connection deteceted, test can't be performed.")
-        return None
     from src.UKGridConnection import UKGridConnection
+    if not have_internet():
+        from src.transport import FakeGridTransport
+        warnings.warn("No internet connection deteceted, using a local stand-in of the APIs.")
+        return UKGridConnection(cache_path=cache_path, transport=FakeGridTransport())
     return UKGridConnection()
 
-def test_call_for_co2_intensity_with_df():
-    grid = initialize_grid_with_internet()
+def test_call_for_co2_intensity_with_df(tmp_path):
+    grid = initialize_grid_with_internet(tmp_path)
     if grid is None:
         return None
     
@@ -36,17 +59,12 @@ def test_call_for_co2_intensity_with_df():
     df["voltage_level"] = voltage_level[0]
     filled_data = grid.get_c02(df)
 
-def test_call_for_price_with_df():
-    from src.utils import have_internet
-    if not have_internet():
-        return
-    
+def test_call_for_price_with_df(tmp_path):
     from src.UKGridConnection import region_map, voltage_level_enums
-    from src.UKGridConnection import UKGridConnection
     from copy import deepcopy
     import pandas as pd
     from datetime import datetime
-    grid = UKGridConnection()
+    grid = initialize_grid_with_internet(tmp_path)
 
     # Simple Test: 1 Region
     sample_dataA = [
@@ -79,8 +97,8 @@ def test_call_for_price_with_df():
     grid.get_price(dfB)
     logging.info('Test B Passed')
 
-def test_call_co2_api():
-    grid = initialize_grid_with_internet()
+def test_call_co2_api(tmp_path):
+    grid = initialize_grid_with_internet(tmp_path)
     if grid is None:
         return None
     grid.use_cache = False # Don't want to generate extra files during testing
@@ -108,8 +126,8 @@ def test_call_co2_api():
     data4 =  grid.intensity_api_request(from_time,to_time,region=region)
     pass
 
-def test_call_price_api():
-    grid = initialize_grid_with_internet()
+def test_call_price_api(tmp_path):
+    grid = initialize_grid_with_internet(tmp_path)
     if grid is None:
         return None
     grid.use_cache = False # Don't want to generate extra files during testing
@@ -138,10 +156,547 @@ def test_call_price_api():
     region = "Yorkshire" #dno = 23
     data = grid.price_api_request(region, volate_level,from_time,to_time)
 
-def test_consolidate_cache():
+def test_consolidate_cache(tmp_path):
     """ If cache does not exist it create a cache and calls it """
-    grid = initialize_grid_with_internet()
+    grid = initialize_grid_with_internet(tmp_path)
     if grid is None:
         return None
     grid.consolidate_cache(keep_latest=True)
-    
\ No newline at end of file
+    
+def test_migrate_legacy_string_cache(tmp_path):
+    """ Flat caches written with the legacy all-string schema are migrated to typed partitions """
+    import pandas as pd
+    import pyarrow.parquet as pq
+    from src.UKGridConnection import UKGridConnection, price_schema
+    (tmp_path / "price").mkdir(parents=True)
+    legacy = pd.DataFrame(
+        {
+            "id": ["YORKSHIRE_LV_1546300800", "YORKSHIRE_LV_1546302600"],
+            "created": ["1680626128227208700", "1680626128227208700"],
+            "region": ["Yorkshire", "Yorkshire"],
+            "voltageLevel": ["LV", "LV"],
+            "from": ["2019-01-01 00:00:00+00:00", "2019-01-01 00:30:00+00:00"],
+            "to": ["2019-01-01 00:30:00+00:00", "2019-01-01 01:00:00+00:00"],
+            "voltage": ["Low Voltage: <1kV", "Low Voltage: <1kV"],
+            "dnoRegion": ["23", "23"],
+            "pennies_per_kwh": ["9.16", "None"],
+        }
+    ).astype(pd.StringDtype())
+    legacy_file = tmp_path / "price" / "price_1.parquet.snappy"
+    legacy.to_parquet(legacy_file, engine="pyarrow", compression="snappy")
+
+    grid = UKGridConnection(cache_path=tmp_path)
+    assert not legacy_file.exists()
+    migrated_file = grid.price_store.partition_dir(("Yorkshire", "Low Voltage: <1kV"), "2019-01") / legacy_file.name
+    assert pq.read_schema(migrated_file).remove_metadata().equals(price_schema)
+    assert grid.price_cache["created"].dtype == "int64"
+    assert grid.price_cache["pennies_per_kwh"].iloc[0] == 9.16
+    assert grid.price_cache["pennies_per_kwh"].isna().iloc[1]
+    assert str(grid.price_cache["from"].dtype) == "datetime64[ns, UTC]"
+
+def test_merge_price_cache_keeps_latest_without_reload(tmp_path):
+    """ Fetched data is merged in memory, replacing older fetches of the same ids """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    grid = UKGridConnection(cache_path=tmp_path)
+    grid.refresh_price_cache = None  # A reload from disk would fail
+
+    start = pd.Timestamp("2019-01-01", tz="UTC")
+    grid.merge_price_cache(
+        fake_price_data("Yorkshire", "Low Voltage: <1kV", start, start + pd.Timedelta(hours=2), 1, 1.0)
+    )
+    grid.merge_price_cache(
+        fake_price_data("Yorkshire", "Low Voltage: <1kV", start, start + pd.Timedelta(hours=1), 2, 2.0)
+    )
+    assert len(grid.price_cache) == 4
+    assert grid.price_cache.key.is_unique
+    assert sorted(grid.price_cache.pennies_per_kwh) == [1.0, 1.0, 2.0, 2.0]
+    assert isinstance(grid.price_cache.region.dtype, pd.CategoricalDtype)
+
+def test_lazy_cache_loads_series_on_demand(tmp_path):
+    """ In lazy mode only the requested series is read from local storage """
+    import shutil
+    from pathlib import Path
+    from src.UKGridConnection import UKGridConnection
+    shutil.copytree(Path(__file__).parents[1] / "data" / ".GridConnection_cache", tmp_path / "cache")
+    grid = UKGridConnection(cache_path=tmp_path / "cache", lazy=True)
+    assert len(grid.price_cache) == 0 and len(grid.co2_cache) == 0
+
+    grid.load_price_series("Yorkshire", "Low Voltage: <1kV")
+    assert len(grid.price_cache) > 0
+    assert set(grid.price_cache.region) == {"Yorkshire"}
+    assert set(grid.price_cache.voltage) == {"Low Voltage: <1kV"}
+
+    grid.load_co2_series(region="South England")
+    assert set(grid.co2_cache.region) == {"South England"}
+    assert grid.co2_cache.generationmix_gas.dtype == "float32"
+
+def test_get_price_only_fetches_missing_slots(tmp_path):
+    """ A gap in the cache is filled with a single API call covering only the gap """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path)
+    region, voltage = "Yorkshire", "Low Voltage: <1kV"
+    start, end = pd.Timestamp("2019-01-01", tz="UTC"), pd.Timestamp("2019-03-01", tz="UTC")
+    gap_start, gap_end = pd.Timestamp("2019-02-10", tz="UTC"), pd.Timestamp("2019-02-11", tz="UTC")
+    grid.merge_price_cache(fake_price_data(region, voltage, start, gap_start))
+    grid.merge_price_cache(fake_price_data(region, voltage, gap_end, end))
+
+    grid.transport = FakeGridTransport()
+    profile = pd.DataFrame({"from": pd.date_range(start, end, freq="1h", inclusive="left")})
+    profile["to"] = profile["from"] + pd.Timedelta(hours=1)
+    profile["region"] = region
+    profile["voltage_level"] = voltage
+    profile = grid.get_price(profile)
+    assert len(grid.transport.requested_urls) == 1
+    assert "start=10-02-2019&" in grid.transport.requested_urls[0]
+    assert profile.pennies_per_kwh.notna().all()
+    in_gap = (profile["from"] >= gap_start) & (profile["from"] < gap_end)
+    assert (profile.loc[in_gap, "pennies_per_kwh"] != 1.0).all()
+    before_gap = profile["from"] < gap_start
+    assert (profile.loc[before_gap, "pennies_per_kwh"] == 1.0).all()
+
+def test_price_api_request_fetches_chunks_concurrently(tmp_path):
+    """ Long ranges are split into chunks fetched in parallel and reassembled in order """
+    from datetime import datetime
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    transport = FakeGridTransport(latency=0.2)
+    grid = UKGridConnection(cache_path=tmp_path, max_workers=4, requests_per_second=None, transport=transport)
+    data = grid.price_api_request("Yorkshire", "Low Voltage: <1kV", datetime(2019, 1, 1), datetime(2019, 5, 1))
+    assert len(transport.requested_urls) == 4
+    assert transport.max_in_flight == 4  # 4 chunks, fetched concurrently
+    assert data.drop_duplicates("id")["from"].is_monotonic_increasing  # Chunks share a day
+    assert data["from"].iloc[0].isoformat() == "2019-01-01T00:00:00+00:00"
+    assert data["from"].iloc[-1].isoformat() == "2019-05-01T23:30:00+00:00"
+
+def test_get_price_fetches_all_series_concurrently(tmp_path):
+    """ Missing data of every (region, voltage) is fetched in parallel and stored once """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    transport = FakeGridTransport(latency=0.2)
+    grid = UKGridConnection(cache_path=tmp_path, max_workers=8, requests_per_second=None, transport=transport)
+    profile = pd.DataFrame(
+        [
+            {"from": pd.Timestamp("2019-01-01"), "to": pd.Timestamp("2019-01-02"), "region": region, "voltage_level": voltage}
+            for region in ["Yorkshire", "London", "South Wales"]
+            for voltage in ["Low Voltage: <1kV", "High Voltage: <22kV"]
+        ]
+    )
+    profile = grid.get_price(profile)
+    assert len(transport.requested_urls) == 6
+    assert transport.max_in_flight == 6  # 6 series, fetched concurrently
+    assert profile.pennies_per_kwh.notna().all()
+    files = list((tmp_path / "price").rglob("price_*.parquet.snappy"))
+    assert len(files) == 6  # One per partition
+    assert len({f.name for f in files}) == 1  # Stored at once
+
+def test_ingest_json_to_cache_tables():
+    """ API responses are turned into typed cache tables with legacy-compatible ids """
+    import json
+    from src.UKGridConnection import co2_table_from_json, price_table_from_json, price_schema, co2_schema
+    price_json = {
+        "data": {
+            "dnoRegion": 23,
+            "voltageLevel": "LV",
+            "data": [{"Overall": 9.16, "Timestamp": "00:30 01-01-2020"}],
+        }
+    }
+    price = price_table_from_json(price_json, "North Scotland", "Low Voltage: <1kV", 1).to_pandas()
+    assert price.id.iloc[0] == "NORTH_SCOTLAND_LV_1577838600"
+    assert str(price["to"].iloc[0]) == "2020-01-01 01:00:00+00:00"
+    assert price.pennies_per_kwh.iloc[0] == 9.16
+
+    slot = {
+        "from": "2020-01-01T00:00Z",
+        "to": "2020-01-01T00:30Z",
+        "intensity": {"forecast": 34, "index": "very low"},
+        "generationmix": [{"fuel": "gas", "perc": 8.3}, {"fuel": "wind", "perc": 91.7}],
+    }
+    co2_json = {"data": {"regionid": 11, "shortname": "South West England", "postcode": "BS8", "data": [slot]}}
+    co2 = co2_table_from_json(co2_json, None, "BS8", 1)
+    assert co2.schema.equals(co2_schema)
+    co2 = co2.to_pandas()
+    assert co2.id.iloc[0] == "NA_BS8_1577836800"
+    assert co2.intensity_actual.isna().iloc[0]
+    assert co2.generationmix_gas.iloc[0] == 8.3 and co2.generationmix_wind.iloc[0] == 91.7
+    assert co2.generationmix_coal.isna().iloc[0]  # Not in the response
+
+def test_migrate_json_generation_mix(tmp_path):
+    """ Partitions written with the JSON generation mix are migrated to one column per fuel """
+    import json
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from src.UKGridConnection import UKGridConnection, co2_schema, co2_table_from_json
+    grid = UKGridConnection(cache_path=tmp_path)
+    mix = [{"fuel": "gas", "perc": 40.5}, {"fuel": "wind", "perc": 59.5}]
+    slot = {"from": "2020-01-01T00:00Z", "to": "2020-01-01T00:30Z", "intensity": {"forecast": 34, "index": "low"}, "generationmix": mix}
+    table = co2_table_from_json({"data": {"regionid": 13, "data": [slot]}}, "London", None, 1)
+    legacy = table.drop([c for c in table.column_names if c.startswith("generationmix_")])
+    legacy = legacy.append_column("generationmix", pa.array([json.dumps(mix)]))
+    legacy_file = grid.co2_store.write(legacy)[0]
+    grid.co2_store.schema_marker.unlink()
+
+    grid = UKGridConnection(cache_path=tmp_path)
+    assert pq.read_schema(legacy_file).remove_metadata().equals(co2_schema)
+    assert grid.co2_cache.generationmix_gas.iloc[0] == 40.5
+    assert grid.co2_cache.generationmix_nuclear.isna().iloc[0]
+
+def test_get_c02_is_cache_first(tmp_path):
+    """ Repeated CO2 queries are answered from the cache without API calls or new files """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path, transport=FakeGridTransport())
+    profile = pd.DataFrame({"from": pd.date_range("2020-01-01", periods=96, freq="30min")})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=30)
+    profile["region"] = ["London", "Yorkshire"] * 48
+    profile["average_power"] = 2.0
+
+    first = grid.get_c02(profile)
+    assert len(grid.transport.requested_urls) == 2  # One per region
+    assert first.intensity_forecast.notna().all()
+    files = sorted((tmp_path / "co2").rglob("*"))
+
+    second = grid.get_c02(profile)
+    assert len(grid.transport.requested_urls) == 2
+    assert sorted((tmp_path / "co2").rglob("*")) == files
+    pd.testing.assert_series_equal(first.intensity_forecast, second.intensity_forecast)
+    assert list(profile.columns) == ["from", "to", "region", "average_power"]
+
+
+def test_get_c02_and_price_of_15_minute_profile(tmp_path):
+    """ Intervals shorter than the half-hour slots get the intensity/price of their slot """
+    import pandas as pd
+    import numpy as np
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path, transport=FakeGridTransport())
+    half_hourly = pd.DataFrame({"from": pd.date_range("2020-01-01", periods=48, freq="30min")})
+    half_hourly["to"] = half_hourly["from"] + pd.Timedelta(minutes=30)
+    half_hourly["region"] = "London"
+    half_hourly["voltage_level"] = "Low Voltage: <1kV"
+    half_hourly["average_power"] = 2.0
+    quarter_hourly = pd.DataFrame({"from": pd.date_range("2020-01-01", periods=96, freq="15min")})
+    quarter_hourly["to"] = quarter_hourly["from"] + pd.Timedelta(minutes=15)
+    quarter_hourly["region"] = "London"
+    quarter_hourly["voltage_level"] = "Low Voltage: <1kV"
+    quarter_hourly["average_power"] = 2.0
+
+    co2 = grid.get_c02(half_hourly)
+    co2_15 = grid.get_c02(quarter_hourly)
+    assert len(co2_15) == 96  # No row explosion
+    np.testing.assert_allclose(co2_15.intensity_forecast.values, np.repeat(co2.intensity_forecast.values, 2))
+    assert np.isclose(co2_15.total_emmissions_forecast.sum(), co2.total_emmissions_forecast.sum())
+
+    price = grid.get_price(half_hourly)
+    price_15 = grid.get_price(quarter_hourly)
+    np.testing.assert_allclose(price_15.pennies_per_kwh.values, np.repeat(price.pennies_per_kwh.values, 2))
+    assert np.isclose(price_15.total_cost_pennies.sum(), price.total_cost_pennies.sum())
+
+
+def test_get_price_joins_all_series_without_mutating_input(tmp_path):
+    """ Prices of interleaved series match the cache and the input frame is left untouched """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    grid = UKGridConnection(cache_path=tmp_path, lazy=True)
+    voltages = ["Low Voltage: <1kV", "High Voltage: <22kV"]
+    start, end = pd.Timestamp("2019-03-01", tz="UTC"), pd.Timestamp("2019-03-03", tz="UTC")
+    for price, (region, voltage) in enumerate([(r, v) for r in ["Yorkshire", "London"] for v in voltages]):
+        grid.merge_price_cache(fake_price_data(region, voltage, start, end, price=float(price)))
+    profile = pd.DataFrame({"from": pd.date_range(start, end, freq="30min", inclusive="left").repeat(4)})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=30)
+    profile["region"] = ["Yorkshire", "Yorkshire", "London", "London"] * (len(profile) // 4)
+    profile["voltage_level"] = voltages * (len(profile) // 2)
+    profile = profile.sample(frac=1, random_state=0)  # Interleave the series
+    original = profile.copy()
+
+    priced = grid.get_price(profile)
+    pd.testing.assert_frame_equal(profile, original)
+    expected = profile.region.map({"Yorkshire": 0, "London": 2}) + profile.voltage_level.map(
+        {voltages[0]: 0, voltages[1]: 1}
+    )
+    assert (priced.pennies_per_kwh == expected).all()
+    assert priced.index.equals(profile.index)
+
+
+def test_background_compaction(tmp_path):
+    """ Scheduled compaction merges the fetch files while the grid keeps serving queries """
+    import time
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path, requests_per_second=None, transport=FakeGridTransport())
+    profile = pd.DataFrame({"from": pd.date_range("2019-01-01", periods=48, freq="30min")})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=30)
+    profile["region"] = "Yorkshire"
+    profile["voltage_level"] = "Low Voltage: <1kV"
+    grid.start_compaction(interval=0.01)
+    try:
+        for day in range(5):
+            priced = grid.get_price(profile.assign(**{col: profile[col] + pd.Timedelta(days=day) for col in ["from", "to"]}))
+            assert priced.pennies_per_kwh.notna().all()
+        deadline = time.monotonic() + 5
+        while any(f.name.startswith("price_") for f in grid.price_store.files()):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        grid.stop_compaction()
+    assert [f.name for f in grid.price_store.files()] == ["Consolidated_Price_Cache.parquet.snappy"]
+    grid.refresh_price_cache()
+    assert grid.price_cache["from"].min() == pd.Timestamp("2019-01-01", tz="UTC")
+
+
+def price_in_worker(cache_path):
+    """ Prices a day of three series in a worker process sharing cache_path """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=cache_path, requests_per_second=None, transport=FakeGridTransport(latency=0.2))
+    profile = pd.DataFrame(
+        [
+            {"from": pd.Timestamp("2019-01-01"), "to": pd.Timestamp("2019-01-02"), "region": region, "voltage_level": "Low Voltage: <1kV"}
+            for region in ["Yorkshire", "London", "South Wales"]
+        ]
+    )
+    priced = grid.get_price(profile)
+    return len(grid.transport.requested_urls), bool(priced.pennies_per_kwh.notna().all())
+
+def test_processes_share_cache_without_duplicate_fetches(tmp_path):
+    """ Workers sharing a cache folder wait for each other's fetches instead of repeating them """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from src.UKGridConnection import UKGridConnection
+    with ProcessPoolExecutor(4, mp_context=multiprocessing.get_context("fork")) as pool:
+        results = list(pool.map(price_in_worker, [tmp_path] * 4))
+    assert sum(requests for requests, _ in results) == 3  # One per series, across workers
+    assert all(complete for _, complete in results)
+    grid = UKGridConnection(cache_path=tmp_path)
+    assert len(grid.price_cache) == 3 * 48 * 2  # The API returns one extra day
+    assert grid.price_cache.key.is_unique
+
+
+def test_hot_cache_is_memory_mapped(tmp_path):
+    """ The hot cache written on compaction is mapped without copies and kept up to date """
+    import numpy as np
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path, hot_cache=True, requests_per_second=None, transport=FakeGridTransport())
+    profile = pd.DataFrame({"from": pd.date_range("2019-01-01", periods=48, freq="30min")})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=30)
+    profile["region"] = "Yorkshire"
+    profile["voltage_level"] = "Low Voltage: <1kV"
+    grid.get_price(profile)
+    grid.get_c02(profile)
+    grid.compact_cache()
+    assert grid.price_store.hot_path.exists() and grid.co2_store.hot_path.exists()
+    mapped = UKGridConnection(cache_path=tmp_path, hot_cache=True, transport=FakeGridTransport())
+    assert not np.asarray(mapped.price_cache["pennies_per_kwh"].values).flags.writeable  # Mapped
+
+    grid.get_price(profile.assign(**{col: profile[col] + pd.Timedelta(days=40) for col in ["from", "to"]}))
+    mapped = UKGridConnection(cache_path=tmp_path, hot_cache=True, transport=FakeGridTransport())
+    assert not np.asarray(mapped.price_cache["pennies_per_kwh"].values).flags.writeable  # Rewritten
+    assert grid.price_store.newer_files() == []
+    decoded = UKGridConnection(cache_path=tmp_path, transport=FakeGridTransport())
+    for cache, series in [("price_cache", ["region", "voltage"]), ("co2_cache", ["region", "postcode"])]:
+        pd.testing.assert_frame_equal(  # Series codes of the keys are per process
+            getattr(mapped, cache).sort_values([*series, "from"]).drop(columns="key").reset_index(drop=True),
+            getattr(decoded, cache).sort_values([*series, "from"]).drop(columns="key").reset_index(drop=True),
+            check_categorical=False,
+        )
+    assert mapped.price_cache["from"].max() >= pd.Timestamp("2019-02-10", tz="UTC")  # Newer file
+    assert mapped.get_price(profile).pennies_per_kwh.notna().all()
+    assert mapped.transport.requested_urls == []
+
+
+def test_repeated_queries_are_served_from_query_cache(tmp_path):
+    """ Repeated get_price queries skip the pipeline until their series are updated """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path, transport=FakeGridTransport())
+    region, voltage = "Yorkshire", "Low Voltage: <1kV"
+    start = pd.Timestamp("2019-01-01", tz="UTC")
+    profile = pd.DataFrame({"from": pd.date_range(start, periods=48, freq="30min")})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=30)
+    profile["region"] = region
+    profile["voltage_level"] = voltage
+
+    first = grid.get_price(profile)
+    first["pennies_per_kwh"] = -1.0  # Callers own their copies
+    second = grid.get_price(profile)
+    assert grid.price_results.stats()["hits"] == 1
+    assert (second.pennies_per_kwh != -1.0).all()
+
+    grid.merge_price_cache(fake_price_data(region, voltage, start, start + pd.Timedelta(days=1), created=2**62))
+    assert (grid.get_price(profile).pennies_per_kwh == 1.0).all()  # Updated series
+    assert grid.price_results.stats()["hits"] == 1
+
+
+def test_stream_price_plans_fetches_once(tmp_path):
+    """ A Parquet profile is enriched batch by batch after a single fetch plan """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection, write_chunks
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path / "cache", requests_per_second=None, transport=FakeGridTransport())
+    profile = pd.DataFrame({"from": pd.date_range("2019-01-01", "2019-03-01", freq="1h", inclusive="left")})
+    profile["to"] = profile["from"] + pd.Timedelta(hours=1)
+    profile["region"] = "Yorkshire"
+    profile["voltage_level"] = "Low Voltage: <1kV"
+    profile["average_power"] = 2.0
+    profile.to_parquet(tmp_path / "profile.parquet")
+
+    rows = write_chunks(grid.stream_price(tmp_path / "profile.parquet", batch_size=100), tmp_path / "out.parquet")
+    assert rows == len(profile)
+    assert len(grid.transport.requested_urls) == 2  # 59 days in two 30 day requests
+    streamed = pd.read_parquet(tmp_path / "out.parquet")
+    expected = grid.get_price(profile)
+    pd.testing.assert_frame_equal(streamed.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
+
+    chunks = [profile.iloc[i : i + 500] for i in range(0, len(profile), 500)]
+    streamed = pd.concat(grid.stream_c02(iter(chunks)))
+    assert len(streamed) == len(profile) and streamed.intensity_forecast.notna().all()
+    assert grid.price_results.stats()["entries"] == 1  # Only get_price is memoized
+
+
+def test_stats_count_api_calls_and_cache_hits(tmp_path):
+    """ stats() accounts for the API requests, rows, files and cache hits of the queries """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path, transport=FakeGridTransport())
+    profile = pd.DataFrame({"from": pd.date_range("2019-01-01", periods=48, freq="30min")})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=30)
+    profile["region"] = "Yorkshire"
+    profile["voltage_level"] = "Low Voltage: <1kV"
+    grid.get_price(profile)
+    grid.get_price(profile)
+    grid.get_price(profile.iloc[:10])
+
+    counters = grid.stats()["counters"]
+    assert counters["api_requests{cache=price}"] == 1
+    assert counters["rows_fetched{cache=price}"] == 96  # Whole days, end day included
+    assert counters["files_written{cache=price}"] == 1
+    assert counters["cache_misses{cache=price}"] == 1
+    assert counters["cache_hits{cache=price}"] == 1  # Third query, data already cached
+    assert counters["query_cache_hits{cache=price}"] == 1  # Second query
+    assert grid.stats()["timers"]["get_price"]["count"] == 3
+    assert grid.stats()["query_cache"]["price"]["hits"] == 1
+    assert 'energygrid_api_requests_total{cache="price"} 1' in grid.metrics.prometheus()
+
+
+class EmptyPriceTransport:
+    """ Price API answering every request without data """
+
+    def __init__(self):
+        self.requested_urls = []
+
+    def get_json(self, url, headers=None):
+        self.requested_urls.append(url)
+        return {"status": "200", "data": {"dnoRegion": 23, "voltageLevel": "LV", "data": []}}
+
+
+def test_unavailable_ranges_are_not_fetched_again(tmp_path):
+    """ Ranges outside the dataset or missing from the API return NaN without re-fetching """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    grid = UKGridConnection(cache_path=tmp_path, transport=EmptyPriceTransport())
+    profile = pd.DataFrame({"from": pd.date_range("2016-01-01", periods=48, freq="30min")})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=30)
+    profile["region"] = "Yorkshire"
+    profile["voltage_level"] = "Low Voltage: <1kV"
+    assert grid.get_price(profile).pennies_per_kwh.isna().all()  # Before the dataset
+    assert grid.transport.requested_urls == []
+
+    profile[["from", "to"]] += pd.Timedelta(days=365 * 3)  # 2018: empty responses
+    assert grid.get_price(profile).pennies_per_kwh.isna().all()
+    assert len(grid.transport.requested_urls) == 1
+    restarted = UKGridConnection(cache_path=tmp_path, transport=grid.transport)
+    assert restarted.get_price(profile).pennies_per_kwh.isna().all()
+    assert len(grid.transport.requested_urls) == 1  # Known unavailable (persisted)
+    assert grid.stats()["counters"]["unavailable_ranges{cache=price}"] == 1
+
+
+def test_empty_profile_and_empty_series(tmp_path):
+    """ Empty profiles and series without any data return NaN instead of raising """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path, transport=FakeGridTransport())
+    empty = pd.DataFrame(
+        {"from": pd.to_datetime([], utc=True), "to": pd.to_datetime([], utc=True)}
+    )
+    empty["region"] = pd.Series(dtype=str)
+    empty["voltage_level"] = pd.Series(dtype=str)
+    assert len(grid.get_price(empty)) == 0 and "pennies_per_kwh" in grid.get_price(empty)
+    assert len(grid.get_c02(empty)) == 0 and "intensity_forecast" in grid.get_c02(empty)
+
+    grid = UKGridConnection(cache_path=tmp_path / "empty", transport=EmptyPriceTransport())
+    profile = pd.DataFrame({"from": pd.date_range("2019-01-01", periods=4, freq="30min")})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=30)
+    profile["region"] = "Yorkshire"
+    profile["voltage_level"] = "Low Voltage: <1kV"
+    assert grid.get_price(profile).pennies_per_kwh.isna().all()
+
+
+def test_get_c02_keeps_slot_columns(tmp_path):
+    """ Labels of the CO2 slots (index, region details, slot times) are returned as before """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection, generationmix_cols
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path, transport=FakeGridTransport())
+    profile = pd.DataFrame({"from": pd.date_range("2020-01-01", periods=4, freq="15min")})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=15)
+    profile["region"] = "London"
+
+    co2 = grid.get_c02(profile)
+    for col in ["intensity_index", "regionid", "dnoregion", "shortname", "source_postcode",
+                "region_ci", "postcode_ci", "from_utc", *generationmix_cols]:
+        assert col in co2.columns
+    assert co2.intensity_index.notna().all()
+    assert list(co2.from_ci) == list(pd.to_datetime(profile["from"], utc=True).dt.floor("30min"))
+
+
+def test_regional_co2_starts_after_national(tmp_path):
+    """ Regional CO2 data is only requested from the start of the regional dataset """
+    import pandas as pd
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    grid = UKGridConnection(cache_path=tmp_path, transport=FakeGridTransport())
+    profile = pd.DataFrame({"from": pd.date_range("2018-01-01", periods=48, freq="30min")})
+    profile["to"] = profile["from"] + pd.Timedelta(minutes=30)
+    assert grid.get_c02(profile.assign(region="London")).intensity_forecast.isna().all()
+    assert grid.transport.requested_urls == []
+    assert grid.get_c02(profile).intensity_forecast.notna().all()  # National
+    assert len(grid.transport.requested_urls) == 1
+
+def test_co2_forecasts_are_fetched_again(tmp_path, monkeypatch):
+    """ Slots not over when fetched (forecasts) are fetched again after co2_forecast_ttl """
+    import time
+    import pandas as pd
+    import src.UKGridConnection as connection
+    from src.UKGridConnection import UKGridConnection
+    from src.transport import FakeGridTransport
+    transport = FakeGridTransport()
+    grid = UKGridConnection(cache_path=tmp_path, requests_per_second=None, transport=transport)
+    now = pd.Timestamp.now(tz="UTC").floor("30min")
+    past = pd.DataFrame({"from": [now - pd.Timedelta(days=2)], "to": [now - pd.Timedelta(days=1)]})
+    recent = pd.DataFrame({"from": [now - pd.Timedelta(hours=2)], "to": [now + pd.Timedelta(hours=2)]})
+    grid.get_c02(past)
+    grid.get_c02(recent)
+    fetched = len(transport.requested_urls)
+    grid.get_c02(recent)
+    assert len(transport.requested_urls) == fetched  # Forecasts fetched less than 30 min ago
+
+    monkeypatch.setattr(connection, "co2_forecast_ttl", pd.Timedelta(seconds=1))
+    time.sleep(1.1)
+    grid.get_c02(past)
+    assert len(transport.requested_urls) == fetched  # Slots fetched once over are final
+    result = grid.get_c02(recent)
+    assert len(transport.requested_urls) == fetched + 1
+    assert f"/intensity/{now:%Y-%m-%dT%H:%MZ}/" in transport.requested_urls[-1]  # Forecasts only
+    assert result.intensity_forecast.notna().all()
+    assert "unavailable_ranges{cache=co2}" not in grid.stats()["counters"]
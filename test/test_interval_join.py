@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+
+def ns(times):
+    return pd.DatetimeIndex(times, tz="UTC").values.astype("int64")
+
+
+def test_interval_means_of_arbitrary_intervals():
+    """ 15-minute, 1-hour and misaligned intervals are time-weighted over 30-minute slots """
+    from src.interval_join import interval_integrals, time_weighted_means
+    slot_from = pd.date_range("2019-01-01", periods=4, freq="30min", tz="UTC")
+    slot_to = slot_from + pd.Timedelta(minutes=30)
+    values = np.array([10.0, 20.0, 30.0, 40.0])
+    query_from = ns(["2019-01-01 00:15", "2019-01-01 00:00", "2019-01-01 00:45"])
+    query_to = ns(["2019-01-01 00:30", "2019-01-01 01:00", "2019-01-01 01:45"])
+
+    integrals, covered = interval_integrals(
+        slot_from.values.astype("int64"), slot_to.values.astype("int64"), values, query_from, query_to
+    )
+    means = time_weighted_means(integrals, covered, query_from, query_to)
+
+    np.testing.assert_allclose(integrals[:, 0], [2.5, 15.0, 30.0])  # value * hours
+    np.testing.assert_allclose(means[:, 0], [10.0, 15.0, 30.0])
+
+
+def test_interval_means_are_nan_unless_fully_covered():
+    from src.interval_join import interval_integrals, time_weighted_means
+    slot_from = ns(["2019-01-01 00:00", "2019-01-01 00:30", "2019-01-01 01:30"])  # 01:00 gap
+    slot_to = slot_from + 30 * 60 * 10**9
+    values = np.array([[1.0, np.nan], [3.0, 2.0], [5.0, 2.0]])
+    query_from = ns(["2019-01-01 00:00", "2019-01-01 00:30", "2019-01-01 23:00"])
+    query_to = ns(["2019-01-01 01:00", "2019-01-01 02:00", "2019-01-01 23:30"])
+
+    integrals, covered = interval_integrals(slot_from, slot_to, values, query_from, query_to)
+    means = time_weighted_means(integrals, covered, query_from, query_to)
+
+    assert means.shape == (3, 2)
+    assert means[0, 0] == 2.0 and np.isnan(means[0, 1])  # Missing value in one column
+    assert np.isnan(means[1]).all()  # Gap in the cache
+    assert np.isnan(means[2]).all()  # After the cache
+
+
+def test_interval_integrals_without_slots():
+    """ No cached slots: nothing is covered, every mean is NaN """
+    from src.interval_join import interval_integrals, time_weighted_means
+    query_from = ns(["2019-01-01 00:00", "2019-01-01 00:30"])
+    query_to = ns(["2019-01-01 00:30", "2019-01-01 01:00"])
+
+    integrals, covered = interval_integrals([], [], np.zeros((0, 2)), query_from, query_to)
+    assert integrals.shape == covered.shape == (2, 2) and not covered.any()
+    assert np.isnan(time_weighted_means(integrals, covered, query_from, query_to)).all()
+
+    integrals, covered = interval_integrals([], [], [], [], [])
+    assert integrals.shape == (0, 1)
+
+
+def test_covering_slots_per_series():
+    from src.interval_join import covering_slots
+    slot_from = ns(["2019-01-01 00:00", "2019-01-01 00:30", "2019-01-01 00:00"])
+    slot_to = slot_from + 30 * 60 * 10**9
+    query_from = ns(["2019-01-01 00:45", "2019-01-01 00:15", "2019-01-01 00:30", "2019-01-01 02:00"])
+
+    position = covering_slots(slot_from, slot_to, query_from, [0, 0, 1], [0, 1, 1, 0])
+    assert list(position) == [1, 2, -1, -1]  # Series 1 has no 00:30 slot, nothing at 02:00
+    assert list(covering_slots([], [], query_from)) == [-1] * 4
@@ -0,0 +1,20 @@
+def test_metrics_counters_timers_and_hooks():
+    from src.metrics import Metrics
+    metrics = Metrics()
+    observed = []
+    metrics.add_hook(lambda kind, name, value, labels: observed.append((kind, name, labels)))
+    metrics.count("api_requests", cache="price")
+    metrics.count("api_requests", 2, cache="price")
+    metrics.count("api_requests", cache="co2")
+    with metrics.timer("get_price"):
+        pass
+    stats = metrics.stats()
+    assert stats["counters"] == {"api_requests{cache=co2}": 1, "api_requests{cache=price}": 3}
+    assert stats["timers"]["get_price"]["count"] == 1
+    assert observed[-1] == ("timer", "get_price", {})
+
+    text = metrics.prometheus()
+    assert "# TYPE energygrid_api_requests_total counter\n" in text
+    assert 'energygrid_api_requests_total{cache="price"} 3\n' in text
+    assert 'energygrid_stage_seconds_count{stage="get_price"} 1\n' in text
+    assert text.count("# TYPE") == 2
@@ -0,0 +1,24 @@
+import pandas as pd
+from datetime import timedelta
+
+
+def ts(text):
+    return pd.Timestamp(text, tz="UTC")
+
+
+def test_unavailable_ranges_are_subtracted_until_they_expire(tmp_path):
+    from src.negative_cache import UnavailableRanges
+    ranges = UnavailableRanges(tmp_path / "unavailable.json", ttl=timedelta(hours=1))
+    key = ("Yorkshire", "LV")
+    ranges.add(key, [(ts("2019-01-10"), ts("2019-01-12"))])
+    remaining, skipped = ranges.subtract(key, [(ts("2019-01-01"), ts("2019-01-31"))])
+    assert skipped
+    assert remaining == [(ts("2019-01-01"), ts("2019-01-10")), (ts("2019-01-12"), ts("2019-01-31"))]
+    assert ranges.subtract(("London", "LV"), [(ts("2019-01-01"), ts("2019-01-31"))])[1] is False
+
+    shared = UnavailableRanges(tmp_path / "unavailable.json")  # Another process
+    assert shared.subtract(key, [(ts("2019-01-10"), ts("2019-01-11"))]) == ([], True)
+
+    expired = UnavailableRanges(tmp_path / "expired.json", ttl=timedelta(0))
+    expired.add(key, [(ts("2019-01-10"), ts("2019-01-12"))])
+    assert expired.subtract(key, [(ts("2019-01-10"), ts("2019-01-11"))])[1] is False
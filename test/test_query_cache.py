@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+
+def test_query_cache_lru_eviction_by_bytes():
+    from src.query_cache import QueryCache
+    cache = QueryCache(max_bytes=2 * 800)
+    results = {key: {"x": np.zeros(100)} for key in [b"a", b"b", b"c"]}  # 800 bytes each
+    cache.put(b"a", results[b"a"], cache.versions([]))
+    cache.put(b"b", results[b"b"], cache.versions([]))
+    assert cache.get(b"a") is results[b"a"]  # b is now the least recently used
+    cache.put(b"c", results[b"c"], cache.versions([]))
+    assert cache.get(b"b") is None
+    assert cache.get(b"c") is results[b"c"]
+    assert cache.stats() == {"entries": 2, "bytes": 1600, "hits": 2, "misses": 1, "evictions": 1}
+
+
+def test_query_cache_invalidation_by_series():
+    from src.query_cache import QueryCache
+    cache = QueryCache()
+    versions = cache.versions([("A", "LV")])
+    cache.invalidate([("A", "LV")])  # Updated while the result was computed
+    cache.put(b"stale", {"x": np.zeros(1)}, versions)
+    cache.put(b"a", {"x": np.zeros(1)}, cache.versions([("A", "LV")]))
+    cache.put(b"b", {"x": np.zeros(1)}, cache.versions([("B", "LV")]))
+    assert cache.get(b"stale") is None
+    cache.invalidate([("A", "LV")])
+    assert cache.get(b"a") is None
+    assert cache.get(b"b") is not None
+    cache.invalidate()
+    assert cache.get(b"b") is None
+
+
+def test_query_key_ignores_index():
+    from src.query_cache import query_key
+    frame = pd.DataFrame({"region": ["A", "B"], "value": [1.0, 2.0]})
+    assert query_key(frame) == query_key(frame.set_axis([5, 6]))
+    assert query_key(frame) != query_key(frame.assign(value=[1.0, 3.0]))
+
+
+def test_query_cache_sizes_pandas_and_object_columns():
+    """ Tz-aware and label columns are sized without conversion, labels with their strings """
+    from src.query_cache import QueryCache, result_nbytes
+    times = pd.Series(pd.date_range("2020-01-01", periods=100, freq="30min", tz="UTC")).array
+    labels = np.array(["moderate"] * 100, dtype=object)
+    assert result_nbytes(times) == 800
+    assert result_nbytes(labels) > 800  # Pointers plus strings
+
+    cache = QueryCache(max_bytes=0)  # Disabled: nothing is sized nor stored
+    cache.put(b"a", {"from": times, "label": labels}, cache.versions([]))
+    assert cache.stats()["entries"] == 0
+    cache = QueryCache()
+    cache.put(b"a", {"from": times, "label": labels}, cache.versions([]))
+    assert cache.stats()["bytes"] == result_nbytes(times) + result_nbytes(labels)
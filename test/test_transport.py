@@ -0,0 +1,64 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def serve(responses):
+    """ Local HTTP server answering GET requests with the given (status, body) in order """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, body = responses.pop(0)
+            self.send_response(status)
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_http_transport_retries_on_server_errors():
+    from src.transport import HTTPTransport
+    responses = [(503, {}), (429, {}), (200, {"data": [1, 2]})]
+    server = serve(responses)
+    transport = HTTPTransport(timeout=5, backoff_factor=0.01)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/prices"
+        assert transport.get_json(url) == {"data": [1, 2]}
+        assert responses == []
+    finally:
+        transport.close()
+        server.shutdown()
+
+
+def test_replay_transport_records_and_replays(tmp_path):
+    import pytest
+    from src.transport import FakeGridTransport, ReplayTransport
+    url = "https://api.carbonintensity.org.uk/intensity/2020-01-01T00:00Z/2020-01-01T01:00Z"
+    fake = FakeGridTransport()
+    recorded = ReplayTransport(tmp_path, record_from=fake).get_json(url)
+    assert ReplayTransport(tmp_path).get_json(url) == recorded
+    assert len(fake.requested_urls) == 1
+    with pytest.raises(FileNotFoundError):
+        ReplayTransport(tmp_path).get_json(url.replace("01:00Z", "02:00Z"))
+
+
+def test_http_transport_counts_bytes_and_retries_per_label():
+    from src.metrics import Metrics
+    from src.transport import HTTPTransport
+    responses = [(503, {}), (200, {"data": [1, 2]})]
+    server = serve(responses)
+    metrics = Metrics()
+    transport = HTTPTransport(timeout=5, backoff_factor=0.01, metrics=metrics)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/prices"
+        transport.get_json(url, labels={"cache": "price"})
+        counters = metrics.stats()["counters"]
+        assert counters["api_retries{cache=price}"] == 1
+        assert counters["api_bytes{cache=price}"] == len(b'{"data": [1, 2]}')
+    finally:
+        transport.close()
+        server.shutdown()
@@ -0,0 +1,19 @@
+def test_time_chunks():
+    from datetime import datetime, timedelta
+    from src.utils import time_chunks
+    chunks = time_chunks(datetime(2020, 1, 1), datetime(2020, 1, 10), timedelta(days=4))
+    assert chunks == [
+        (datetime(2020, 1, 1), datetime(2020, 1, 5)),
+        (datetime(2020, 1, 5), datetime(2020, 1, 9)),
+        (datetime(2020, 1, 9), datetime(2020, 1, 10)),
+    ]
+
+
+def test_rate_limiter_spaces_requests():
+    import time
+    from src.utils import RateLimiter
+    limiter = RateLimiter(requests_per_second=20)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.wait()
+    assert time.monotonic() - start >= 4 / 20